@@ -0,0 +1,154 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Load-driven powermetrics sampling period for ``--adaptive_interval``."""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import deque
+from typing import List, Mapping
+
+from prometheus_client import CollectorRegistry, Counter, Gauge
+
+
+# Keys of ``PrometheusExporter.derive_sample`` values the controller reads.
+UTILISATION_KEYS = ('host_ecpu_percent', 'host_pcpu_percent', 'host_gpu_percent')
+POWER_KEYS = ('host_cpu_power', 'host_gpu_power')
+
+
+def period_levels(min_period: float, max_period: float) -> List[float]:
+    """Return ``min_period`` doubled up to ``max_period``, the periods the controller uses."""
+    levels = [min_period]
+    while levels[-1] * 2 < max_period:
+        levels.append(levels[-1] * 2)
+    if levels[-1] < max_period:
+        levels.append(max_period)
+    return levels
+
+
+class AdaptiveRate:  # pylint: disable=too-many-instance-attributes
+    """Pick the powermetrics sampling period from the recent load.
+
+    The frames of every publishing interval are fed to :meth:`observe`; at
+    the end of the interval :meth:`update` looks at the busiest of the E-CPU,
+    P-CPU and GPU utilisations and at the coefficient of variation of the
+    CPU + GPU power over the last ``history`` frames. A busy or bursty
+    interval halves the period at once, while it is only doubled after
+    ``idle_intervals`` quiet intervals in a row, so a short lull does not
+    make the rate flap. Periods are ``min_period`` times a power of two.
+
+    The exporter's own CPU time is counted per period, so the cost of every
+    sampling rate can be read off ``asitop_exporter_cpu_seconds``.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        min_period: float,
+        max_period: float,
+        *,
+        busy_percent: float = 50.0,
+        idle_percent: float = 10.0,
+        busy_variation: float = 0.25,
+        idle_variation: float = 0.05,
+        idle_intervals: int = 3,
+        history: int = 16,
+        registry: CollectorRegistry | None = None,
+    ) -> None:
+        self.levels = period_levels(min_period, max_period)
+        # Start slow; the first busy interval speeds up.
+        self.level = len(self.levels) - 1
+        self.busy_percent = busy_percent
+        self.idle_percent = idle_percent
+        self.busy_variation = busy_variation
+        self.idle_variation = idle_variation
+        self.idle_intervals = idle_intervals
+        self.powers = deque(maxlen=history)
+        self.utilisation = 0.0
+        self.quiet = 0
+        self.cpu_time = time.process_time()
+
+        self.period_gauge = Gauge(
+            name='asitop_exporter_sample_period_seconds',
+            documentation='Current powermetrics sampling period chosen by --adaptive_interval.',
+            registry=registry,
+        )
+        self.changes = Counter(
+            name='asitop_exporter_sample_period_changes',
+            documentation='Sampling period changes made by --adaptive_interval.',
+            registry=registry,
+        )
+        self.cpu_seconds = Counter(
+            name='asitop_exporter_cpu_seconds',
+            documentation='CPU time of the exporter process, by the sampling period it was running at.',
+            labelnames=['period'],
+            registry=registry,
+        )
+        self.period_gauge.set(self.period)
+
+    @property
+    def period(self) -> float:
+        return self.levels[self.level]
+
+    @property
+    def min_period(self) -> float:
+        return self.levels[0]
+
+    def observe(self, values: Mapping[str, float]) -> None:
+        utilisation = max(values[key] for key in UTILISATION_KEYS)
+        if utilisation > self.utilisation:
+            self.utilisation = utilisation
+        self.powers.append(sum(values[key] for key in POWER_KEYS))
+
+    def variation(self) -> float:
+        """Coefficient of variation of the recent power samples."""
+        count = len(self.powers)
+        if count < 2:
+            return 0.0
+        mean = sum(self.powers) / count
+        if mean <= 0:
+            return 0.0
+        variance = sum((power - mean) ** 2 for power in self.powers) / count
+        return math.sqrt(variance) / mean
+
+    def update(self) -> float | None:
+        """Close the interval; return the new period if it changes, else ``None``."""
+        now = time.process_time()
+        self.cpu_seconds.labels(format(self.period, 'g')).inc(now - self.cpu_time)
+        self.cpu_time = now
+
+        utilisation = self.utilisation
+        variation = self.variation()
+        self.utilisation = 0.0
+        level = self.level
+        if utilisation >= self.busy_percent or variation >= self.busy_variation:
+            self.quiet = 0
+            level = max(0, level - 1)
+        elif utilisation <= self.idle_percent and variation <= self.idle_variation:
+            self.quiet += 1
+            if self.quiet >= self.idle_intervals:
+                self.quiet = 0
+                level = min(len(self.levels) - 1, level + 1)
+        else:
+            self.quiet = 0
+
+        if level == self.level:
+            return None
+        self.level = level
+        self.period_gauge.set(self.period)
+        self.changes.inc()
+        return self.period
@@ -0,0 +1,91 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Per-window min/max/mean/last aggregation of high-resolution samples."""
+
+from __future__ import annotations
+
+from array import array
+from typing import Dict, Iterable, Mapping, Tuple
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+# (min, max, mean, last)
+WindowStats = Tuple[float, float, float, float]
+STATS = ('min', 'max', 'mean', 'last')
+
+
+class WindowAggregator:
+    """Fixed-capacity ring buffers of samples for a set of metrics.
+
+    Samples are stored in one ``capacity x len(keys)`` array, a column per
+    metric, so the statistics of every metric are computed in one vectorised
+    pass with NumPy when it is installed. Without NumPy one ``array('d')``
+    ring is kept per metric. When more than ``capacity`` samples arrive in a
+    window the oldest ones are overwritten.
+    """
+
+    def __init__(self, keys: Iterable[str], capacity: int, *, use_numpy: bool = True) -> None:
+        self.keys = tuple(keys)
+        self.capacity = max(1, capacity)
+        self.use_numpy = use_numpy and numpy is not None
+        if self.use_numpy:
+            self.buffer = numpy.zeros((self.capacity, len(self.keys)))
+        else:
+            self.columns = [array('d', bytes(8 * self.capacity)) for _ in self.keys]
+        self.position = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def add(self, values: Mapping[str, float]) -> None:
+        position = self.position
+        if self.use_numpy:
+            self.buffer[position] = [values[key] for key in self.keys]
+        else:
+            for column, key in zip(self.columns, self.keys):
+                column[position] = values[key]
+        self.position = (position + 1) % self.capacity
+        self.count += 1
+
+    def reset(self) -> None:
+        self.position = 0
+        self.count = 0
+
+    def summary(self) -> Dict[str, WindowStats] | None:
+        """Return ``{key: (min, max, mean, last)}`` over the current window."""
+        size = len(self)
+        if size == 0:
+            return None
+        last = (self.position - 1) % self.capacity
+        if self.use_numpy:
+            window = self.buffer[:size]
+            return dict(zip(self.keys, zip(
+                window.min(axis=0).tolist(),
+                window.max(axis=0).tolist(),
+                window.mean(axis=0).tolist(),
+                self.buffer[last].tolist(),
+            )))
+        summary = {}
+        for key, column in zip(self.keys, self.columns):
+            window = column[:size]
+            summary[key] = (min(window), max(window), sum(window) / size, column[last])
+        return summary
@@ -20,34 +20,19 @@ from __future__ import annotations
 import time
 import argparse
 import sys
-from typing import TextIO
 
-from prometheus_client import start_wsgi_server
 from termcolor import colored
 
+from asitop_exporter.debug import DebugApp, ProfileGate
 from asitop_exporter.exporter import PrometheusExporter
-from asitop_exporter.utils import get_ip_address, run_powermetrics_process
+from asitop_exporter.payload import FORMATS
+from asitop_exporter.server import ExporterApp, start_asyncio_server, start_wsgi_server
+from asitop_exporter.sketch import DEFAULT_QUANTILES
+from asitop_exporter.tasks import MAX_TOP_TASKS
+from asitop_exporter.utils import cprint, get_ip_address, get_soc_info, powermetrics_samplers, run_powermetrics_process
 from asitop_exporter.version import __version__
 
 
-def cprint(text: str = '', *, file: TextIO | None = None) -> None:
-    """Print colored text to a file."""
-    for prefix, color in (
-        ('INFO: ', 'yellow'),
-        ('WARNING: ', 'yellow'),
-        ('ERROR: ', 'red'),
-        ('NVML ERROR: ', 'red'),
-    ):
-        if text.startswith(prefix):
-            # text = text.replace(
-            #     prefix.rstrip(),
-            #     colored(prefix.rstrip(), color=color, attrs=('bold',)),
-            #     1,
-            # )
-            text = prefix.rstrip()
-    print(text, file=file)
-
-
 def parse_arguments() -> argparse.Namespace:
     """Parse command-line arguments for ``asitop-exporter``."""
 
@@ -59,6 +44,11 @@ def parse_arguments() -> argparse.Namespace:
 
     posfloat.__name__ = 'positive float'
 
+    def floatlist(argstring: str) -> list:
+        return [posfloat(item) for item in argstring.split(',') if item.strip()]
+
+    floatlist.__name__ = 'comma-separated list of positive floats'
+
     parser = argparse.ArgumentParser(
         prog='asitop-exporter',
         description='Prometheus exporter built on top of `asitop`.',
@@ -109,6 +99,23 @@ def parse_arguments() -> argparse.Namespace:
         default=8000,
         help='Port to listen on. (default: %(default)d)',
     )
+    parser.add_argument(
+        '--server',
+        dest='server',
+        choices=('threaded', 'asyncio'),
+        default='threaded',
+        help='HTTP server for /metrics: one thread per request, or an asyncio event loop\n'
+             'with keep-alive for many concurrent scrapers. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--request_timeout',
+        dest='request_timeout',
+        type=posfloat,
+        default=10.0,
+        metavar='SEC',
+        help='drop --server asyncio connections that take longer to send a request or\n'
+             'read a response. (default: %(default)s)',
+    )
     parser.add_argument(
         '--interval',
         dest='interval',
@@ -118,6 +125,62 @@ def parse_arguments() -> argparse.Namespace:
         help='Interval between updates in seconds. (default: %(default)s)',
     )
 
+    parser.add_argument(
+        '--sample_interval',
+        dest='sample_interval',
+        type=posfloat,
+        default=None,
+        metavar='MS',
+        help='let powermetrics sample every MS milliseconds and also export min/max/mean/last\n'
+             'of the samples within each --interval. (e.g. 100-250)',
+    )
+    parser.add_argument(
+        '--adaptive_interval',
+        dest='adaptive_interval',
+        type=floatlist,
+        default=None,
+        metavar='MIN_MS,MAX_MS',
+        help='like --sample_interval, but sample faster (down to MIN_MS) while the host is busy\n'
+             'or its power is bursty and slower (up to MAX_MS) while it is idle, e.g. 100,1000.\n'
+             'Implies --stream. (default: disabled)',
+    )
+
+    parser.add_argument(
+        '--quantile_windows',
+        dest='quantile_windows',
+        type=floatlist,
+        default=[],
+        metavar='SEC[,SEC...]',
+        help='export p50/p95/p99 summaries of power, cluster utilisation and frequency\n'
+             'over these sliding windows, e.g. 60,300. (default: disabled)',
+    )
+    parser.add_argument(
+        '--quantiles',
+        dest='quantiles',
+        type=floatlist,
+        default=list(DEFAULT_QUANTILES),
+        metavar='Q[,Q...]',
+        help='quantiles reported for --quantile_windows. (default: 0.5,0.95,0.99)',
+    )
+
+    parser.add_argument(
+        '--history_size',
+        dest='history_size',
+        type=int,
+        default=0,
+        metavar='N',
+        help='keep the last N samples of every host metric in memory and serve them at\n'
+             '/api/v1/range?metric=<name>&start=<unix>&end=<unix>[&format=binary]. (default: disabled)',
+    )
+    parser.add_argument(
+        '--history_file',
+        dest='history_file',
+        type=str,
+        default=None,
+        metavar='PATH',
+        help='memory-map the --history_size store to PATH so it survives restarts',
+    )
+
     parser.add_argument(
         '--post_url',
         dest='post_url',
@@ -127,6 +190,109 @@ def parse_arguments() -> argparse.Namespace:
         help='post result to url',
     )
 
+    parser.add_argument(
+        '--post_batch',
+        dest='post_batch',
+        type=int,
+        default=1,
+        metavar='N',
+        help='send up to N intervals in one post request. (default: %(default)d)',
+    )
+    parser.add_argument(
+        '--post_gzip',
+        dest='post_gzip',
+        action='store_true',
+        help='gzip the post request body',
+    )
+    parser.add_argument(
+        '--post_timeout',
+        dest='post_timeout',
+        type=posfloat,
+        default=5.0,
+        metavar='SEC',
+        help='timeout of one post request in seconds. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--post_format',
+        dest='post_format',
+        choices=FORMATS,
+        default='records',
+        help='post one JSON object per metric (records) or one per interval with parallel metrics/values lists (columnar). (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--post_queue_size',
+        dest='post_queue_size',
+        type=int,
+        default=64,
+        metavar='N',
+        help='intervals buffered for posting before new ones are dropped. (default: %(default)d)',
+    )
+    parser.add_argument(
+        '--post_retries',
+        dest='post_retries',
+        type=int,
+        default=3,
+        metavar='N',
+        help='retries of a failed post request, with exponential backoff. (default: %(default)d)',
+    )
+
+    parser.add_argument(
+        '--statsd',
+        dest='statsd',
+        type=str,
+        default=None,
+        metavar='HOST:PORT',
+        help='also send every sample as StatsD gauges over UDP to HOST:PORT',
+    )
+    parser.add_argument(
+        '--jsonl_file',
+        dest='jsonl_file',
+        type=str,
+        default=None,
+        metavar='PATH',
+        help='also append every sample to PATH as one JSON object per line',
+    )
+    parser.add_argument(
+        '--sink_queue_size',
+        dest='sink_queue_size',
+        type=int,
+        default=64,
+        metavar='N',
+        help='samples buffered for --statsd and --jsonl_file before new ones are dropped. (default: %(default)d)',
+    )
+
+    parser.add_argument(
+        '--push_url',
+        dest='push_url',
+        type=str,
+        default=None,
+        metavar='ADDRESS',
+        help='also push the metrics to a Pushgateway at ADDRESS, for hosts Prometheus cannot reach',
+    )
+    parser.add_argument(
+        '--push_job',
+        dest='push_job',
+        type=str,
+        default='asitop_exporter',
+        metavar='JOB',
+        help='job label of the pushed metrics, the instance label is --hostname. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--push_interval',
+        dest='push_interval',
+        type=posfloat,
+        default=None,
+        metavar='SEC',
+        help='seconds between pushes; the latest sample is pushed, so a multiple of --interval\n'
+             'coalesces several samples into one request. (default: --interval)',
+    )
+    parser.add_argument(
+        '--push_gzip',
+        dest='push_gzip',
+        action='store_true',
+        help='gzip the push request body',
+    )
+
     parser.add_argument(
         '--alive_time',
         dest='alive_time',
@@ -136,6 +302,81 @@ def parse_arguments() -> argparse.Namespace:
         help='powermetrics file alive time. asitop-exporter will delete the pre file and create a new one after alive_time',
     )
 
+    parser.add_argument(
+        '--record_dir',
+        dest='record_dir',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help='keep the raw powermetrics frames in zlib-compressed, indexed segment files in DIR\n'
+             'instead of the /tmp scratch file (implies --stream). Read them back with\n'
+             'asitop_exporter.recorder.Recording or `asitop-exporter extract DIR`',
+    )
+    parser.add_argument(
+        '--record_max_size',
+        dest='record_max_size',
+        type=posfloat,
+        default=1024,
+        metavar='MB',
+        help='delete the oldest segments beyond this total size. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--record_segment_size',
+        dest='record_segment_size',
+        type=posfloat,
+        default=64,
+        metavar='MB',
+        help='start a new segment after this size. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--record_segment_time',
+        dest='record_segment_time',
+        type=posfloat,
+        default=3600,
+        metavar='SEC',
+        help='start a new segment after this many seconds. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--bandwidth',
+        dest='bandwidth',
+        action='store_true',
+        help='export memory bandwidth (E-CPU, P-CPU, GPU, media and DRAM total, GB/s) from the\n'
+             'powermetrics bandwidth sampler, where this macOS still provides it.',
+    )
+    parser.add_argument(
+        '--top_tasks',
+        dest='top_tasks',
+        type=int,
+        default=0,
+        metavar='N',
+        help=f'export CPU time, energy impact and wakeups of the N processes with the highest\n'
+             f'energy impact (at most {MAX_TOP_TASKS}), the rest summed as name="other". (default: disabled)',
+    )
+
+    parser.add_argument(
+        '--debug_port',
+        dest='debug_port',
+        type=int,
+        default=None,
+        metavar='PORT',
+        help='serve profiling endpoints (stack sampling and cProfile for N seconds, tracemalloc\n'
+             'snapshots and diffs, thread stacks) on 127.0.0.1:PORT/debug/. (default: disabled)',
+    )
+    parser.add_argument(
+        '--no_self_metrics',
+        dest='self_metrics',
+        action='store_false',
+        help='do not export the asitop_exporter_* metrics about the exporter itself (parse, update\n'
+             'and render durations, sample age, retries, CPU and memory of it and of powermetrics).',
+    )
+
+    parser.add_argument(
+        '--stream',
+        dest='stream',
+        action='store_true',
+        help='read powermetrics frames from its stdout pipe instead of a temporary file. --alive_time is ignored',
+    )
+
     args = parser.parse_args()
     if args.interval < 0.25:
         parser.error(
@@ -143,12 +384,47 @@ def parse_arguments() -> argparse.Namespace:
             f'Expected 1/4 or higher.',
         )
 
+    if any(q > 1 for q in args.quantiles):
+        parser.error('quantiles must be between 0 and 1.')
+    if args.sample_interval is not None and not 10 <= args.sample_interval < args.interval * 1000:
+        parser.error(
+            f'the sample interval {args.sample_interval:g}ms must be at least 10ms and shorter than --interval.',
+        )
+    if args.adaptive_interval is not None:
+        if args.sample_interval is not None:
+            parser.error('--adaptive_interval and --sample_interval are mutually exclusive.')
+        if len(args.adaptive_interval) != 2:
+            parser.error('--adaptive_interval expects MIN_MS,MAX_MS.')
+        min_period, max_period = args.adaptive_interval
+        if not 10 <= min_period < max_period <= args.interval * 1000:
+            parser.error(
+                f'the adaptive interval {min_period:g}-{max_period:g}ms must be at least 10ms and '
+                f'no longer than --interval.',
+            )
+    if not 0 <= args.top_tasks <= MAX_TOP_TASKS:
+        parser.error(f'--top_tasks must be between 0 and {MAX_TOP_TASKS}.')
+
     return args
 
 
 def main() -> int:  # pylint: disable=too-many-locals,too-many-statements
     """Main function for ``asitop-exporter`` CLI."""
+    if sys.argv[1:2] == ['replay']:
+        from asitop_exporter.replay import main as replay_main  # pylint: disable=import-outside-toplevel
+
+        return replay_main(sys.argv[2:])
+    if sys.argv[1:2] == ['extract']:
+        from asitop_exporter.recorder import main as extract_main  # pylint: disable=import-outside-toplevel
+
+        return extract_main(sys.argv[2:])
+
     args = parse_arguments()
+    if args.bandwidth:
+        samplers = powermetrics_samplers()
+        if samplers and 'bandwidth' not in samplers:
+            # Removed from powermetrics in newer macOS releases.
+            cprint('WARNING: powermetrics has no bandwidth sampler on this macOS, --bandwidth is ignored.', file=sys.stderr)
+            args.bandwidth = False
 
 
     timecode = str(int(time.time()))
@@ -156,11 +432,62 @@ def main() -> int:  # pylint: disable=too-many-locals,too-many-statements
     # powermetrics_process = run_powermetrics_process(timecode,
     #                                                 interval=args.interval * 1000)
 
-    exporter = PrometheusExporter(hostname=args.hostname, interval=args.interval, timecode=timecode, post_url=args.post_url, alive_time=args.alive_time)
+    exporter = PrometheusExporter(
+        hostname=args.hostname,
+        interval=args.interval,
+        timecode=timecode,
+        post_url=args.post_url,
+        alive_time=args.alive_time,
+        stream=args.stream,
+        post_batch_size=args.post_batch,
+        post_compress=args.post_gzip,
+        post_timeout=args.post_timeout,
+        post_queue_size=args.post_queue_size,
+        post_retries=args.post_retries,
+        post_format=args.post_format,
+        sample_interval=args.sample_interval / 1000 if args.sample_interval is not None else None,
+        quantile_windows=args.quantile_windows,
+        quantiles=args.quantiles,
+        history_size=args.history_size,
+        history_path=args.history_file,
+        push_url=args.push_url,
+        push_job=args.push_job,
+        push_interval=args.push_interval,
+        push_compress=args.push_gzip,
+        statsd_address=args.statsd,
+        jsonl_path=args.jsonl_file,
+        sink_queue_size=args.sink_queue_size,
+        record_dir=args.record_dir,
+        record_max_bytes=int(args.record_max_size * (1 << 20)),
+        record_segment_size=int(args.record_segment_size * (1 << 20)),
+        record_segment_age=args.record_segment_time,
+        top_tasks=args.top_tasks,
+        bandwidth=args.bandwidth,
+        adaptive_interval=(
+            tuple(period / 1000 for period in args.adaptive_interval)
+            if args.adaptive_interval is not None
+            else None
+        ),
+        self_metrics=args.self_metrics,
+        profile_gate=ProfileGate() if args.debug_port is not None else None,
+        # Cached per boot, so only the first start pays for system_profiler.
+        soc_info=get_soc_info(),
+    )
     exporter.start_powermetrics_process()
 
     try:
-        start_wsgi_server(port=args.port, addr=args.bind_address)
+        app = ExporterApp(
+            exporter.registry,
+            history=exporter.history,
+            snapshot=lambda: exporter.collector.snapshot,
+            # Re-render at least once per interval, so a stalled sampler shows up.
+            max_age=args.interval if exporter.self_metrics is not None else None,
+            render_time=exporter.self_metrics.render if exporter.self_metrics is not None else None,
+        )
+        if args.server == 'asyncio':
+            start_asyncio_server(app, port=args.port, addr=args.bind_address, timeout=args.request_timeout)
+        else:
+            start_wsgi_server(app, port=args.port, addr=args.bind_address)
     except OSError as ex:
         if 'address already in use' in str(ex).lower():
             cprint(
@@ -192,6 +519,7 @@ def main() -> int:  # pylint: disable=too-many-locals,too-many-statements
             )
         else:
             cprint(f'ERROR: {ex}', file=sys.stderr)
+        exporter.close()
         return 1
 
     cprint(
@@ -206,12 +534,27 @@ def main() -> int:  # pylint: disable=too-many-locals,too-many-statements
         file=sys.stderr,
     )
 
+    if args.debug_port is not None:
+        try:
+            # Localhost only: profiles and stacks expose the process internals.
+            start_wsgi_server(
+                DebugApp(exporter.profile_gate, interval=args.interval),
+                port=args.debug_port,
+                addr='127.0.0.1',
+                name='debug-server',
+            )
+        except OSError as ex:
+            cprint(f'ERROR: Cannot serve the debug endpoints on 127.0.0.1:{args.debug_port}: {ex}', file=sys.stderr)
+            exporter.close()
+            return 1
+        cprint(f'INFO: Debug endpoints at http://127.0.0.1:{args.debug_port}/debug/', file=sys.stderr)
+
     try:
         exporter.collect()
     except KeyboardInterrupt:
         cprint(file=sys.stderr)
         cprint('INFO: Interrupted by user.', file=sys.stderr)
-        exporter.terminate_powermetrics_process()
+        exporter.close()
 
     return 0
 
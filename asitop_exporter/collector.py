@@ -0,0 +1,316 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Snapshot-based Prometheus collector for ``asitop-exporter``."""
+
+from __future__ import annotations
+
+import time
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Mapping, NamedTuple, Sequence, Tuple
+
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+
+from asitop_exporter.aggregate import STATS, WindowStats
+from asitop_exporter.parsers import CpuReading
+from asitop_exporter.sketch import QuantileSummary
+from asitop_exporter.tasks import TaskStats
+
+
+class MetricSpec(NamedTuple):
+    key: str  # key in ``PrometheusExporter.metrics_dict`` or ``CpuSample`` field
+    name: str
+    documentation: str
+    unit: str
+
+
+# pylint: disable=line-too-long
+HOST_METRICS: Tuple[MetricSpec, ...] = (
+    # E-CPU
+    MetricSpec('host_ecpu_percent', 'host_ECPU_percent', 'Host E-CPU percent (%).', 'Percentage'),
+    MetricSpec('host_ecpu_clock', 'host_ECPU_clock', 'Host E-CPU clock (MHZ).', 'MHz'),
+    # P-CPU
+    MetricSpec('host_pcpu_percent', 'host_PCPU_percent', 'Host P-CPU percent (%).', 'Percentage'),
+    MetricSpec('host_pcpu_clock', 'host_PCPU_clock', 'Host P-CPU clock (MHZ).', 'MHz'),
+    # GPU
+    MetricSpec('host_gpu_percent', 'host_GPU_percent', 'Host GPU percent (%).', 'Percentage'),
+    MetricSpec('host_gpu_clock', 'host_GPU_clock', 'Host GPU clock (MHZ).', 'MHz'),
+    # ANE
+    MetricSpec('host_ane_percent', 'host_ANE_percent', 'Host ANE percent (%).', 'Percentage'),
+    MetricSpec('host_ane_power', 'host_ANE_power', 'Host ANE power (W).', 'W'),
+    # RAM
+    MetricSpec('host_ram_total', 'host_RAM_total', 'Host RAM total (GB).', 'GB'),
+    MetricSpec('host_ram_used', 'host_RAM_uesd', 'Host RAM used (GB).', 'GB'),
+    MetricSpec('host_ram_free', 'host_RAM_free', 'Host RAM free (GB).', 'GB'),
+    MetricSpec('host_swap_total', 'host_swap_total', 'Host swap total (GB).', 'GB'),
+    MetricSpec('host_swap_used', 'host_swap_uesd', 'Host swap used (GB).', 'GB'),
+    MetricSpec('host_swap_free', 'host_swap_free', 'Host swap free (GB).', 'GB'),
+    # Power
+    MetricSpec('host_cpu_power', 'host_cpu_power', 'Host cpu power (W).', 'W'),
+    MetricSpec('host_cpu_peak_power', 'host_cpu_peak_power', 'Host cpu peak power (W).', 'W'),
+    MetricSpec('host_cpu_avg_power', 'host_cpu_avg_power', 'Host cpu avg power (W).', 'W'),
+    MetricSpec('host_gpu_power', 'host_gpu_power', 'Host gpu power (W).', 'W'),
+    MetricSpec('host_gpu_peak_power', 'host_gpu_peak_power', 'Host gpu peak power (W).', 'W'),
+    MetricSpec('host_gpu_avg_power', 'host_gpu_avg_power', 'Host gpu avg power (W).', 'W'),
+)
+# Memory bandwidth from the ``bandwidth`` sampler (``--bandwidth``).
+BANDWIDTH_METRICS: Tuple[MetricSpec, ...] = (
+    MetricSpec('host_ecpu_bandwidth', 'host_ECPU_bandwidth', 'Host E-CPU memory bandwidth (GB/s).', 'GBps'),
+    MetricSpec('host_pcpu_bandwidth', 'host_PCPU_bandwidth', 'Host P-CPU memory bandwidth (GB/s).', 'GBps'),
+    MetricSpec('host_gpu_bandwidth', 'host_GPU_bandwidth', 'Host GPU memory bandwidth (GB/s).', 'GBps'),
+    MetricSpec('host_media_bandwidth', 'host_media_bandwidth', 'Host media engines memory bandwidth (GB/s).', 'GBps'),
+    MetricSpec('host_dram_read_bandwidth', 'host_DRAM_read_bandwidth', 'Host DRAM read bandwidth (GB/s).', 'GBps'),
+    MetricSpec('host_dram_write_bandwidth', 'host_DRAM_write_bandwidth', 'Host DRAM write bandwidth (GB/s).', 'GBps'),
+    MetricSpec('host_dram_bandwidth', 'host_DRAM_bandwidth', 'Host DRAM total bandwidth (GB/s).', 'GBps'),
+)
+# pylint: enable=line-too-long
+
+
+# Metrics that are also aggregated over the publishing window when sampling
+# at a higher rate than ``--interval``.
+WINDOW_KEYS: Tuple[str, ...] = (
+    'host_ecpu_percent',
+    'host_ecpu_clock',
+    'host_pcpu_percent',
+    'host_pcpu_clock',
+    'host_gpu_percent',
+    'host_gpu_clock',
+    'host_ane_percent',
+    'host_ane_power',
+    'host_cpu_power',
+    'host_gpu_power',
+)
+WINDOW_METRICS: Tuple[MetricSpec, ...] = tuple(
+    MetricSpec(spec.key, spec.name + '_window', spec.documentation.replace('.', ' over the last interval.', 1), spec.unit)
+    for spec in HOST_METRICS
+    if spec.key in WINDOW_KEYS
+)
+WINDOW_LABELS = ['hostname', 'stat']
+
+# Metrics whose distribution over ``--quantile_windows`` is exported as a summary.
+QUANTILE_KEYS: Tuple[str, ...] = (
+    'host_ecpu_percent',
+    'host_ecpu_clock',
+    'host_pcpu_percent',
+    'host_pcpu_clock',
+    'host_ane_power',
+    'host_cpu_power',
+    'host_gpu_power',
+)
+QUANTILE_METRICS: Tuple[MetricSpec, ...] = tuple(
+    MetricSpec(spec.key, spec.name + '_distribution', spec.documentation.replace('.', ' distribution.', 1), spec.unit)
+    for spec in HOST_METRICS
+    if spec.key in QUANTILE_KEYS
+)
+
+CLUSTER_METRICS: Tuple[MetricSpec, ...] = (
+    MetricSpec('cluster_active', 'host_CPU_cluster_percent', 'Host CPU cluster percent (%).', 'Percentage'),
+    MetricSpec('cluster_freq', 'host_CPU_cluster_clock', 'Host CPU cluster clock (MHZ).', 'MHz'),
+)
+CORE_METRICS: Tuple[MetricSpec, ...] = (
+    MetricSpec('core_active', 'host_CPU_core_percent', 'Host CPU core percent (%).', 'Percentage'),
+    MetricSpec('core_freq', 'host_CPU_core_clock', 'Host CPU core clock (MHZ).', 'MHz'),
+)
+CLUSTER_LABELS = ['hostname', 'cluster', 'type']
+CORE_LABELS = ['hostname', 'cluster', 'core', 'type']
+
+# Top processes of the ``tasks`` sampler, fields of ``tasks.TaskStats``.
+TASK_METRICS: Tuple[MetricSpec, ...] = (
+    MetricSpec('cpu_ms_per_s', 'host_task_cpu_time', 'Host task CPU time (ms/s).', 'ms_per_s'),
+    MetricSpec('energy_impact_per_s', 'host_task_energy_impact', 'Host task energy impact (per second).', 'per_s'),
+    MetricSpec('wakeups_per_s', 'host_task_wakeups', 'Host task interrupt and idle wakeups (per second).', 'per_s'),
+)
+TASK_LABELS = ['hostname', 'pid', 'name']
+
+
+class CpuTopology(NamedTuple):
+    """Label values for every cluster and core of one detected CPU layout."""
+
+    key: Tuple[Tuple[str, Tuple[int, ...]], ...]
+    cluster_labels: Tuple[Sequence[str], ...]
+    core_labels: Tuple[Sequence[str], ...]
+
+
+class CpuSample(NamedTuple):
+    """Per-cluster and per-core values, aligned with ``topology``'s labels."""
+
+    topology: CpuTopology
+    cluster_active: List[float]
+    cluster_freq: List[float]
+    core_active: List[float]
+    core_freq: List[float]
+
+
+class Snapshot(NamedTuple):
+    """Immutable set of metric values published for one sample."""
+
+    values: Mapping[str, float]
+    timestamp: float
+    version: int
+    cpu: CpuSample | None = None
+    # ``{key: (min, max, mean, last)}`` for ``WINDOW_KEYS``
+    window: Mapping[str, WindowStats] | None = None
+    # ``{key: {window_seconds: QuantileSummary}}`` for ``QUANTILE_KEYS``
+    quantiles: Mapping[str, Mapping[float, QuantileSummary]] | None = None
+    # top processes plus ``other``, see ``tasks.TaskAggregator``
+    tasks: Tuple[TaskStats, ...] | None = None
+
+
+EMPTY_SNAPSHOT = Snapshot(MappingProxyType({}), 0.0, 0)
+
+
+class SnapshotCollector(Collector):
+    """Render the exporter's metrics from the latest published :class:`Snapshot`.
+
+    The sampling thread builds a complete snapshot and swaps it in with a
+    single reference assignment, and each scrape reads that reference once,
+    so a scrape never sees values from two different samples.
+    """
+
+    def __init__(
+        self,
+        hostname: str,
+        metrics: Iterable[MetricSpec] = HOST_METRICS,
+        quantiles: Sequence[float] = (),
+    ) -> None:
+        self.hostname = hostname
+        self.metrics = tuple(metrics)
+        self.quantile_labels = tuple(format(q, 'g') for q in quantiles)
+        self.snapshot = EMPTY_SNAPSHOT
+        self.topologies: Dict[tuple, CpuTopology] = {}
+
+    def cpu_sample(self, cpu: CpuReading) -> CpuSample:
+        """Build a :class:`CpuSample` from ``parse_cpu_metrics(...)['cpu']``.
+
+        Label values are created the first time a layout is seen and reused
+        for every later sample with the same clusters and cores.
+        """
+        key = cpu.layout.key
+        topology = self.topologies.get(key)
+        if topology is None:
+            topology = self.topologies[key] = self.make_topology(key)
+        return CpuSample(topology, cpu.cluster_active, cpu.cluster_freq, cpu.core_active, cpu.core_freq)
+
+    def make_topology(self, key: Tuple[Tuple[str, Tuple[int, ...]], ...]) -> CpuTopology:
+        cluster_labels = []
+        core_labels = []
+        for name, cores in key:
+            core_type = name[0]
+            cluster_labels.append((self.hostname, name, core_type))
+            for core in cores:
+                core_labels.append((self.hostname, name, str(core), core_type))
+        return CpuTopology(key, tuple(cluster_labels), tuple(core_labels))
+
+    def update(
+        self,
+        values: Mapping[str, float],
+        timestamp: float | None = None,
+        cpu: CpuSample | None = None,
+        window: Mapping[str, WindowStats] | None = None,
+        quantiles: Mapping[str, Mapping[float, QuantileSummary]] | None = None,
+        tasks: Tuple[TaskStats, ...] | None = None,
+    ) -> Snapshot:
+        """Publish ``values`` as the new snapshot. ``values`` must not be mutated afterwards."""
+        snapshot = Snapshot(
+            MappingProxyType(values),
+            time.time() if timestamp is None else timestamp,
+            self.snapshot.version + 1,
+            cpu,
+            window,
+            quantiles,
+            tasks,
+        )
+        self.snapshot = snapshot
+        return snapshot
+
+    def collect_quantiles(self, quantiles: Mapping[str, Mapping[float, QuantileSummary]]) -> Iterator[Metric]:
+        for spec in QUANTILE_METRICS:
+            family = Metric(spec.name, spec.documentation, 'summary', spec.unit)
+            for window, summary in quantiles.get(spec.key, {}).items():
+                window_label = format(window, 'g')
+                for quantile_label, value in zip(self.quantile_labels, summary.quantiles):
+                    family.add_sample(
+                        family.name,
+                        {'hostname': self.hostname, 'window': window_label, 'quantile': quantile_label},
+                        value,
+                    )
+                labels = {'hostname': self.hostname, 'window': window_label}
+                family.add_sample(family.name + '_count', labels, summary.count)
+                family.add_sample(family.name + '_sum', labels, summary.sum)
+            yield family
+
+    def describe(self) -> Iterator[GaugeMetricFamily]:
+        for spec in self.metrics:
+            yield GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=['hostname'])
+        for spec in WINDOW_METRICS:
+            yield GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=WINDOW_LABELS)
+        for spec in QUANTILE_METRICS:
+            yield Metric(spec.name, spec.documentation, 'summary', spec.unit)
+        for spec in CLUSTER_METRICS:
+            yield GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=CLUSTER_LABELS)
+        for spec in CORE_METRICS:
+            yield GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=CORE_LABELS)
+        for spec in TASK_METRICS:
+            yield GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=TASK_LABELS)
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        snapshot = self.snapshot
+        values = snapshot.values
+        labels = [self.hostname]
+        for spec in self.metrics:
+            family = GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=['hostname'])
+            value = values.get(spec.key)
+            if value is not None:
+                family.add_metric(labels, value)
+            yield family
+
+        window = snapshot.window
+        if window is not None:
+            for spec in WINDOW_METRICS:
+                family = GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=WINDOW_LABELS)
+                stats = window.get(spec.key)
+                if stats is not None:
+                    for stat, value in zip(STATS, stats):
+                        family.add_metric([self.hostname, stat], value)
+                yield family
+
+        if snapshot.quantiles is not None:
+            yield from self.collect_quantiles(snapshot.quantiles)
+
+        cpu = snapshot.cpu
+        for specs, labelnames, label_values in (
+            (CLUSTER_METRICS, CLUSTER_LABELS, cpu and cpu.topology.cluster_labels),
+            (CORE_METRICS, CORE_LABELS, cpu and cpu.topology.core_labels),
+        ):
+            for spec in specs:
+                family = GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=labelnames)
+                if cpu is not None:
+                    for label_value, value in zip(label_values, getattr(cpu, spec.key)):
+                        family.add_metric(label_value, value)
+                yield family
+
+        tasks = snapshot.tasks
+        if tasks is not None:
+            task_labels = [
+                [self.hostname, '' if task.pid is None else str(task.pid), task.name]
+                for task in tasks
+            ]
+            for spec in TASK_METRICS:
+                family = GaugeMetricFamily(spec.name, spec.documentation, unit=spec.unit, labels=TASK_LABELS)
+                for labels, task in zip(task_labels, tasks):
+                    family.add_metric(labels, getattr(task, spec.key))
+                yield family
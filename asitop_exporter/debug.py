@@ -0,0 +1,281 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""On-demand profiling of a running exporter over HTTP (``--debug_port``).
+
+Nothing here runs until a request asks for it: the stack sampler is a
+thread that only exists for the duration of a profile, cProfile is only
+enabled around the sampling thread's work while a session is open, and
+tracemalloc is off until ``/debug/tracemalloc/start``.
+"""
+
+from __future__ import annotations
+
+import collections
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+from typing import Callable, Dict, List, Mapping, Tuple
+from urllib.parse import parse_qs
+
+from asitop_exporter.server import Response, WSGIApp, text_response
+
+
+MAX_SECONDS = 300
+MAX_SNAPSHOTS = 8
+SORT_KEYS = tuple(key.value for key in pstats.SortKey)
+
+INDEX = """asitop-exporter debug endpoints
+
+/debug/profile?seconds=N[&mode=sample|cprofile][&interval=MS][&sort=KEY][&limit=N]
+    sample (default): sample the stacks of all threads every MS (default 5)
+    milliseconds for N seconds; returns collapsed stacks for flamegraph.pl.
+    cprofile: run cProfile around the sampling thread's work for N seconds;
+    returns the top N (default 50) pstats lines sorted by KEY, one of
+    calls, cumulative (default), filename, line, name, nfl, pcalls,
+    stdname or time.
+/debug/threads
+    current stack of every thread.
+/debug/tracemalloc/start[?frames=N]
+/debug/tracemalloc/snapshot[?limit=N]
+    take a snapshot and list the top allocations by line.
+/debug/tracemalloc/diff?from=ID[&to=ID][&limit=N]
+    compare two snapshots (to: a new snapshot by default).
+/debug/tracemalloc/stop
+"""
+
+
+class ProfileGate:
+    """Let a profiling request run cProfile inside another thread.
+
+    The profiled thread routes its work through :meth:`call`. While no
+    session is open that costs one attribute read; while one is open the
+    call runs with the session's profiler enabled in that thread.
+    """
+
+    def __init__(self) -> None:
+        self.profile = None
+        self.busy = False
+        self.condition = threading.Condition()
+        self.session = threading.Lock()
+
+    def call(self, func: Callable[[], object]) -> object:
+        if self.profile is None:
+            return func()
+        with self.condition:
+            profile = self.profile
+            if profile is None:
+                return func()
+            self.busy = True
+        profile.enable()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def run(self, seconds: float, timeout: float) -> cProfile.Profile | None:
+        """Profile for ``seconds``; ``None`` if another session is running."""
+        if not self.session.acquire(blocking=False):
+            return None
+        try:
+            profile = cProfile.Profile()
+            with self.condition:
+                self.profile = profile
+            time.sleep(seconds)
+            with self.condition:
+                self.profile = None
+                # Let a call that is still running finish with the profiler.
+                self.condition.wait_for(lambda: not self.busy, timeout=timeout)
+            return profile
+        finally:
+            self.session.release()
+
+
+def sample_stacks(seconds: float, interval: float) -> Tuple[Dict[str, int], int]:
+    """Sample the stacks of all other threads; return collapsed stack counts."""
+    counts: Dict[str, int] = collections.Counter()
+    me = threading.get_ident()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+
+def format_threads() -> str:
+    names = {thread.ident: thread for thread in threading.enumerate()}
+    out = io.StringIO()
+    for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+        thread = names.get(ident)
+        name = thread.name if thread is not None else '?'
+        daemon = ' daemon' if thread is not None and thread.daemon else ''
+        out.write(f'Thread {name} ({ident}){daemon}:\n')
+        out.write(''.join(traceback.format_stack(frame)))
+        out.write('\n')
+    return out.getvalue()
+
+
+def format_statistics(statistics: List, limit: int) -> str:
+    total = sum(stat.size for stat in statistics)
+    lines = [f'total {total / 1024:.1f} KiB in {len(statistics)} lines']
+    lines.extend(str(stat) for stat in statistics[:limit])
+    return '\n'.join(lines) + '\n'
+
+
+class DebugApp(WSGIApp):
+    """Profiling, tracemalloc and thread dump endpoints."""
+
+    def __init__(self, gate: ProfileGate | None = None, interval: float = 1.0) -> None:
+        self.gate = gate
+        # A sampling-thread call can take up to an interval to finish.
+        self.interval = interval
+        self.snapshots: Dict[int, tracemalloc.Snapshot] = {}
+        self.next_snapshot = 1
+        self.lock = threading.Lock()
+        self.routes: Dict[str, Callable[[Mapping[str, List[str]]], Response]] = {
+            '/debug/': self.index,
+            '/debug/profile': self.profile,
+            '/debug/threads': self.threads,
+            '/debug/tracemalloc/start': self.tracemalloc_start,
+            '/debug/tracemalloc/snapshot': self.tracemalloc_snapshot,
+            '/debug/tracemalloc/diff': self.tracemalloc_diff,
+            '/debug/tracemalloc/stop': self.tracemalloc_stop,
+        }
+
+    def handle(self, method: str, path: str, query_string: str, headers: Mapping[str, str]) -> Response:
+        route = self.routes.get('/debug/' if path in ('/', '/debug') else path)
+        if route is None:
+            return text_response('404 Not Found', 'Not Found\n')
+        if method not in ('GET', 'HEAD'):
+            return text_response('405 Method Not Allowed', 'Method Not Allowed\n')
+        try:
+            return route(parse_qs(query_string))
+        except ValueError as ex:
+            return text_response('400 Bad Request', f'{ex}\n')
+
+    def index(self, params: Mapping[str, List[str]]) -> Response:
+        return text_response('200 OK', INDEX)
+
+    def profile(self, params: Mapping[str, List[str]]) -> Response:
+        seconds = float(params.get('seconds', ['10'])[0])
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError(f'seconds must be in (0, {MAX_SECONDS}]')
+        mode = params.get('mode', ['sample'])[0]
+        if mode == 'sample':
+            interval = float(params.get('interval', ['5'])[0]) / 1000
+            if interval <= 0:
+                raise ValueError('interval must be positive')
+            counts, samples = sample_stacks(seconds, interval)
+            lines = [f'{stack} {count}' for stack, count in sorted(counts.items())]
+            return text_response('200 OK', f'# {samples} samples\n' + '\n'.join(lines) + '\n')
+        if mode != 'cprofile':
+            raise ValueError('mode must be sample or cprofile')
+        # Checked before profiling, not after the client waited for it.
+        sort = params.get('sort', ['cumulative'])[0]
+        if sort not in SORT_KEYS:
+            raise ValueError(f'sort must be one of {", ".join(SORT_KEYS)}')
+        limit = int(params.get('limit', ['50'])[0])
+        if self.gate is None:
+            return text_response('404 Not Found', 'cProfile sessions are not available.\n')
+        profile = self.gate.run(seconds, timeout=self.interval + 5)
+        if profile is None:
+            return text_response('409 Conflict', 'Another cProfile session is running.\n')
+        out = io.StringIO()
+        try:
+            stats = pstats.Stats(profile, stream=out)
+        except TypeError:
+            # Nothing was profiled: the sampling thread made no call in time.
+            return text_response('200 OK', 'No calls were profiled, try more seconds.\n')
+        stats.sort_stats(sort)
+        stats.print_stats(limit)
+        return text_response('200 OK', out.getvalue())
+
+    def threads(self, params: Mapping[str, List[str]]) -> Response:
+        return text_response('200 OK', format_threads())
+
+    def tracemalloc_start(self, params: Mapping[str, List[str]]) -> Response:
+        frames = int(params.get('frames', ['1'])[0])
+        if tracemalloc.is_tracing():
+            return text_response('200 OK', 'tracemalloc is already tracing.\n')
+        tracemalloc.start(frames)
+        return text_response('200 OK', f'tracemalloc started with {frames} frames.\n')
+
+    def tracemalloc_snapshot(self, params: Mapping[str, List[str]]) -> Response:
+        snapshot_id, snapshot = self.take_snapshot()
+        if snapshot is None:
+            return text_response('409 Conflict', 'tracemalloc is not tracing, start it first.\n')
+        limit = int(params.get('limit', ['30'])[0])
+        text = format_statistics(snapshot.statistics('lineno'), limit)
+        return text_response('200 OK', f'snapshot {snapshot_id}\n{text}')
+
+    def tracemalloc_diff(self, params: Mapping[str, List[str]]) -> Response:
+        limit = int(params.get('limit', ['30'])[0])
+        with self.lock:
+            old = self.snapshots.get(int(params.get('from', ['0'])[0]))
+        if old is None:
+            raise ValueError(f'unknown snapshot, available: {sorted(self.snapshots)}')
+        if 'to' in params:
+            with self.lock:
+                new_id = int(params['to'][0])
+                new = self.snapshots.get(new_id)
+            if new is None:
+                raise ValueError(f'unknown snapshot, available: {sorted(self.snapshots)}')
+        else:
+            new_id, new = self.take_snapshot()
+            if new is None:
+                return text_response('409 Conflict', 'tracemalloc is not tracing, start it first.\n')
+        text = format_statistics(new.compare_to(old, 'lineno'), limit)
+        return text_response('200 OK', f'snapshot {new_id}\n{text}')
+
+    def tracemalloc_stop(self, params: Mapping[str, List[str]]) -> Response:
+        tracemalloc.stop()
+        with self.lock:
+            self.snapshots.clear()
+        return text_response('200 OK', 'tracemalloc stopped, snapshots dropped.\n')
+
+    def take_snapshot(self) -> Tuple[int, tracemalloc.Snapshot | None]:
+        if not tracemalloc.is_tracing():
+            return 0, None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        with self.lock:
+            snapshot_id = self.next_snapshot
+            self.next_snapshot += 1
+            self.snapshots[snapshot_id] = snapshot
+            while len(self.snapshots) > MAX_SNAPSHOTS:
+                del self.snapshots[min(self.snapshots)]
+        return snapshot_id, snapshot
@@ -0,0 +1,305 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Selective decoder for ``powermetrics`` plist frames."""
+
+from __future__ import annotations
+
+import binascii
+import datetime
+import html
+import re
+from typing import Any, Dict, Iterable, List, Mapping, Tuple
+from xml.parsers.expat import ParserCreate
+
+
+# Top-level keys read by ``parse_cpu_metrics``, ``parse_gpu_metrics``,
+# ``parse_thermal_pressure`` and the exporter itself.
+BASE_KEYS = frozenset({'timestamp', 'elapsed_ns', 'thermal_pressure', 'processor', 'gpu'})
+# Fields of each ``tasks`` entry read by ``parse_tasks``.
+TASK_FIELDS = frozenset({
+    'pid',
+    'name',
+    'cputime_ms_per_s',
+    'energy_impact_per_s',
+    'intr_wakeups_per_s',
+    'idle_wakeups_per_s',
+})
+
+_ARRAY_TAG = re.compile(rb'<(/?)array(/?)>')
+_DICT_TAG = re.compile(rb'<(/?)dict(/?)>')
+_VALUE_START = re.compile(rb'\s*<array(/?)>')
+
+
+class SelectivePlistDecoder:
+    """Decode only the wanted top-level keys of an XML plist frame.
+
+    The frame is tokenized with expat like :func:`plistlib.loads`, but the
+    value of every top-level key outside ``keys`` is skipped without building
+    any Python objects for it. Kept values have the same types and shapes as
+    :func:`plistlib.loads` would produce.
+
+    ``records`` maps top-level keys whose value is an array of dicts, such as
+    ``tasks`` with one dict per process, to the scalar fields to keep from
+    each dict. Those arrays are cut out of the frame and scanned with one
+    regular expression instead of expat, which keeps frames with thousands
+    of processes cheap; each dict decodes to only the listed fields. A
+    record key whose value is not an array is decoded with expat instead.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable[str] = BASE_KEYS,
+        records: Mapping[str, Iterable[str]] | None = None,
+    ) -> None:
+        self.keys = frozenset(keys)
+        self.records = {key: _RecordScanner(fields) for key, fields in (records or {}).items()}
+
+    def loads(self, data: bytes) -> Dict[str, Any]:
+        arrays = {}
+        fallback = {}
+        for key, scanner in self.records.items():
+            try:
+                data, array = _cut_array(data, key)
+            except ValueError:
+                fallback[key] = scanner
+                continue
+            if array is not None:
+                arrays[key] = scanner.scan(array)
+        result = _FrameParser(self.keys | fallback.keys()).parse(data)
+        for key, scanner in fallback.items():
+            if key in result:
+                result[key] = scanner.select(result[key])
+        result.update(arrays)
+        return result
+
+
+def _top_level_key(data: bytes, key: str) -> int:
+    """Return the offset of ``<key>key</key>`` in the root dict, or -1."""
+    tag = b'<key>%s</key>' % key.encode('utf-8')
+    depth = 0
+    position = 0
+    start = data.find(tag)
+    while start >= 0:
+        for match in _DICT_TAG.finditer(data, position, start):
+            if match.group(2):
+                continue
+            depth += -1 if match.group(1) else 1
+        if depth == 1:
+            return start
+        position = start
+        start = data.find(tag, start + len(tag))
+    return -1
+
+
+def _cut_array(data: bytes, key: str) -> Tuple[bytes, bytes | None]:
+    """Remove ``<key>key</key><array>...</array>`` from a frame, returning both parts.
+
+    Returns ``None`` as the array if the root dict has no such key. Raises
+    ``ValueError`` if its value is not an array or is not closed.
+    """
+    start = _top_level_key(data, key)
+    if start < 0:
+        return data, None
+    value = _VALUE_START.match(data, start + len(key) + len('<key></key>'))
+    if value is None:
+        raise ValueError(f'{key} is not an array')
+    if value.group(1):
+        # <array/>: no records.
+        return data[:start] + data[value.end():], b''
+    depth = 0
+    for match in _ARRAY_TAG.finditer(data, value.start()):
+        if match.group(2):
+            continue
+        if not match.group(1):
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return data[:start] + data[match.end():], data[start:match.end()]
+    raise ValueError(f'{key} array is not closed')
+
+
+class _RecordScanner:
+    """Decode selected scalar fields of the top-level dicts in a plist array."""
+
+    def __init__(self, fields: Iterable[str]) -> None:
+        self.fields = frozenset(fields)
+        names = b'|'.join(re.escape(field.encode('utf-8')) for field in sorted(fields))
+        self.pattern = re.compile(
+            rb'<(/?)dict>|<key>(' + names + rb')</key>\s*<(integer|real|string|true|false)(?:/>|>([^<]*)</\3>)',
+        )
+
+    def scan(self, array: bytes) -> List[Dict[str, Any]]:
+        records = []
+        record = None
+        depth = 0
+        for closing, key, kind, raw in self.pattern.findall(array):
+            if not key:
+                # <dict> or </dict>; only fields of the outermost dicts are kept.
+                if closing:
+                    depth -= 1
+                else:
+                    depth += 1
+                    if depth == 1:
+                        record = {}
+                        records.append(record)
+                continue
+            if depth != 1:
+                continue
+            record[key.decode('utf-8')] = _convert(kind, raw)
+        return records
+
+    def select(self, value: Any) -> List[Dict[str, Any]]:
+        """Reduce an expat-decoded value to the same records :meth:`scan` would return."""
+        if not isinstance(value, list):
+            return []
+        return [
+            {field: item[field] for field in self.fields if field in item}
+            for item in value
+            if isinstance(item, dict)
+        ]
+
+
+def _convert(kind: bytes, raw: bytes) -> Any:
+    if kind == b'integer':
+        return int(raw, 16) if raw.startswith((b'0x', b'0X')) else int(raw)
+    if kind == b'real':
+        return float(raw)
+    if kind == b'string':
+        text = raw.decode('utf-8')
+        return html.unescape(text) if '&' in text else text
+    return kind == b'true'
+
+
+class _FrameParser:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, keys: frozenset) -> None:
+        self.keys = keys
+        self.stack = []
+        self.current_key = None
+        self.root = None
+        self.data = []
+        self.skip_next = False
+        self.skip_depth = 0
+        self.parser = ParserCreate()
+        self.parser.buffer_text = True
+        self._keep_handlers()
+
+    def parse(self, data: bytes) -> Dict[str, Any]:
+        self.parser.Parse(data, True)
+        return self.root if self.root is not None else {}
+
+    # Handlers ---------------------------------------------------------------
+
+    def _keep_handlers(self) -> None:
+        self.parser.StartElementHandler = self.handle_begin_element
+        self.parser.EndElementHandler = self.handle_end_element
+        self.parser.CharacterDataHandler = self.handle_data
+
+    def _skip_handlers(self) -> None:
+        self.parser.StartElementHandler = self.handle_skip_begin
+        self.parser.EndElementHandler = self.handle_skip_end
+        self.parser.CharacterDataHandler = None
+
+    def handle_skip_begin(self, element: str, attrs: dict) -> None:
+        self.skip_depth += 1
+
+    def handle_skip_end(self, element: str) -> None:
+        self.skip_depth -= 1
+        if self.skip_depth == 0:
+            self._keep_handlers()
+
+    def handle_begin_element(self, element: str, attrs: dict) -> None:
+        if self.skip_next:
+            self.skip_next = False
+            self.skip_depth = 1
+            self._skip_handlers()
+            return
+        self.data = []
+        handler = getattr(self, 'begin_' + element, None)
+        if handler is not None:
+            handler()
+
+    def handle_end_element(self, element: str) -> None:
+        handler = getattr(self, 'end_' + element, None)
+        if handler is not None:
+            handler()
+
+    def handle_data(self, data: str) -> None:
+        self.data.append(data)
+
+    # Values -----------------------------------------------------------------
+
+    def add_object(self, value: Any) -> None:
+        if self.current_key is not None:
+            self.stack[-1][self.current_key] = value
+            self.current_key = None
+        elif not self.stack:
+            self.root = value
+        else:
+            self.stack[-1].append(value)
+
+    def get_data(self) -> str:
+        data = ''.join(self.data)
+        self.data = []
+        return data
+
+    def begin_dict(self) -> None:
+        value = {}
+        self.add_object(value)
+        self.stack.append(value)
+
+    def end_dict(self) -> None:
+        self.stack.pop()
+
+    def end_key(self) -> None:
+        self.current_key = self.get_data()
+        if len(self.stack) == 1 and self.current_key not in self.keys:
+            self.current_key = None
+            self.skip_next = True
+
+    def begin_array(self) -> None:
+        value = []
+        self.add_object(value)
+        self.stack.append(value)
+
+    def end_array(self) -> None:
+        self.stack.pop()
+
+    def end_true(self) -> None:
+        self.add_object(True)
+
+    def end_false(self) -> None:
+        self.add_object(False)
+
+    def end_integer(self) -> None:
+        raw = self.get_data()
+        if raw.startswith(('0x', '0X')):
+            self.add_object(int(raw, 16))
+        else:
+            self.add_object(int(raw))
+
+    def end_real(self) -> None:
+        self.add_object(float(self.get_data()))
+
+    def end_string(self) -> None:
+        self.add_object(self.get_data())
+
+    def end_data(self) -> None:
+        self.add_object(binascii.a2b_base64(self.get_data().encode('utf-8')))
+
+    def end_date(self) -> None:
+        self.add_object(datetime.datetime.strptime(self.get_data(), '%Y-%m-%dT%H:%M:%SZ'))
@@ -19,22 +19,128 @@
 from __future__ import annotations
 
 import math
+import subprocess
+import sys
 import time
+from typing import Mapping, Sequence, Tuple
 from uuid import uuid4
-from typing import List
-from requests import post
-import json
-import copy
 from collections import deque
-from prometheus_client import REGISTRY, CollectorRegistry, Gauge, Info
-from asitop_exporter.utils import get_ip_address,get_ram_metrics_dict,run_powermetrics_process
-from asitop_exporter.parsers import parse_powermetrics
+from prometheus_client import REGISTRY, CollectorRegistry, Info
+from asitop_exporter.adaptive import AdaptiveRate
+from asitop_exporter.aggregate import WindowAggregator
+from asitop_exporter.collector import (
+    BANDWIDTH_METRICS,
+    HOST_METRICS,
+    QUANTILE_KEYS,
+    WINDOW_KEYS,
+    SnapshotCollector,
+)
+from asitop_exporter.history import HistoryStore
+from asitop_exporter.payload import PayloadEncoder
+from asitop_exporter.pusher import PushGatewayPusher
+from asitop_exporter.selfmetrics import SelfMetrics
+from asitop_exporter.utils import cprint,get_ip_address,get_ram_metrics_dict,run_powermetrics_process
+from asitop_exporter.debug import ProfileGate
+from asitop_exporter.decoder import BASE_KEYS, TASK_FIELDS, SelectivePlistDecoder
+from asitop_exporter.parsers import DEFAULT_DECODER, try_parse_frame, unix_time
+from asitop_exporter.reader import PowermetricsFileReader, PowermetricsStreamReader
+from asitop_exporter.recorder import Recorder
+from asitop_exporter.sinks import (
+    HistorySink,
+    HttpJsonSink,
+    JsonLinesSink,
+    PrometheusSink,
+    Sample,
+    SinkPipeline,
+    StatsdSink,
+)
+from asitop_exporter.sketch import DEFAULT_QUANTILES, QuantileTracker
+from asitop_exporter.tasks import TaskAggregator
+
+# First delay between two restarts of a powermetrics that keeps exiting,
+# doubled on every restart up to ``max(interval, MAX_RESTART_DELAY)``.
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+
+# Bandwidth metric key -> ``parse_bandwidth_metrics`` counters it sums.
+BANDWIDTH_VALUES = (
+    ('host_ecpu_bandwidth', ('ECPU DCS RD', 'ECPU DCS WR')),
+    ('host_pcpu_bandwidth', ('PCPU DCS RD', 'PCPU DCS WR')),
+    ('host_gpu_bandwidth', ('GFX DCS RD', 'GFX DCS WR')),
+    ('host_media_bandwidth', ('MEDIA DCS',)),
+    ('host_dram_read_bandwidth', ('DCS RD',)),
+    ('host_dram_write_bandwidth', ('DCS WR',)),
+    ('host_dram_bandwidth', ('DCS RD', 'DCS WR')),
+)
+
 
 def get_avg(inlist):
     avg = sum(inlist) / len(inlist)
     return avg
 
 
+class PowerHistory:
+    """Peak and recent average CPU and GPU power, carried across samples."""
+
+    def __init__(self) -> None:
+        self.cpu_peak_power = 0
+        self.gpu_peak_power = 0
+        self.avg_cpu_power_list = deque([], maxlen = 5)
+        self.avg_gpu_power_list = deque([], maxlen = 5)
+
+
+def derive_sample(reading, power: PowerHistory, interval: float) -> dict:
+    """Convert one parsed powermetrics frame into per-sample metric values.
+
+    ``power`` is updated with the frame's CPU and GPU power. ``interval`` is
+    the sampling period, used for frames without ``elapsed_ns``.
+    """
+    cpu_metrics_dict, gpu_metrics_dict, thermal_pressure, bandwidth_metrics, timestamp = reading
+    # Energies are accumulated over the frame, convert with its real duration.
+    elapsed = cpu_metrics_dict.get("elapsed_s") or interval
+
+    ane_max_power = 8.0
+    ane_power_W = cpu_metrics_dict["ane_W"] / elapsed
+    ane_util_percent = int(ane_power_W / ane_max_power * 100)
+
+    cpu_power_W = cpu_metrics_dict["cpu_W"] / elapsed
+    if cpu_power_W > power.cpu_peak_power:
+        power.cpu_peak_power = cpu_power_W
+    power.avg_cpu_power_list.append(cpu_power_W)
+    avg_cpu_power = get_avg(power.avg_cpu_power_list)
+
+    gpu_power_W = cpu_metrics_dict["gpu_W"] / elapsed
+    if gpu_power_W > power.gpu_peak_power:
+        power.gpu_peak_power = gpu_power_W
+    power.avg_gpu_power_list.append(gpu_power_W)
+    avg_gpu_power = get_avg(power.avg_gpu_power_list)
+
+    values = {
+        "host_ecpu_percent": cpu_metrics_dict["E-Cluster_active"],
+        "host_ecpu_clock": cpu_metrics_dict["E-Cluster_freq_Mhz"],
+        "host_pcpu_percent": cpu_metrics_dict["P-Cluster_active"],
+        "host_pcpu_clock": cpu_metrics_dict["P-Cluster_freq_Mhz"],
+
+        "host_gpu_percent": gpu_metrics_dict["active"],
+        "host_gpu_clock": gpu_metrics_dict["freq_MHz"],
+        "host_ane_percent": ane_util_percent,
+        "host_ane_power": ane_power_W,
+
+        "host_cpu_power": cpu_power_W,
+        "host_cpu_peak_power": power.cpu_peak_power,
+        "host_cpu_avg_power": avg_cpu_power,
+
+        "host_gpu_power": gpu_power_W,
+        "host_gpu_peak_power": power.gpu_peak_power,
+        "host_gpu_avg_power": avg_gpu_power,
+    }
+    if bandwidth_metrics is not None:
+        # Counters are bytes over the frame, like the energies.
+        for key, counters in BANDWIDTH_VALUES:
+            values[key] = sum([bandwidth_metrics[counter] for counter in counters]) / elapsed
+    return values
+
+
 class PrometheusExporter:  # pylint: disable=too-many-instance-attributes
     """Prometheus exporter built on top of ``asitop``."""
 
@@ -46,7 +152,36 @@ class PrometheusExporter:  # pylint: disable=too-many-instance-attributes
         interval: float = 1.0,
         timecode: str | None = None,
         post_url: str | None = None,
-        alive_time: int  = 60
+        alive_time: int  = 60,
+        stream: bool = False,
+        post_batch_size: int = 1,
+        post_compress: bool = False,
+        post_timeout: float = 5.0,
+        post_queue_size: int = 64,
+        post_retries: int = 3,
+        post_format: str = 'records',
+        sample_interval: float | None = None,
+        quantile_windows: Sequence[float] = (),
+        quantiles: Sequence[float] = DEFAULT_QUANTILES,
+        history_size: int = 0,
+        history_path: str | None = None,
+        push_url: str | None = None,
+        push_job: str = 'asitop_exporter',
+        push_interval: float | None = None,
+        push_compress: bool = False,
+        statsd_address: str | None = None,
+        jsonl_path: str | None = None,
+        sink_queue_size: int = 64,
+        record_dir: str | None = None,
+        record_max_bytes: int = 1 << 30,
+        record_segment_size: int = 64 << 20,
+        record_segment_age: float = 3600.0,
+        top_tasks: int = 0,
+        bandwidth: bool = False,
+        adaptive_interval: Tuple[float, float] | None = None,
+        self_metrics: bool = True,
+        profile_gate: ProfileGate | None = None,
+        soc_info: Mapping[str, object] | None = None,
     ) -> None:        
         self.hostname = hostname or get_ip_address()
         self.registry = registry
@@ -54,8 +189,63 @@ class PrometheusExporter:  # pylint: disable=too-many-instance-attributes
         self.timecode = timecode
         self.post_url = post_url
         self.alive_time = alive_time
+        self.stream = stream
+        self.recorder = None
+        if record_dir is not None:
+            # Raw frames go to the compressed recording instead of a /tmp file.
+            self.stream = True
+            self.recorder = Recorder(
+                record_dir,
+                max_bytes=record_max_bytes,
+                segment_size=record_segment_size,
+                segment_age=record_segment_age,
+            )
+        self.adaptive = None
+        if adaptive_interval is not None:
+            # Rate changes start a second powermetrics next to the first,
+            # which needs the pipe; the file path is shared.
+            self.stream = True
+            self.adaptive = AdaptiveRate(*adaptive_interval, registry=registry)
+            sample_interval = self.adaptive.period
+        # powermetrics sampling period when it is finer than ``interval``
+        self.sample_interval = sample_interval
+        self.window = None
+        if sample_interval is not None:
+            shortest = self.adaptive.min_period if self.adaptive is not None else sample_interval
+            self.window = WindowAggregator(WINDOW_KEYS, capacity=2 * math.ceil(interval / shortest))
+        self.history = None
+        if history_size > 0:
+            self.history = HistoryStore([spec.key for spec in HOST_METRICS], history_size, history_path)
+        self.quantile_tracker = None
+        if quantile_windows:
+            self.quantile_tracker = QuantileTracker(QUANTILE_KEYS, quantile_windows, quantiles)
+        self.decoder = DEFAULT_DECODER
+        self.bandwidth = bandwidth
+        self.tasks = None
+        records = {}
+        if bandwidth:
+            records['bandwidth_counters'] = ('name', 'value')
+        if top_tasks > 0:
+            # Only pid, name and the rates are pulled out of the tasks array.
+            records['tasks'] = TASK_FIELDS
+            self.tasks = TaskAggregator(top_tasks)
+        if records:
+            self.decoder = SelectivePlistDecoder(BASE_KEYS, records)
         self.powermetrics_process = None
-
+        self.reader = None
+        # (process, reader) started at a new sampling period, until its first frame
+        self.pending_powermetrics = None
+        self.last_frame_time = None
+        # Newest values and CPU reading ingested, published at the next boundary.
+        self.latest_values = None
+        self.latest_cpu = None
+        self.next_publish = None
+        # Restart backoff, reset by the first frame of a new child.
+        self.restart_delay = RESTART_DELAY
+        self.next_restart = 0.0
+        self.profile_gate = profile_gate
+        # Static fields of the post payload are encoded once here.
+        self.payload_encoder = PayloadEncoder(get_ip_address(), self.interval, fmt=post_format)
 
         self.info = Info(
             'asitop',
@@ -63,298 +253,328 @@ class PrometheusExporter:  # pylint: disable=too-many-instance-attributes
             labelnames=['hostname'],
             registry=self.registry,
         )
+        if soc_info is not None:
+            self.info.labels(self.hostname).info({
+                key: str(soc_info[key])
+                for key in ('name', 'core_count', 'e_core_count', 'p_core_count', 'gpu_core_count')
+            })
 
-
-        self.cpu_peak_power = 0
-        self.gpu_peak_power = 0
-        self.avg_cpu_power_list = deque([], maxlen = 5)
-        self.avg_gpu_power_list = deque([], maxlen = 5)
+        self.power = PowerHistory()
 
         self.metrics_dict = {}
-        # E-CPU
-        self.host_ecpu_percent = Gauge(
-            name='host_ECPU_percent',
-            documentation='Host E-CPU percent (%).',
-            unit='Percentage',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_ecpu_clock = Gauge(
-            name='host_ECPU_clock',
-            documentation='Host E-CPU clock (MHZ).',
-            unit='MHz',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-
-        # P-CPU
-        self.host_pcpu_percent = Gauge(
-            name='host_PCPU_percent',
-            documentation='Host P-CPU percent (%).',
-            unit='Percentage',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_pcpu_clock = Gauge(
-            name='host_PCPU_clock',
-            documentation='Host P-CPU clock (MHZ).',
-            unit='MHz',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-
-        # GPU
-        self.host_gpu_percent = Gauge(
-            name='host_GPU_percent',
-            documentation='Host GPU percent (%).',
-            unit='Percentage',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_gpu_clock = Gauge(
-            name='host_GPU_clock',
-            documentation='Host GPU clock (MHZ).',
-            unit='MHz',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-
-        # ANE
-        self.host_ane_percent = Gauge(
-            name='host_ANE_percent',
-            documentation='Host ANE percent (%).',
-            unit='Percentage',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_ane_power = Gauge(
-            name='host_ANE_power',
-            documentation='Host ANE power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-
-        self.host_ram_total = Gauge(
-            name='host_RAM_total',
-            documentation='Host RAM total (GB).',
-            unit='GB',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_ram_used = Gauge(
-            name='host_RAM_uesd',
-            documentation='Host RAM used (GB).',
-            unit='GB',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_ram_free = Gauge(
-            name='host_RAM_free',
-            documentation='Host RAM free (GB).',
-            unit='GB',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_swap_total = Gauge(
-            name='host_swap_total',
-            documentation='Host swap total (GB).',
-            unit='GB',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_swap_used = Gauge(
-            name='host_swap_uesd',
-            documentation='Host swap used (GB).',
-            unit='GB',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_swap_free = Gauge(
-            name='host_swap_free',
-            documentation='Host swap free (GB).',
-            unit='GB',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-
-        self.host_cpu_power = Gauge(
-            name='host_cpu_power',
-            documentation='Host cpu power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_cpu_peak_power = Gauge(
-            name='host_cpu_peak_power',
-            documentation='Host cpu peak power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_cpu_avg_power = Gauge(
-            name='host_cpu_avg_power',
-            documentation='Host cpu avg power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-
-        self.host_gpu_power = Gauge(
-            name='host_gpu_power',
-            documentation='Host gpu power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
-        )
-        self.host_gpu_peak_power = Gauge(
-            name='host_gpu_peak_power',
-            documentation='Host gpu peak power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
+        self.collector = SnapshotCollector(
+            self.hostname,
+            HOST_METRICS + BANDWIDTH_METRICS if bandwidth else HOST_METRICS,
+            quantiles=quantiles,
         )
-        self.host_gpu_avg_power = Gauge(
-            name='host_gpu_avg_power',
-            documentation='Host gpu avg power (W).',
-            unit='W',
-            labelnames=['hostname'],
-            registry=self.registry,
+        self.registry.register(self.collector)
+
+        self.self_metrics = None
+        if self_metrics:
+            self.self_metrics = SelfMetrics(
+                child=lambda: self.powermetrics_process,
+                frame_time=lambda: self.last_frame_time,
+                output_file=lambda: None if self.stream else '/tmp/asitop_exporter_powermetrics' + self.timecode,
+            )
+
+        # Every sample is fanned out to these; each queued sink has its own
+        # bounded queue and worker, so a slow output only loses its own data.
+        # Their write latency (e.g. of the posts) is a self metric.
+        self.sinks = SinkPipeline(
+            self.registry,
+            latency_registry=self.self_metrics.registry if self.self_metrics is not None else None,
         )
-    
-    def post_result(self):
-        uuid = str(uuid4())
-        timestamp = int(time.time() * 1000)
-        interval = int(self.interval)
-        #os.environ.get('APP_ID', 'agi_common')
-        metric_json = {
-            "cluster" : "jmlj-tonglu-productk8s",
-            "namespace": "ezagi",
-            "nodeip": get_ip_address(),
-            "endpoint": get_ip_address(),
-            "metric": "Throughput",
-            "value": 1.0,
-            "step": interval,
-            "counterType": "COUNTER",
-            "timestamp": timestamp,
-            "uuid": uuid,
-            "tags": {
-                "url": "",
-                "serviceName": "ezagi_algo_m2_iaas"
-            },
-            "monitorType": "iaas"
-        }
-        metric_json_list = []
-        for k, v in self.metrics_dict.items():
-            current_json = metric_json
-            current_json['tags']['url'] = k
-            current_json['value'] = v
-            metric_json_list.append(copy.deepcopy(current_json))
-
-        json_data = json.dumps(metric_json_list)
-        headers = {'Content-type': 'application/json'}
-        rsp = post(self.post_url, data=json_data, headers=headers)
+        if self.self_metrics is not None:
+            self.registry.register(self.self_metrics.registry)
+        self.sinks.add(PrometheusSink(self.collector))
+        if self.history is not None:
+            self.sinks.add(HistorySink(self.history))
+        if self.post_url is not None:
+            self.sinks.add(HttpJsonSink(
+                self.post_url,
+                self.payload_encoder,
+                queue_size=post_queue_size,
+                batch_size=post_batch_size,
+                linger=self.interval * post_batch_size,
+                compress=post_compress,
+                timeout=post_timeout,
+                retries=post_retries,
+            ))
+        if statsd_address is not None:
+            self.sinks.add(StatsdSink(statsd_address, self.hostname, queue_size=sink_queue_size))
+        if jsonl_path is not None:
+            self.sinks.add(JsonLinesSink(jsonl_path, self.hostname, queue_size=sink_queue_size))
+        self.sinks.start()
+
+        self.pusher = None
+        if push_url is not None:
+            self.pusher = PushGatewayPusher(
+                push_url,
+                self.registry,
+                job=push_job,
+                grouping_key={'instance': self.hostname},
+                interval=push_interval or self.interval,
+                version=lambda: self.collector.snapshot.version,
+                compress=push_compress,
+            ).start()
+
+    def encode_result(self) -> bytes:
+        """Serialise ``self.metrics_dict`` into the JSON body sent to ``post_url``."""
+        return b'[' + self.encode_payload() + b']'
+
+    def encode_payload(self) -> bytes:
+        return self.payload_encoder.encode(self.metrics_dict, int(time.time() * 1000), str(uuid4()))
 
     def get_reading(self):
-        ready = parse_powermetrics(timecode=self.timecode)
+        """Wait for and return the parsed frames received since the previous call.
+
+        Returns as soon as a complete frame has been written: both readers
+        are read without blocking, then waited on (the stream reader's pipe
+        thread or the file reader's watcher). Every second without a new
+        frame counts as a retry. Returns an empty list once powermetrics
+        has exited.
+        """
+        ready = self.read_readings()
         while not ready:
-            time.sleep(1)
-            ready = parse_powermetrics(timecode=self.timecode)
+            if self.stream and self.reader.closed:
+                # The pipe can reach EOF before the child is reaped; wait for
+                # it, so maintain_powermetrics sees it exited.
+                self.reap_powermetrics(timeout=1.0)
+                return []
+            if self.powermetrics_exited():
+                return []
+            if not self.reader.wait(1.0) and self.self_metrics is not None:
+                self.self_metrics.retries.inc()
+            ready = self.read_readings()
+        self.restart_delay = RESTART_DELAY
+        self.next_restart = 0.0
         return ready
 
+    def reap_powermetrics(self, timeout: float) -> None:
+        try:
+            self.powermetrics_process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            pass
+
+    def powermetrics_exited(self) -> bool:
+        return self.powermetrics_process is not None and self.powermetrics_process.poll() is not None
+
+    def read_readings(self):
+        parsed = self.parse_frames_from(self.reader, timeout=0 if self.stream else None)
+        if self.pending_powermetrics is not None:
+            process, reader = self.pending_powermetrics
+            fresh = [pair for pair in self.parse_frames_from(reader, timeout=0) if pair[1] is not None]
+            if fresh:
+                # The new child is producing; retire the old one only now,
+                # so switching the rate leaves no gap in the samples.
+                parsed += self.parse_frames_from(self.reader, timeout=0)
+                self.pending_powermetrics = None
+                self.stop_powermetrics(self.powermetrics_process, self.reader)
+                self.powermetrics_process, self.reader = process, reader
+                # Both children sampled the span since the new one's first
+                # frame; keep only the new child's frames for it.
+                first = fresh[0][1][4]
+                parsed = [pair for pair in parsed if pair[1] is not None and pair[1][4] < first]
+                parsed += fresh
+            elif process.poll() is not None:
+                self.pending_powermetrics = None
+                self.stop_powermetrics(process, reader)
+        if self.recorder is not None and parsed:
+            # Recorded once deduplicated, so an overlap is not recorded twice.
+            self.recorder.write([frame for frame, _ in parsed])
+        return [reading for _, reading in parsed if reading is not None]
+
+    def parse_frames_from(self, reader, timeout=None):
+        """Read ``reader``'s new frames (``timeout`` as for stream readers) and parse them.
+
+        Returns ``(frame, reading)`` pairs, ``reading`` is ``None`` for a
+        frame that fails to parse.
+        """
+        frames = reader.read_frames() if timeout is None else reader.read_frames(timeout=timeout)
+        if not frames:
+            return []
+        if self.self_metrics is None:
+            return [(frame, try_parse_frame(frame, self.decoder)) for frame in frames]
+        start = time.perf_counter()
+        parsed = [(frame, try_parse_frame(frame, self.decoder)) for frame in frames]
+        self.self_metrics.parse.observe(time.perf_counter() - start)
+        return parsed
+
     def collect(self) -> None:
+        # Frame arrival paces the loop: every new frame is ingested as soon as
+        # it has been written, and published at once or at the next boundary.
         while True:
-            current_time = int(time.time())
-            if(current_time - int(self.timecode) >= 60 * self.alive_time):
-                self.timecode = str(current_time)
-                self.terminate_powermetrics_process()
-                self.start_powermetrics_process()
-
-            next_update_time = time.monotonic() + self.interval
-            self.update_host()
-            time.sleep(max(0.0, next_update_time - time.monotonic()))
-
-    def update_host(self) -> None:
-        ready = self.get_reading()
-        last_timestamp = ready[-1]
-
-        if ready:
-            cpu_metrics_dict, gpu_metrics_dict, thermal_pressure, bandwidth_metrics, timestamp = ready
+            self.maintain_powermetrics()
+            self.run_update()
+
+    def maintain_powermetrics(self) -> None:
+        """Restart powermetrics if it exited, and rotate its output file every ``alive_time``."""
+        if self.powermetrics_exited():
+            self.restart_powermetrics()
+            return
+        # There is no output file to rotate in stream mode.
+        current_time = int(time.time())
+        if not self.stream and current_time - int(self.timecode) >= 60 * self.alive_time:
+            self.timecode = str(current_time)
+            self.terminate_powermetrics_process()
+            self.start_powermetrics_process()
+
+    def restart_powermetrics(self) -> None:
+        """Start powermetrics again, backing off while it keeps exiting before its first frame."""
+        delay = max(0.0, self.next_restart - time.monotonic())
+        cprint(
+            f'WARNING: powermetrics exited with code {self.powermetrics_process.returncode}, '
+            f'restarting in {delay:.1f} s.',
+            file=sys.stderr,
+        )
+        if delay > 0:
+            time.sleep(delay)
+        self.terminate_powermetrics_process()
+        if not self.stream:
+            # A new output file, as on rotation.
+            self.timecode = str(int(time.time()))
+        self.start_powermetrics_process()
+        self.next_restart = time.monotonic() + self.restart_delay
+        self.restart_delay = min(2 * self.restart_delay, max(self.interval, MAX_RESTART_DELAY))
+
+    def run_update(self) -> None:
+        if self.profile_gate is None:
+            self.sample_once()
+        else:
+            # --debug_port: cProfile sessions run around this call.
+            self.profile_gate.call(self.sample_once)
+
+    def derive_sample(self, reading) -> dict:
+        """Convert one parsed powermetrics frame into per-sample metric values."""
+        return derive_sample(reading, self.power, self.sample_interval or self.interval)
+
+    def sample_once(self) -> None:
+        """Ingest the next frames; publish them unless a window is still open.
+
+        Without ``sample_interval`` every frame is a sample and is published
+        as soon as it is read. With it, frames go into the window as they
+        arrive and the window is published once per ``interval``.
+        """
+        readings = self.get_reading()
+        if not readings:
+            return
+        start = time.perf_counter()
+        self.ingest(readings)
+        now = time.monotonic()
+        if self.next_publish is None:
+            self.next_publish = now + self.interval
+        if self.window is None or now >= self.next_publish:
+            self.next_publish += self.interval
+            if self.next_publish <= now:
+                # Fell behind (powermetrics stalled), do not publish a burst.
+                self.next_publish = now + self.interval
+            self.publish()
+        if self.self_metrics is not None:
+            self.self_metrics.update.observe(time.perf_counter() - start)
+
+    def ingest(self, readings) -> None:
+        """Feed parsed frames to the window, quantile, adaptive and task aggregators."""
+        self.last_frame_time = unix_time(readings[-1][4])
+        for reading in readings:
+            values = self.derive_sample(reading)
+            if self.window is not None:
+                self.window.add(values)
+            if self.quantile_tracker is not None:
+                self.quantile_tracker.add(values)
+            if self.adaptive is not None:
+                self.adaptive.observe(values)
+            if self.tasks is not None and "tasks" in reading[0]:
+                elapsed = reading[0].get("elapsed_s") or self.sample_interval or self.interval
+                self.tasks.add(reading[0]["tasks"], elapsed)
+        self.latest_values = values
+        self.latest_cpu = readings[-1][0]["cpu"]
+
+    def publish(self) -> None:
+        """Publish the newest sample, closing the window and the task interval."""
+        values = self.latest_values
+        window = None
+        if self.window is not None:
+            window = self.window.summary()
+            self.window.reset()
+
+        tasks = None
+        if self.tasks is not None:
+            tasks = self.tasks.top()
+            self.tasks.reset()
 
         ram_metrics_dict = get_ram_metrics_dict()
-        ane_max_power = 8.0
-        ane_util_percent = int(cpu_metrics_dict["ane_W"] / self.interval / ane_max_power * 100)
-
-        cpu_power_W = cpu_metrics_dict["cpu_W"] / self.interval
-        if cpu_power_W > self.cpu_peak_power:
-            self.cpu_peak_power = cpu_power_W
-        self.avg_cpu_power_list.append(cpu_power_W)
-        avg_cpu_power = get_avg(self.avg_cpu_power_list)
-
-        gpu_power_W = cpu_metrics_dict["gpu_W"] / self.interval
-        if gpu_power_W > self.gpu_peak_power:
-            self.gpu_peak_power = gpu_power_W
-        self.avg_gpu_power_list.append(gpu_power_W)
-        avg_gpu_power = get_avg(self.avg_gpu_power_list)
-
-        for gauge, value in (
-            (self.host_ecpu_percent, cpu_metrics_dict["E-Cluster_active"]),
-            (self.host_ecpu_clock, cpu_metrics_dict["E-Cluster_freq_Mhz"]),
-            (self.host_pcpu_percent, cpu_metrics_dict["P-Cluster_active"]),
-            (self.host_pcpu_clock, cpu_metrics_dict["P-Cluster_freq_Mhz"]),
-            (self.host_gpu_percent, gpu_metrics_dict["active"]),
-            (self.host_gpu_clock, gpu_metrics_dict["freq_MHz"]),
-            (self.host_ane_percent, ane_util_percent),
-            (self.host_ane_power, cpu_metrics_dict["ane_W"] / self.interval),
-
-            (self.host_ram_total, ram_metrics_dict["total_GB"]),
-            (self.host_ram_used, ram_metrics_dict["used_GB"]),
-            (self.host_ram_free, ram_metrics_dict["free_GB"] ),
-            (self.host_swap_total, ram_metrics_dict["swap_total_GB"]),
-            (self.host_swap_used, ram_metrics_dict["swap_used_GB"]),
-            (self.host_swap_free, ram_metrics_dict["swap_free_GB"]),
-
-            (self.host_cpu_power, cpu_power_W),
-            (self.host_cpu_peak_power, self.cpu_peak_power),
-            (self.host_cpu_avg_power, avg_cpu_power),
-
-            (self.host_gpu_power, gpu_power_W),
-            (self.host_gpu_peak_power, self.gpu_peak_power),
-            (self.host_gpu_avg_power, avg_gpu_power),
-        ):
-            gauge.labels(self.hostname).set(value)
-
-        self.metrics_dict["host_ecpu_percent"] = cpu_metrics_dict["E-Cluster_active"]
-        self.metrics_dict["host_ecpu_clock"] = cpu_metrics_dict["E-Cluster_freq_Mhz"]
-        self.metrics_dict["host_pcpu_percent"] = cpu_metrics_dict["P-Cluster_active"]
-        self.metrics_dict["host_pcpu_clock"] = cpu_metrics_dict["P-Cluster_freq_Mhz"]
-
-        self.metrics_dict["host_gpu_percent"] = gpu_metrics_dict["active"]
-        self.metrics_dict["host_gpu_clock"] = gpu_metrics_dict["freq_MHz"]
-        self.metrics_dict["host_ane_percent"] = ane_util_percent
-        self.metrics_dict["host_ane_power"] = cpu_metrics_dict["ane_W"] / self.interval
-        
-        self.metrics_dict["host_ram_total"] = ram_metrics_dict["total_GB"]
-        self.metrics_dict["host_ram_used"] =  ram_metrics_dict["used_GB"]
-        self.metrics_dict["host_ram_free"] = ram_metrics_dict["free_GB"]
-
-        self.metrics_dict["host_swap_total"] = ram_metrics_dict["swap_total_GB"]
-        self.metrics_dict["host_swap_used"] = ram_metrics_dict["swap_used_GB"]
-        self.metrics_dict["host_swap_free"] = ram_metrics_dict["swap_free_GB"]
-
-        self.metrics_dict["host_cpu_power"] = cpu_power_W
-        self.metrics_dict["host_cpu_peak_power"] = self.cpu_peak_power
-        self.metrics_dict["host_cpu_avg_power"] = avg_cpu_power
-
-        self.metrics_dict["host_gpu_power"] = gpu_power_W
-        self.metrics_dict["host_gpu_peak_power"] = self.gpu_peak_power
-        self.metrics_dict["host_gpu_avg_power"] = avg_gpu_power
-
-        if(self.post_url is not None):
-            self.post_result()
-
+        values.update({
+            "host_ram_total": ram_metrics_dict["total_GB"],
+            "host_ram_used": ram_metrics_dict["used_GB"],
+            "host_ram_free": ram_metrics_dict["free_GB"],
+
+            "host_swap_total": ram_metrics_dict["swap_total_GB"],
+            "host_swap_used": ram_metrics_dict["swap_used_GB"],
+            "host_swap_free": ram_metrics_dict["swap_free_GB"],
+        })
+        # Swap the whole sample in at once so scrapes never see a partial update.
+        self.metrics_dict = values
+        self.sinks.publish(Sample(
+            time.time(),
+            values,
+            cpu=self.collector.cpu_sample(self.latest_cpu),
+            window=window,
+            quantiles=self.quantile_tracker.summary() if self.quantile_tracker is not None else None,
+            tasks=tasks,
+        ))
+
+        if self.adaptive is not None:
+            period = self.adaptive.update()
+            if period is not None:
+                self.change_sample_interval(period)
+
+    def spawn_powermetrics(self):
+        """Start powermetrics at the current sampling period, return ``(process, reader)``."""
+        interval = self.sample_interval or self.interval
+        process = run_powermetrics_process(
+            self.timecode,
+            interval=int(interval * 1000),
+            output_file=not self.stream,
+            tasks=self.tasks is not None,
+            bandwidth=self.bandwidth,
+        )
+        if self.stream:
+            reader = PowermetricsStreamReader(process.stdout)
+        else:
+            reader = PowermetricsFileReader('/tmp/asitop_exporter_powermetrics' + self.timecode)
+        return process, reader
 
     def start_powermetrics_process(self):
-        self.powermetrics_process = run_powermetrics_process(self.timecode, interval=self.interval)
+        self.powermetrics_process, self.reader = self.spawn_powermetrics()
+
+    def change_sample_interval(self, period):
+        """Start powermetrics at ``period`` next to the running one.
+
+        :meth:`read_readings` switches over once the new child's first
+        frame has arrived.
+        """
+        if self.pending_powermetrics is not None:
+            self.stop_powermetrics(*self.pending_powermetrics)
+        self.sample_interval = period
+        self.pending_powermetrics = self.spawn_powermetrics()
+
+    def close(self):
+        """Stop powermetrics, the sinks and the pusher."""
+        self.terminate_powermetrics_process()
+        self.sinks.stop(timeout=self.interval)
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.pusher is not None:
+            self.pusher.stop(timeout=self.interval)
+
     def terminate_powermetrics_process(self):
-        self.powermetrics_process.terminate()
\ No newline at end of file
+        if self.pending_powermetrics is not None:
+            self.stop_powermetrics(*self.pending_powermetrics)
+            self.pending_powermetrics = None
+        self.stop_powermetrics(self.powermetrics_process, self.reader)
+
+    @staticmethod
+    def stop_powermetrics(process, reader):
+        process.terminate()
+        if reader is not None:
+            reader.close()
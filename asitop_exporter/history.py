@@ -0,0 +1,176 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Fixed-size short-term history of the exported host metrics."""
+
+from __future__ import annotations
+
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from typing import Iterable, List, Mapping, Tuple
+
+
+MAGIC = b'ASTH'
+VERSION = 1
+# magic, version, capacity, columns, position, count
+HEADER = struct.Struct('<4sIQQQQ')
+HEADER_SIZE = 4096  # header plus the JSON list of keys
+
+
+class _Timestamps:
+    """Sequence view of the timestamps in logical (oldest first) order, for bisect."""
+
+    def __init__(self, store: HistoryStore, size: int) -> None:
+        self.store = store
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, logical: int) -> float:
+        return self.store.rows[self.store._physical(logical) * self.store.columns]  # pylint: disable=protected-access
+
+
+class HistoryStore:
+    """Ring buffer of ``(timestamp, value per key)`` rows in one flat array.
+
+    The rows live in a single float64 buffer, either in memory or, when
+    ``path`` is given, in a memory-mapped file so the history survives a
+    restart. A file written with different keys or capacity is reset.
+    The exporter keeps the ``HOST_METRICS`` only. Readers take a short lock, writers append one row per published sample.
+    """
+
+    def __init__(self, keys: Iterable[str], capacity: int, path: str | None = None) -> None:
+        self.keys = tuple(keys)
+        self.columns = 1 + len(self.keys)
+        self.capacity = max(1, capacity)
+        self.path = path
+        self.index = {key: column for column, key in enumerate(self.keys, start=1)}
+        self.lock = threading.Lock()
+
+        size = HEADER_SIZE + 8 * self.capacity * self.columns
+        self._file = None
+        if path is None:
+            self.buffer = bytearray(size)
+            fresh = True
+        else:
+            fresh = not os.path.exists(path) or os.path.getsize(path) != size
+            self._file = open(path, 'a+b')  # pylint: disable=consider-using-with
+            if fresh:
+                self._file.truncate(size)
+            self.buffer = mmap.mmap(self._file.fileno(), size)
+        self._view = memoryview(self.buffer)
+        self.rows = self._view[HEADER_SIZE:].cast('d')
+
+        if fresh or not self._header_matches():
+            self.position = 0
+            self.count = 0
+            self._write_header()
+        else:
+            _, _, _, _, self.position, self.count = HEADER.unpack_from(self.buffer, 0)
+
+    def _keys_blob(self) -> bytes:
+        return json.dumps(self.keys).encode('utf-8')
+
+    def _header_matches(self) -> bool:
+        magic, version, capacity, columns, _, _ = HEADER.unpack_from(self.buffer, 0)
+        blob = self._keys_blob()
+        stored = bytes(self.buffer[HEADER.size:HEADER.size + len(blob)])
+        return (magic, version, capacity, columns) == (MAGIC, VERSION, self.capacity, self.columns) and stored == blob
+
+    def _write_header(self) -> None:
+        blob = self._keys_blob()
+        if HEADER.size + len(blob) > HEADER_SIZE:
+            raise ValueError('too many history keys for the file header')
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, self.capacity, self.columns, self.position, self.count)
+        self.buffer[HEADER.size:HEADER.size + len(blob)] = blob
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp: float, values: Mapping[str, float]) -> None:
+        with self.lock:
+            base = self.position * self.columns
+            rows = self.rows
+            rows[base] = timestamp
+            for key, column in self.index.items():
+                value = values.get(key)
+                rows[base + column] = math.nan if value is None else value
+            self.position = (self.position + 1) % self.capacity
+            self.count += 1
+            HEADER.pack_into(
+                self.buffer, 0, MAGIC, VERSION, self.capacity, self.columns, self.position, self.count,
+            )
+
+    def _physical(self, logical: int) -> int:
+        """Map the n-th oldest row to its slot in the ring."""
+        oldest = self.position if self.count >= self.capacity else 0
+        return (oldest + logical) % self.capacity
+
+    def query(self, key: str, start: float = -math.inf, end: float = math.inf) -> Tuple[List[float], List[float]]:
+        """Return the timestamps and values of ``key`` with ``start <= timestamp <= end``."""
+        column = self.index[key]
+        with self.lock:
+            size = len(self)
+            rows = self.rows
+            columns = self.columns
+            # Rows are appended in time order, so the range can be bisected.
+            timestamps_view = _Timestamps(self, size)
+            first = bisect.bisect_left(timestamps_view, start)
+            last = bisect.bisect_right(timestamps_view, end)
+            timestamps = []
+            values = []
+            for logical in range(first, last):
+                base = self._physical(logical) * columns
+                timestamps.append(rows[base])
+                values.append(rows[base + column])
+        return timestamps, values
+
+    def flush(self) -> None:
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self.rows.release()
+            self._view.release()
+            self.buffer.flush()
+            self.buffer.close()
+            self._file.close()
+            self._file = None
+
+
+def encode_range(metric: str, timestamps: List[float], values: List[float], fmt: str = 'json') -> Tuple[str, bytes]:
+    """Encode a range query result, returning ``(content_type, body)``.
+
+    ``json`` gives ``{"metric", "timestamps", "values"}`` with parallel lists
+    (NaN for missing values is encoded as ``null``); ``binary`` gives
+    little-endian float64 ``timestamp, value`` pairs.
+    """
+    if fmt == 'binary':
+        pairs = [item for pair in zip(timestamps, values) for item in pair]
+        return 'application/octet-stream', struct.pack(f'<{len(pairs)}d', *pairs)
+    body = {
+        'metric': metric,
+        'timestamps': timestamps,
+        'values': [None if math.isnan(value) else value for value in values],
+    }
+    return 'application/json', json.dumps(body, separators=(',', ':')).encode('utf-8')
@@ -5,160 +5,251 @@ from subprocess import PIPE
 import psutil
 from .parsers import *
 import plistlib
+import calendar
+import datetime
+from typing import NamedTuple
+from .decoder import SelectivePlistDecoder
+from .reader import PowermetricsFileReader
 
 
-def parse_powermetrics(path='/tmp/asitop_exporter_powermetrics', timecode="0"):
-    data = None
+DEFAULT_DECODER = SelectivePlistDecoder()
+
+
+def parse_frame(frame, decoder=DEFAULT_DECODER):
+    """Parse one plist frame, decoding only the keys ``decoder`` keeps.
+
+    Pass ``decoder=None`` to decode the whole frame with :mod:`plistlib`.
+    """
+    if decoder is None:
+        powermetrics_parse = plistlib.loads(frame)
+    else:
+        powermetrics_parse = decoder.loads(frame)
+    thermal_pressure = parse_thermal_pressure(powermetrics_parse)
+    cpu_metrics_dict = parse_cpu_metrics(powermetrics_parse)
+    gpu_metrics_dict = parse_gpu_metrics(powermetrics_parse)
+    bandwidth_metrics = parse_bandwidth_metrics(powermetrics_parse)
+    timestamp = powermetrics_parse["timestamp"]
+    # Time the sample covers, energies are accumulated over it.
+    if "elapsed_ns" in powermetrics_parse:
+        cpu_metrics_dict["elapsed_s"] = powermetrics_parse["elapsed_ns"] / 1e9
+    if "tasks" in powermetrics_parse:
+        cpu_metrics_dict["tasks"] = parse_tasks(powermetrics_parse)
+    return cpu_metrics_dict, gpu_metrics_dict, thermal_pressure, bandwidth_metrics, timestamp
+
+
+def try_parse_frame(frame, decoder=DEFAULT_DECODER):
+    """Like :func:`parse_frame`, but return ``None`` if the frame fails to parse."""
     try:
-        with open(path+timecode, 'rb') as fp:
-            data = fp.read()
-        data = data.split(b'\x00')
-        powermetrics_parse = plistlib.loads(data[-1])
-        thermal_pressure = parse_thermal_pressure(powermetrics_parse)
-        cpu_metrics_dict = parse_cpu_metrics(powermetrics_parse)
-        gpu_metrics_dict = parse_gpu_metrics(powermetrics_parse)
-        #bandwidth_metrics = parse_bandwidth_metrics(powermetrics_parse)
-        bandwidth_metrics = None
-        timestamp = powermetrics_parse["timestamp"]
-        return cpu_metrics_dict, gpu_metrics_dict, thermal_pressure, bandwidth_metrics, timestamp
-    except Exception as e:
-        if data:
-            if len(data) > 1:
-                powermetrics_parse = plistlib.loads(data[-2])
-                thermal_pressure = parse_thermal_pressure(powermetrics_parse)
-                cpu_metrics_dict = parse_cpu_metrics(powermetrics_parse)
-                gpu_metrics_dict = parse_gpu_metrics(powermetrics_parse)
-                #bandwidth_metrics = parse_bandwidth_metrics(powermetrics_parse)
-                bandwidth_metrics = None
-                timestamp = powermetrics_parse["timestamp"]
-                return cpu_metrics_dict, gpu_metrics_dict, thermal_pressure, bandwidth_metrics, timestamp
-        return False
-    
+        return parse_frame(frame, decoder)
+    except Exception:  # noqa: BLE001 # pylint: disable=broad-except
+        return None
+
+
+def parse_frames(frames, decoder=DEFAULT_DECODER):
+    """Parse raw frames, skipping those that fail to parse."""
+    readings = []
+    for frame in frames:
+        reading = try_parse_frame(frame, decoder)
+        if reading is not None:
+            readings.append(reading)
+    return readings
+
+
+def parse_powermetrics(path='/tmp/asitop_exporter_powermetrics', timecode="0", reader=None, decoder=DEFAULT_DECODER):
+    """Parse the newest complete frame written to the powermetrics output file.
+
+    Pass a persistent :class:`~asitop_exporter.reader.PowermetricsFileReader`
+    as ``reader`` to only read the bytes appended since the previous call.
+    Returns ``False`` when no new complete frame is available.
+    """
+    if reader is None:
+        with PowermetricsFileReader(path+timecode) as oneshot:
+            frames = oneshot.read_frames()
+    else:
+        frames = reader.read_frames()
+    for frame in reversed(frames):
+        try:
+            return parse_frame(frame, decoder)
+        except Exception:  # noqa: BLE001 # pylint: disable=broad-except
+            continue
+    return False
+
+
+def unix_time(timestamp):
+    """Convert a frame ``timestamp`` to unix time; plist dates are UTC."""
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is None:
+            return calendar.timegm(timestamp.timetuple()) + timestamp.microsecond / 1e6
+        return timestamp.timestamp()
+    return float(timestamp)
+
 
 def parse_thermal_pressure(powermetrics_parse):
     return powermetrics_parse["thermal_pressure"]
 
 
+# Counters read from ``bandwidth_counters``, in bytes over the sample.
+BANDWIDTH_COUNTERS = (
+    "PCPU0 DCS RD", "PCPU0 DCS WR",
+    "PCPU1 DCS RD", "PCPU1 DCS WR",
+    "PCPU2 DCS RD", "PCPU2 DCS WR",
+    "PCPU3 DCS RD", "PCPU3 DCS WR",
+    "PCPU DCS RD", "PCPU DCS WR",
+    "ECPU0 DCS RD", "ECPU0 DCS WR",
+    "ECPU1 DCS RD", "ECPU1 DCS WR",
+    "ECPU DCS RD", "ECPU DCS WR",
+    "GFX DCS RD", "GFX DCS WR",
+    "ISP DCS RD", "ISP DCS WR",
+    "STRM CODEC DCS RD", "STRM CODEC DCS WR",
+    "PRORES DCS RD", "PRORES DCS WR",
+    "VDEC DCS RD", "VDEC DCS WR",
+    "VENC0 DCS RD", "VENC0 DCS WR",
+    "VENC1 DCS RD", "VENC1 DCS WR",
+    "VENC2 DCS RD", "VENC2 DCS WR",
+    "VENC3 DCS RD", "VENC3 DCS WR",
+    "VENC DCS RD", "VENC DCS WR",
+    "JPG0 DCS RD", "JPG0 DCS WR",
+    "JPG1 DCS RD", "JPG1 DCS WR",
+    "JPG2 DCS RD", "JPG2 DCS WR",
+    "JPG3 DCS RD", "JPG3 DCS WR",
+    "JPG DCS RD", "JPG DCS WR",
+    "DCS RD", "DCS WR",
+)
+# (target, sources): the sources are added to the target, in this order, so
+# a rollup may use the result of an earlier one.
+BANDWIDTH_ROLLUPS = tuple(
+    [
+        (f"{unit} DCS {direction}", tuple(f"{unit}{index} DCS {direction}" for index in range(4)))
+        for unit in ("PCPU", "JPG", "VENC")
+        for direction in ("RD", "WR")
+    ] + [
+        ("MEDIA DCS", tuple(
+            f"{unit} DCS {direction}"
+            for unit in ("ISP", "STRM CODEC", "PRORES", "VDEC", "VENC", "JPG")
+            for direction in ("RD", "WR")
+        )),
+    ]
+)
+BANDWIDTH_SLOTS = {
+    name: slot
+    for slot, name in enumerate(dict.fromkeys(BANDWIDTH_COUNTERS + tuple(target for target, _ in BANDWIDTH_ROLLUPS)))
+}
+_BANDWIDTH_ROLLUP_SLOTS = tuple(
+    (BANDWIDTH_SLOTS[target], tuple(BANDWIDTH_SLOTS[source] for source in sources))
+    for target, sources in BANDWIDTH_ROLLUPS
+)
+
+
 def parse_bandwidth_metrics(powermetrics_parse):
-    bandwidth_metrics = powermetrics_parse["bandwidth_counters"]
-    bandwidth_metrics_dict = {}
-    data_fields = ["PCPU0 DCS RD", "PCPU0 DCS WR",
-                   "PCPU1 DCS RD", "PCPU1 DCS WR",
-                   "PCPU2 DCS RD", "PCPU2 DCS WR",
-                   "PCPU3 DCS RD", "PCPU3 DCS WR",
-                   "PCPU DCS RD", "PCPU DCS WR",
-                   "ECPU0 DCS RD", "ECPU0 DCS WR",
-                   "ECPU1 DCS RD", "ECPU1 DCS WR",
-                   "ECPU DCS RD", "ECPU DCS WR",
-                   "GFX DCS RD", "GFX DCS WR",
-                   "ISP DCS RD", "ISP DCS WR",
-                   "STRM CODEC DCS RD", "STRM CODEC DCS WR",
-                   "PRORES DCS RD", "PRORES DCS WR",
-                   "VDEC DCS RD", "VDEC DCS WR",
-                   "VENC0 DCS RD", "VENC0 DCS WR",
-                   "VENC1 DCS RD", "VENC1 DCS WR",
-                   "VENC2 DCS RD", "VENC2 DCS WR",
-                   "VENC3 DCS RD", "VENC3 DCS WR",
-                   "VENC DCS RD", "VENC DCS WR",
-                   "JPG0 DCS RD", "JPG0 DCS WR",
-                   "JPG1 DCS RD", "JPG1 DCS WR",
-                   "JPG2 DCS RD", "JPG2 DCS WR",
-                   "JPG3 DCS RD", "JPG3 DCS WR",
-                   "JPG DCS RD", "JPG DCS WR",
-                   "DCS RD", "DCS WR"]
-    for h in data_fields:
-        bandwidth_metrics_dict[h] = 0
-    for l in bandwidth_metrics:
-        if l["name"] in data_fields:
-            bandwidth_metrics_dict[l["name"]] = l["value"]/(1e9)
-    bandwidth_metrics_dict["PCPU DCS RD"] = bandwidth_metrics_dict["PCPU DCS RD"] + \
-        bandwidth_metrics_dict["PCPU0 DCS RD"] + \
-        bandwidth_metrics_dict["PCPU1 DCS RD"] + \
-        bandwidth_metrics_dict["PCPU2 DCS RD"] + \
-        bandwidth_metrics_dict["PCPU3 DCS RD"]
-    bandwidth_metrics_dict["PCPU DCS WR"] = bandwidth_metrics_dict["PCPU DCS WR"] + \
-        bandwidth_metrics_dict["PCPU0 DCS WR"] + \
-        bandwidth_metrics_dict["PCPU1 DCS WR"] + \
-        bandwidth_metrics_dict["PCPU2 DCS WR"] + \
-        bandwidth_metrics_dict["PCPU3 DCS WR"]
-    bandwidth_metrics_dict["JPG DCS RD"] = bandwidth_metrics_dict["JPG DCS RD"] + \
-        bandwidth_metrics_dict["JPG0 DCS RD"] + \
-        bandwidth_metrics_dict["JPG1 DCS RD"] + \
-        bandwidth_metrics_dict["JPG2 DCS RD"] + \
-        bandwidth_metrics_dict["JPG3 DCS RD"]
-    bandwidth_metrics_dict["JPG DCS WR"] = bandwidth_metrics_dict["JPG DCS WR"] + \
-        bandwidth_metrics_dict["JPG0 DCS WR"] + \
-        bandwidth_metrics_dict["JPG1 DCS WR"] + \
-        bandwidth_metrics_dict["JPG2 DCS WR"] + \
-        bandwidth_metrics_dict["JPG3 DCS WR"]
-    bandwidth_metrics_dict["VENC DCS RD"] = bandwidth_metrics_dict["VENC DCS RD"] + \
-        bandwidth_metrics_dict["VENC0 DCS RD"] + \
-        bandwidth_metrics_dict["VENC1 DCS RD"] + \
-        bandwidth_metrics_dict["VENC2 DCS RD"] + \
-        bandwidth_metrics_dict["VENC3 DCS RD"]
-    bandwidth_metrics_dict["VENC DCS WR"] = bandwidth_metrics_dict["VENC DCS WR"] + \
-        bandwidth_metrics_dict["VENC0 DCS WR"] + \
-        bandwidth_metrics_dict["VENC1 DCS WR"] + \
-        bandwidth_metrics_dict["VENC2 DCS WR"] + \
-        bandwidth_metrics_dict["VENC3 DCS WR"]
-    bandwidth_metrics_dict["MEDIA DCS"] = sum([
-        bandwidth_metrics_dict["ISP DCS RD"], bandwidth_metrics_dict["ISP DCS WR"],
-        bandwidth_metrics_dict["STRM CODEC DCS RD"], bandwidth_metrics_dict["STRM CODEC DCS WR"],
-        bandwidth_metrics_dict["PRORES DCS RD"], bandwidth_metrics_dict["PRORES DCS WR"],
-        bandwidth_metrics_dict["VDEC DCS RD"], bandwidth_metrics_dict["VDEC DCS WR"],
-        bandwidth_metrics_dict["VENC DCS RD"], bandwidth_metrics_dict["VENC DCS WR"],
-        bandwidth_metrics_dict["JPG DCS RD"], bandwidth_metrics_dict["JPG DCS WR"],
-    ])
-    return bandwidth_metrics_dict
+    """Return ``{counter: GB over the sample}`` including the rollups, or
+    ``None`` if the frame has no ``bandwidth_counters`` (newer macOS)."""
+    bandwidth_counters = powermetrics_parse.get("bandwidth_counters")
+    if bandwidth_counters is None:
+        return None
+    slots = BANDWIDTH_SLOTS
+    values = [0.0] * len(slots)
+    for counter in bandwidth_counters:
+        slot = slots.get(counter.get("name"))
+        if slot is not None:
+            values[slot] = counter["value"] / 1e9
+    for target, sources in _BANDWIDTH_ROLLUP_SLOTS:
+        values[target] += sum([values[source] for source in sources])
+    return dict(zip(slots, values))
+
+
+class CpuLayout:
+    """Cluster and core layout of one CPU topology.
+
+    Compiled from the first frame of a topology and reused while later
+    frames have the same clusters and cores. The E and P aggregates are
+    computed over however many clusters of each type the chip has.
+    """
+
+    def __init__(self, clusters):
+        # ((cluster name, (cpu, ...)), ...), also the collector's topology key
+        self.key = tuple(
+            (cluster["name"], tuple(cpu["cpu"] for cpu in cluster["cpus"]))
+            for cluster in clusters
+        )
+        self.cluster_count = len(self.key)
+        self.core_count = sum(len(cores) for _, cores in self.key)
+        self.e_core = [cpu for name, cores in self.key if name[0] == "E" for cpu in cores]
+        self.p_core = [cpu for name, cores in self.key if name[0] != "E" for cpu in cores]
+        # (prefix, cluster indices, their core counts, total cores) per type
+        self.groups = []
+        for prefix in ("E", "P"):
+            indices = tuple(
+                index for index, (name, _) in enumerate(self.key) if (name[0] == "E") == (prefix == "E")
+            )
+            weights = tuple(len(self.key[index][1]) for index in indices)
+            self.groups.append((prefix, indices, weights, sum(weights)))
+
+    def matches(self, clusters):
+        if len(clusters) != self.cluster_count:
+            return False
+        for cluster, (name, cores) in zip(clusters, self.key):
+            cpus = cluster["cpus"]
+            if cluster["name"] != name or len(cpus) != len(cores):
+                return False
+            for cpu, core in zip(cpus, cores):
+                if cpu["cpu"] != core:
+                    return False
+        return True
+
+
+class CpuReading(NamedTuple):
+    """Per-cluster and per-core values of one frame, in ``layout`` order."""
+
+    layout: CpuLayout
+    cluster_active: list
+    cluster_freq: list
+    core_active: list
+    core_freq: list
+
+
+_cpu_layout = None
+
+
+def get_cpu_layout(clusters):
+    """Return the cached :class:`CpuLayout`, rebuilding it if the topology changed."""
+    global _cpu_layout  # pylint: disable=global-statement
+    layout = _cpu_layout
+    if layout is None or not layout.matches(clusters):
+        layout = _cpu_layout = CpuLayout(clusters)
+    return layout
 
 
 def parse_cpu_metrics(powermetrics_parse):
-    e_core = []
-    p_core = []
     cpu_metrics = powermetrics_parse["processor"]
-    cpu_metric_dict = {}
-    # cpu_clusters
     cpu_clusters = cpu_metrics["clusters"]
-    for cluster in cpu_clusters:
-        name = cluster["name"]
-        cpu_metric_dict[name+"_freq_Mhz"] = int(cluster["freq_hz"]/(1e6))
-        cpu_metric_dict[name+"_active"] = int((1 - cluster["idle_ratio"])*100)
+    layout = get_cpu_layout(cpu_clusters)
+    cluster_active = [0] * layout.cluster_count
+    cluster_freq = [0] * layout.cluster_count
+    core_active = [0] * layout.core_count
+    core_freq = [0] * layout.core_count
+    core = 0
+    for index, cluster in enumerate(cpu_clusters):
+        cluster_freq[index] = int(cluster["freq_hz"] / 1e6)
+        cluster_active[index] = int((1 - cluster["idle_ratio"]) * 100)
         for cpu in cluster["cpus"]:
-            name = 'E-Cluster' if name[0] == 'E' else 'P-Cluster'
-            core = e_core if name[0] == 'E' else p_core
-            core.append(cpu["cpu"])
-            cpu_metric_dict[name + str(cpu["cpu"]) + "_freq_Mhz"] = int(cpu["freq_hz"] / (1e6))
-            cpu_metric_dict[name + str(cpu["cpu"]) + "_active"] = int((1 - cpu["idle_ratio"]) * 100)
-    cpu_metric_dict["e_core"] = e_core
-    cpu_metric_dict["p_core"] = p_core
-    if "E-Cluster_active" not in cpu_metric_dict:
-        # M1 Ultra
-        cpu_metric_dict["E-Cluster_active"] = int(
-            (cpu_metric_dict["E0-Cluster_active"] + cpu_metric_dict["E1-Cluster_active"])/2)
-    if "E-Cluster_freq_Mhz" not in cpu_metric_dict:
-        # M1 Ultra
-        cpu_metric_dict["E-Cluster_freq_Mhz"] = max(
-            cpu_metric_dict["E0-Cluster_freq_Mhz"], cpu_metric_dict["E1-Cluster_freq_Mhz"])
-    if "P-Cluster_active" not in cpu_metric_dict:
-        if "P2-Cluster_active" in cpu_metric_dict:
-            # M1 Ultra
-            cpu_metric_dict["P-Cluster_active"] = int((cpu_metric_dict["P0-Cluster_active"] + cpu_metric_dict["P1-Cluster_active"] +
-                                                      cpu_metric_dict["P2-Cluster_active"] + cpu_metric_dict["P3-Cluster_active"]) / 4)
-        else:
-            cpu_metric_dict["P-Cluster_active"] = int(
-                (cpu_metric_dict["P0-Cluster_active"] + cpu_metric_dict["P1-Cluster_active"])/2)
-    if "P-Cluster_freq_Mhz" not in cpu_metric_dict:
-        if "P2-Cluster_freq_Mhz" in cpu_metric_dict:
-            # M1 Ultra
-            freqs = [
-                cpu_metric_dict["P0-Cluster_freq_Mhz"],
-                cpu_metric_dict["P1-Cluster_freq_Mhz"],
-                cpu_metric_dict["P2-Cluster_freq_Mhz"],
-                cpu_metric_dict["P3-Cluster_freq_Mhz"]]
-            cpu_metric_dict["P-Cluster_freq_Mhz"] = max(freqs)
-        else:
-            cpu_metric_dict["P-Cluster_freq_Mhz"] = max(
-                cpu_metric_dict["P0-Cluster_freq_Mhz"], cpu_metric_dict["P1-Cluster_freq_Mhz"])
+            core_freq[core] = int(cpu["freq_hz"] / 1e6)
+            core_active[core] = int((1 - cpu["idle_ratio"]) * 100)
+            core += 1
+
+    cpu_metric_dict = {
+        "e_core": layout.e_core,
+        "p_core": layout.p_core,
+        "cpu": CpuReading(layout, cluster_active, cluster_freq, core_active, core_freq),
+    }
+    for prefix, indices, weights, total in layout.groups:
+        if not total:
+            cpu_metric_dict[prefix + "-Cluster_active"] = 0
+            cpu_metric_dict[prefix + "-Cluster_freq_Mhz"] = 0
+            continue
+        # Utilisation weighted by cores; the fastest cluster sets the clock.
+        cpu_metric_dict[prefix + "-Cluster_active"] = int(
+            sum([cluster_active[index] * weight for index, weight in zip(indices, weights)]) / total)
+        cpu_metric_dict[prefix + "-Cluster_freq_Mhz"] = max([cluster_freq[index] for index in indices])
     # power
     cpu_metric_dict["ane_W"] = cpu_metrics["ane_energy"]/1000
     #cpu_metric_dict["dram_W"] = cpu_metrics["dram_energy"]/1000
@@ -168,6 +259,21 @@ def parse_cpu_metrics(powermetrics_parse):
     return cpu_metric_dict
 
 
+def parse_tasks(powermetrics_parse):
+    """Return ``(pid, name, cpu ms/s, energy impact/s, wakeups/s)`` per process."""
+    return [
+        (
+            task["pid"],
+            task.get("name", ""),
+            task.get("cputime_ms_per_s", 0.0),
+            task.get("energy_impact_per_s", 0.0),
+            task.get("intr_wakeups_per_s", 0.0) + task.get("idle_wakeups_per_s", 0.0),
+        )
+        for task in powermetrics_parse["tasks"]
+        if "pid" in task
+    ]
+
+
 def parse_gpu_metrics(powermetrics_parse):
     gpu_metrics = powermetrics_parse["gpu"]
     gpu_metrics_dict = {
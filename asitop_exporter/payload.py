@@ -0,0 +1,107 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Precompiled JSON encoder for the ``--post_url`` payload."""
+
+from __future__ import annotations
+
+import json
+import math
+from typing import Dict, Mapping, Tuple
+
+
+CLUSTER = 'jmlj-tonglu-productk8s'
+NAMESPACE = 'ezagi'
+SERVICE_NAME = 'ezagi_algo_m2_iaas'
+MONITOR_TYPE = 'iaas'
+METRIC = 'Throughput'
+COUNTER_TYPE = 'COUNTER'
+
+FORMATS = ('records', 'columnar')
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value).encode('utf-8')
+
+
+def encode_number(value) -> bytes:
+    """Encode a metric value exactly like :func:`json.dumps` would."""
+    if type(value) is int:  # pylint: disable=unidiomatic-typecheck
+        return b'%d' % value
+    if type(value) is float and math.isfinite(value):  # pylint: disable=unidiomatic-typecheck
+        return float.__repr__(value).encode('ascii')
+    return _dumps(value)
+
+
+class PayloadEncoder:
+    """Encode ``metrics_dict`` samples into the JSON posted to ``post_url``.
+
+    Everything that does not change between samples is encoded to bytes once
+    at construction time. Per sample only the value, timestamp and uuid are
+    spliced in, and the ``url`` tag fragment is cached per metric name.
+
+    :meth:`encode` returns the JSON array *items* for one sample without the
+    surrounding brackets, so several samples can be joined into one request.
+    The ``records`` format produces one object per metric, the ``columnar``
+    format one object per sample with parallel ``metrics``/``values`` lists.
+    """
+
+    def __init__(self, nodeip: str, interval: float, *, fmt: str = 'records') -> None:
+        if fmt not in FORMATS:
+            raise ValueError(f'unknown payload format {fmt!r}, expected one of {FORMATS}')
+        self.format = fmt
+        nodeip = _dumps(nodeip)
+        self.static = (
+            b'{"cluster": ' + _dumps(CLUSTER)
+            + b', "namespace": ' + _dumps(NAMESPACE)
+            + b', "nodeip": ' + nodeip
+            + b', "endpoint": ' + nodeip
+            + b', "metric": ' + _dumps(METRIC)
+        )
+        self.step = b', "step": %d, "counterType": ' % int(interval) + _dumps(COUNTER_TYPE)
+        self.tail = b', "serviceName": ' + _dumps(SERVICE_NAME) + b'}, "monitorType": ' + _dumps(MONITOR_TYPE) + b'}'
+        self._url_fragments: Dict[str, bytes] = {}
+        self._metric_names: Tuple[Tuple[str, ...], bytes] = ((), b'[]')
+
+    def _url_fragment(self, key: str) -> bytes:
+        fragment = self._url_fragments.get(key)
+        if fragment is None:
+            fragment = self._url_fragments[key] = b'", "tags": {"url": ' + _dumps(key) + self.tail
+        return fragment
+
+    def encode(self, metrics: Mapping[str, float], timestamp: int, uuid: str) -> bytes:
+        if self.format == 'columnar':
+            return self.encode_columnar(metrics, timestamp, uuid)
+
+        head = self.static + b', "value": '
+        middle = self.step + b', "timestamp": %d, "uuid": "' % timestamp + uuid.encode('ascii')
+        return b', '.join([
+            head + encode_number(value) + middle + self._url_fragment(key)
+            for key, value in metrics.items()
+        ])
+
+    def encode_columnar(self, metrics: Mapping[str, float], timestamp: int, uuid: str) -> bytes:
+        names = tuple(metrics)
+        if names != self._metric_names[0]:
+            self._metric_names = (names, _dumps(list(names)))
+        values = b', '.join([encode_number(value) for value in metrics.values()])
+        return (
+            self.static + self.step
+            + b', "timestamp": %d, "uuid": "' % timestamp + uuid.encode('ascii')
+            + b'", "tags": {' + self.tail[2:-1]
+            + b', "metrics": ' + self._metric_names[1]
+            + b', "values": [' + values + b']}'
+        )
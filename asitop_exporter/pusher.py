@@ -0,0 +1,161 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Push the registry to a Pushgateway for hosts Prometheus cannot scrape."""
+
+from __future__ import annotations
+
+import base64
+import gzip
+import random
+import threading
+import time
+from typing import Callable, Dict
+from urllib.parse import quote
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+
+
+def grouping_path(job: str, grouping_key: Dict[str, str]) -> str:
+    """Build the ``/metrics/job/<job>/<label>/<value>...`` path of a push.
+
+    Values containing ``/`` use the Pushgateway's base64 encoding.
+    """
+    parts = []
+    for name, value in (('job', job), *grouping_key.items()):
+        if '/' in value:
+            encoded = base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+            parts.append(f'{name}@base64/{encoded}')
+        elif not value:
+            parts.append(f'{name}@base64/=')
+        else:
+            parts.append(f'{name}/{quote(value, safe="")}')
+    return '/metrics/' + '/'.join(parts)
+
+
+class PushGatewayPusher:  # pylint: disable=too-many-instance-attributes
+    """Push the registry to a Pushgateway every ``interval`` seconds.
+
+    One push carries the latest published sample, so a push interval longer
+    than the sampling interval coalesces several samples into one request
+    (the Pushgateway keeps only the latest value of each series anyway).
+    The exposition is rendered, and compressed, once per new sample as
+    reported by ``version`` and the bytes are reused until the next one.
+    Pushes go over a keep-alive session and failed ones are retried with
+    exponential backoff and full jitter.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        url: str,
+        registry: CollectorRegistry,
+        *,
+        job: str = 'asitop_exporter',
+        grouping_key: Dict[str, str] | None = None,
+        interval: float = 15.0,
+        version: Callable[[], int] | None = None,
+        compress: bool = False,
+        timeout: float = 5.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ) -> None:
+        self.url = url.rstrip('/') + grouping_path(job, grouping_key or {})
+        self.registry = registry
+        self.interval = interval
+        self.version = version
+        self.compress = compress
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers['Content-Type'] = CONTENT_TYPE_LATEST
+        if compress:
+            self.session.headers['Content-Encoding'] = 'gzip'
+
+        self._body = None
+        self._body_version = None
+
+        self.failures = Counter(
+            name='asitop_exporter_push_failures',
+            documentation='Failed push attempts to push_url, including retried ones.',
+            registry=registry,
+        )
+        self.latency = Histogram(
+            name='asitop_exporter_push_latency_seconds',
+            documentation='Latency of successful pushes to push_url.',
+            registry=registry,
+        )
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='push-gateway', daemon=True)
+
+    def start(self) -> PushGatewayPusher:
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        self._thread.join(timeout)
+        self.session.close()
+
+    def render(self) -> bytes:
+        """Return the push body, rendered again only after a new sample."""
+        version = self.version() if self.version is not None else None
+        if self._body is None or version is None or version != self._body_version:
+            body = generate_latest(self.registry)
+            if self.compress:
+                body = gzip.compress(body)
+            self._body = body
+            self._body_version = version
+        return self._body
+
+    def push(self) -> bool:
+        body = self.render()
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.session.put(self.url, data=body, timeout=self.timeout)
+                if response.status_code < 300:
+                    self.latency.observe(time.monotonic() - start)
+                    return True
+                if response.status_code < 500 and response.status_code != 429:
+                    # The gateway rejected the body, retrying will not help.
+                    self.failures.inc()
+                    return False
+            except RequestException:
+                pass
+            self.failures.inc()
+            if attempt == self.retries:
+                break
+            delay = random.uniform(0.0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if self._stop.wait(delay):
+                break
+        return False
+
+    def _run(self) -> None:
+        next_push = time.monotonic() + self.interval
+        while not self._stop.wait(max(0.0, next_push - time.monotonic())):
+            next_push += self.interval
+            self.push()
+            # Skip the pushes missed while retrying instead of bursting them.
+            next_push = max(next_push, time.monotonic())
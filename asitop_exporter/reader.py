@@ -0,0 +1,218 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Incremental readers for ``powermetrics`` plist output."""
+
+from __future__ import annotations
+
+import mmap
+import os
+import queue
+import threading
+from typing import BinaryIO, Iterator, List
+
+from asitop_exporter.watch import watch_file
+
+FRAME_SEPARATOR = b'\x00'
+FRAME_TERMINATOR = b'</plist>'
+
+
+def split_frames(buffer: bytes, data: bytes) -> tuple[List[bytes], bytes]:
+    """Split ``buffer + data`` into complete frames and the trailing partial frame.
+
+    A trailing frame that already ends with ``</plist>`` is complete even if
+    its NUL separator has not been written yet, so it is returned right away.
+    """
+    *frames, partial = (buffer + data).split(FRAME_SEPARATOR)
+    if partial.rstrip().endswith(FRAME_TERMINATOR):
+        frames.append(partial)
+        partial = b''
+    return [frame for frame in frames if frame.strip()], partial
+
+
+class PowermetricsFileReader:
+    """Tail a ``powermetrics -f plist -o <path>`` output file.
+
+    The reader remembers the byte offset it has consumed so far and only maps
+    the bytes appended since the previous call. Bytes after the last NUL
+    separator are kept as a partial frame until the rest of it is written, so
+    :meth:`read_frames` only ever returns complete frames and the cost of a
+    call does not depend on the size of the file. :meth:`wait` blocks until
+    the file is written to, see :mod:`asitop_exporter.watch`.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.offset = 0
+        self._partial = b''
+        self._fp = None
+        self._inode = None
+        self._watcher = None
+
+    def _open(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._close_file()
+            return False
+        if self._fp is None or stat.st_ino != self._inode:
+            self._close_file()
+            self._fp = open(self.path, 'rb')  # pylint: disable=consider-using-with
+            self._inode = stat.st_ino
+        return True
+
+    def reset(self) -> None:
+        """Forget the consumed offset and any buffered partial frame."""
+        self.offset = 0
+        self._partial = b''
+
+    def _close_file(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = None
+        self._inode = None
+        self.reset()
+
+    def close(self) -> None:
+        self._close_file()
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+
+    def wait(self, timeout: float) -> bool:
+        """Block until the file may have new bytes; ``False`` after ``timeout`` seconds."""
+        if self._watcher is None:
+            # Writes made before the watcher existed were not seen, read again first.
+            self._watcher = watch_file(self.path)
+            return True
+        return self._watcher.wait(timeout)
+
+    def read_new_bytes(self) -> bytes:
+        """Return the bytes appended to the file since the previous call."""
+        if not self._open():
+            return b''
+        size = os.fstat(self._fp.fileno()).st_size
+        if size < self.offset:
+            # The file was truncated or replaced in place, start over.
+            self.reset()
+        if size == self.offset:
+            return b''
+
+        start = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(
+            self._fp.fileno(),
+            length=size - start,
+            offset=start,
+            access=mmap.ACCESS_READ,
+        ) as mapped:
+            data = mapped[self.offset - start:]
+        self.offset = size
+        return data
+
+    def read_frames(self) -> List[bytes]:
+        """Return the complete frames written since the previous call."""
+        # Read first: a truncated or replaced file drops the buffered partial frame.
+        data = self.read_new_bytes()
+        frames, self._partial = split_frames(self._partial, data)
+        return frames
+
+    def __enter__(self) -> PowermetricsFileReader:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class PowermetricsStreamReader:
+    """Split ``powermetrics -f plist`` frames straight off the child's stdout.
+
+    A daemon thread reads the pipe as data arrives and queues every complete
+    frame, so nothing touches the disk and a frame is available to the
+    consumer as soon as powermetrics has written it. :meth:`wait` blocks
+    until then without consuming the frame.
+    """
+
+    def __init__(self, stream: BinaryIO, chunk_size: int = 65536) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.closed = False
+        self._frames = queue.Queue()
+        # Set when frames (or EOF) were queued since the last read_frames().
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._read_loop,
+            name='powermetrics-reader',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _read_loop(self) -> None:
+        partial = b''
+        fileno = self.stream.fileno()
+        try:
+            while True:
+                data = os.read(fileno, self.chunk_size)
+                if not data:
+                    break
+                frames, partial = split_frames(partial, data)
+                for frame in frames:
+                    self._frames.put(frame)
+                if frames:
+                    self._ready.set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            self._frames.put(None)
+            self._ready.set()
+
+    def read_frames(self, timeout: float | None = None) -> List[bytes]:
+        """Wait up to ``timeout`` seconds for a frame and return all queued frames.
+
+        Returns an empty list on timeout or once the stream has reached EOF.
+        """
+        frames = []
+        # Cleared before reading, so a frame queued meanwhile sets it again.
+        self._ready.clear()
+        try:
+            frame = self._frames.get(timeout=timeout)
+            while frame is not None:
+                frames.append(frame)
+                frame = self._frames.get_nowait()
+            # Keep the EOF marker for later callers.
+            self._frames.put(None)
+            self._ready.set()
+        except queue.Empty:
+            pass
+        return frames
+
+    def wait(self, timeout: float) -> bool:
+        """Block until frames are queued; ``False`` after ``timeout`` seconds."""
+        return self._ready.wait(timeout)
+
+    def frames(self) -> Iterator[bytes]:
+        """Yield frames as they arrive until the stream reaches EOF."""
+        while True:
+            frames = self.read_frames()
+            if not frames:
+                return
+            yield from frames
+
+    def close(self) -> None:
+        try:
+            self.stream.close()
+        except OSError:
+            pass
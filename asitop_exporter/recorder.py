@@ -0,0 +1,321 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Compressed, indexed recording of the raw powermetrics frames.
+
+A recording directory holds segment files ``<start>.seg`` (``<start>-<n>.seg``
+for later segments started within the same second), each a sequence of
+blocks, with an ``.idx`` index of the same name next to it. A block is a
+:data:`BLOCK_HEADER` followed by the zlib-compressed, NUL-separated frames
+it holds; every block has one fixed-size :data:`INDEX_ENTRY` in the index,
+so a time range is found by bisecting the index and only the blocks that
+overlap it are decompressed. Indexes can be rebuilt from the block headers.
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import calendar
+import datetime
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+from typing import Iterator, List, NamedTuple, Tuple
+
+from asitop_exporter.reader import FRAME_SEPARATOR
+
+
+# magic, compressed length, frame count, first timestamp, last timestamp
+BLOCK_HEADER = struct.Struct('<4sIIdd')
+BLOCK_MAGIC = b'ASRB'
+# first timestamp, last timestamp, block offset in the segment
+INDEX_ENTRY = struct.Struct('<ddQ')
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+_TIMESTAMP = re.compile(rb'<key>timestamp</key>\s*<date>([^<]+)</date>')
+
+
+def frame_timestamp(frame: bytes) -> float | None:
+    """Read the ``timestamp`` of a raw plist frame without decoding it."""
+    match = _TIMESTAMP.search(frame)
+    if match is None:
+        return None
+    try:
+        parsed = datetime.datetime.strptime(match.group(1).decode('ascii'), '%Y-%m-%dT%H:%M:%SZ')
+    except ValueError:
+        return None
+    return float(calendar.timegm(parsed.timetuple()))
+
+
+class BlockIndex(NamedTuple):
+    first: float
+    last: float
+    offset: int
+
+
+class Recorder:  # pylint: disable=too-many-instance-attributes
+    """Append raw frames to rotating, block-compressed segment files.
+
+    Frames are buffered until ``block_size`` bytes or ``block_age`` seconds
+    have accumulated and then written as one compressed block, so at most
+    one block is lost if the exporter dies. A new segment is started after
+    ``segment_size`` bytes or ``segment_age`` seconds, and the oldest
+    segments are deleted while the recording exceeds ``max_bytes``. The
+    limit is checked after every block; when the current segment alone
+    exceeds it, the next block starts a new segment so the current one can
+    be deleted. The recording thus stays within ``max_bytes`` plus one block.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        directory: str,
+        *,
+        max_bytes: int = 1 << 30,
+        segment_size: int = 64 << 20,
+        segment_age: float = 3600.0,
+        block_size: int = 256 << 10,
+        block_age: float = 60.0,
+        level: int = 6,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.block_size = block_size
+        self.block_age = block_age
+        self.level = level
+        os.makedirs(directory, exist_ok=True)
+
+        self.segment = None
+        self.index = None
+        self.segment_started = 0.0
+        self.pending: List[bytes] = []
+        self.pending_bytes = 0
+        self.pending_since = 0.0
+        self.first = None
+        self.last = None
+        # Bytes of all segments and indexes, listed at rotation and then counted.
+        self.total = 0
+
+    def write(self, frames: List[bytes]) -> None:
+        now = time.time()
+        for frame in frames:
+            timestamp = frame_timestamp(frame) or now
+            if not self.pending:
+                self.pending_since = time.monotonic()
+                self.first = timestamp
+            self.last = timestamp
+            self.pending.append(frame)
+            self.pending_bytes += len(frame) + 1
+        if self.pending and (
+            self.pending_bytes >= self.block_size
+            or time.monotonic() - self.pending_since >= self.block_age
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered frames as one block."""
+        if not self.pending:
+            return
+        if self.segment is None or self._segment_full():
+            self._rotate()
+        data = zlib.compress(FRAME_SEPARATOR.join(self.pending), self.level)
+        offset = self.segment.tell()
+        self.segment.write(BLOCK_HEADER.pack(BLOCK_MAGIC, len(data), len(self.pending), self.first, self.last))
+        self.segment.write(data)
+        self.segment.flush()
+        self.index.write(INDEX_ENTRY.pack(self.first, self.last, offset))
+        self.index.flush()
+        self.pending = []
+        self.pending_bytes = 0
+        self.total += BLOCK_HEADER.size + len(data) + INDEX_ENTRY.size
+        if self.total > self.max_bytes:
+            self._enforce_limit()
+
+    def _segment_full(self) -> bool:
+        return (
+            self.segment.tell() >= self.segment_size
+            or time.monotonic() - self.segment_started >= self.segment_age
+            # Only the current segment is left to delete.
+            or self.total > self.max_bytes
+        )
+
+    def _rotate(self) -> None:
+        self._close_segment()
+        stamp = f'{self.first:.0f}'
+        base = os.path.join(self.directory, stamp)
+        # Segments started within the same second get a sequence suffix.
+        sequence = 0
+        while os.path.exists(base + SEGMENT_SUFFIX):
+            sequence += 1
+            base = os.path.join(self.directory, f'{stamp}-{sequence}')
+        # pylint: disable=consider-using-with
+        self.segment = open(base + SEGMENT_SUFFIX, 'ab')
+        self.index = open(base + INDEX_SUFFIX, 'ab')
+        self.segment_started = time.monotonic()
+        self._enforce_limit()
+
+    def _enforce_limit(self) -> None:
+        segments = list_segments(self.directory)
+        sizes = [file_size(path) + file_size(path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX) for path in segments]
+        total = sum(sizes)
+        current = self.segment.name if self.segment is not None else None
+        for path, size in zip(segments, sizes):
+            if total <= self.max_bytes or path == current:
+                break
+            for name in (path, path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            total -= size
+        self.total = total
+
+    def _close_segment(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = self.index = None
+
+    def close(self) -> None:
+        self.flush()
+        self._close_segment()
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def segment_order(name: str) -> Tuple[float, int]:
+    """Sort key of ``<start>.seg`` and ``<start>-<sequence>.seg``."""
+    stamp, _, sequence = name[:-len(SEGMENT_SUFFIX)].partition('-')
+    return float(stamp), int(sequence or 0)
+
+
+def list_segments(directory: str) -> List[str]:
+    """Return the segment files of a recording, oldest first."""
+    names = [name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)]
+    names.sort(key=segment_order)
+    return [os.path.join(directory, name) for name in names]
+
+
+def scan_blocks(segment_path: str) -> List[BlockIndex]:
+    """Rebuild a segment's index from its block headers."""
+    entries = []
+    with open(segment_path, 'rb') as fp:
+        offset = 0
+        while True:
+            header = fp.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                break
+            magic, length, _, first, last = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                break
+            entries.append(BlockIndex(first, last, offset))
+            offset += BLOCK_HEADER.size + length
+            fp.seek(offset)
+    return entries
+
+
+def load_index(segment_path: str) -> List[BlockIndex]:
+    """Load a segment's index, rebuilding it if it is missing or behind the segment."""
+    index_path = segment_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+    try:
+        with open(index_path, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return scan_blocks(segment_path)
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    entries = [BlockIndex(*entry) for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+    end = 0
+    with open(segment_path, 'rb') as fp:
+        if entries:
+            fp.seek(entries[-1].offset)
+            header = fp.read(BLOCK_HEADER.size)
+            if len(header) == BLOCK_HEADER.size:
+                end = entries[-1].offset + BLOCK_HEADER.size + BLOCK_HEADER.unpack(header)[1]
+        if fp.seek(0, os.SEEK_END) > end:
+            # Blocks were written after the last index entry (e.g. a crash in between).
+            return scan_blocks(segment_path)
+    return entries
+
+
+class Recording:
+    """Read back a recording directory by time range."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def blocks(self, start: float = float('-inf'), end: float = float('inf')) -> Iterator[Tuple[str, BlockIndex]]:
+        """Yield ``(segment, block)`` for the blocks overlapping ``[start, end]``."""
+        for segment in list_segments(self.directory):
+            index = load_index(segment)
+            if not index or index[-1].last < start or index[0].first > end:
+                continue
+            # Blocks are written in time order, so their last timestamps are sorted.
+            first = bisect.bisect_left([block.last for block in index], start)
+            for block in index[first:]:
+                if block.first > end:
+                    break
+                yield segment, block
+
+    def frames(self, start: float = float('-inf'), end: float = float('inf')) -> Iterator[Tuple[float, bytes]]:
+        """Yield ``(timestamp, raw frame)`` for the frames in ``[start, end]``."""
+        for segment, block in self.blocks(start, end):
+            with open(segment, 'rb') as fp:
+                fp.seek(block.offset)
+                magic, length, _, _, _ = BLOCK_HEADER.unpack(fp.read(BLOCK_HEADER.size))
+                if magic != BLOCK_MAGIC:
+                    continue
+                data = zlib.decompress(fp.read(length))
+            for frame in data.split(FRAME_SEPARATOR):
+                timestamp = frame_timestamp(frame)
+                if timestamp is None:
+                    timestamp = block.first
+                if start <= timestamp <= end:
+                    yield timestamp, frame
+
+
+def main(argv: List[str] | None = None) -> int:
+    """Extract a time range of a recording as a plain NUL-delimited capture."""
+    parser = argparse.ArgumentParser(
+        prog='asitop-exporter extract',
+        description='Extract frames of a --record_dir recording into a capture that\n'
+                    '`asitop-exporter replay` reads.',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument('directory', metavar='DIR', help='recording directory')
+    parser.add_argument('--start', type=float, default=float('-inf'), metavar='UNIX', help='first timestamp')
+    parser.add_argument('--end', type=float, default=float('inf'), metavar='UNIX', help='last timestamp')
+    parser.add_argument('--output', '-o', required=True, metavar='PATH', help='capture file to write')
+    args = parser.parse_args(argv)
+
+    count = 0
+    with open(args.output, 'wb') as output:
+        for _, frame in Recording(args.directory).frames(args.start, args.end):
+            output.write(frame + FRAME_SEPARATOR)
+            count += 1
+    print(f'INFO: Extracted {count} frames.', file=sys.stderr)
+    return 0
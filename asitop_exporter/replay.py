@@ -0,0 +1,293 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Replay recorded powermetrics captures into OpenMetrics text for backfilling.
+
+``asitop-exporter replay capture.plist ... > backfill.om`` runs every frame
+through the same parse and derive steps as the live exporter and writes the
+metrics with the original frame timestamps, ready for
+``promtool tsdb create-blocks-from openmetrics``. Works on any platform.
+"""
+
+from __future__ import annotations
+
+import argparse
+import mmap
+import os
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, TextIO, Tuple
+
+from prometheus_client.utils import floatToGoString
+
+from asitop_exporter.collector import SnapshotCollector
+from asitop_exporter.exporter import PowerHistory, derive_sample
+from asitop_exporter.parsers import parse_frame, unix_time
+from asitop_exporter.reader import FRAME_SEPARATOR, split_frames
+from asitop_exporter.utils import get_ip_address
+
+
+# (path, start offset, end offset) of a run of whole frames
+Chunk = Tuple[str, int, int]
+
+
+def split_capture(path: str, chunk_size: int) -> List[Chunk]:
+    """Cut a capture into byte ranges of about ``chunk_size`` ending on frame separators."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            end = data.find(FRAME_SEPARATOR, min(start + chunk_size, size))
+            end = size if end < 0 else end + 1
+            chunks.append((path, start, end))
+            start = end
+    return chunks
+
+
+def parse_chunk(chunk: Chunk) -> list:
+    """Parse the frames of one chunk; runs in a worker process."""
+    path, start, end = chunk
+    with open(path, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    frames, partial = split_frames(b'', data)
+    if partial.strip():
+        frames.append(partial)
+    readings = []
+    for frame in frames:
+        try:
+            readings.append(parse_frame(frame))
+        except Exception:  # noqa: BLE001 # pylint: disable=broad-except
+            continue
+    return readings
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Series:
+    """Sample lines of one series: spilled extents of the spool file, then buffered lines."""
+
+    __slots__ = ('prefix', 'lines', 'extents')
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.lines: List[str] = []
+        # (offset, length) of the blocks already spilled, in sample order
+        self.extents: List[Tuple[int, int]] = []
+
+
+class OpenMetricsWriter:
+    """Collect timestamped samples per series and write them grouped.
+
+    OpenMetrics needs all samples of a series together, and all series of
+    a family together, but every frame adds one sample to each series.
+    Samples are buffered in memory per series; once the buffers hold
+    ``buffer_size`` characters they are all spilled, one block per series,
+    to a single temporary file, so memory stays flat for captures of any
+    length without a file per series.
+    """
+
+    def __init__(self, buffer_size: int = 16 << 20) -> None:
+        # name -> (type, unit, help, {(sample name, label values): series})
+        self.families: Dict[str, Tuple[str, str, str, Dict[tuple, Series]]] = {}
+        self.buffer_size = buffer_size
+        self.buffered = 0
+        self.spool: BinaryIO | None = None
+
+    def add(self, families: Iterable, timestamp: float) -> None:
+        suffix = f' {timestamp:.3f}\n'
+        for family in families:
+            if not family.samples:
+                continue
+            entry = self.families.get(family.name)
+            if entry is None:
+                entry = self.families[family.name] = (family.type, family.unit, family.documentation, {})
+            series_by_key = entry[3]
+            for sample in family.samples:
+                key = (sample.name, *sample.labels.values())
+                series = series_by_key.get(key)
+                if series is None:
+                    labels = ','.join(
+                        f'{name}="{escape_label_value(value)}"' for name, value in sample.labels.items()
+                    )
+                    series = series_by_key[key] = Series(f'{sample.name}{{{labels}}} ')
+                line = floatToGoString(sample.value) + suffix
+                series.lines.append(line)
+                self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.spill()
+
+    def spill(self) -> None:
+        """Append every series' buffered lines to the spool file as one block each."""
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()  # pylint: disable=consider-using-with
+        spool = self.spool
+        spool.seek(0, os.SEEK_END)
+        for _, _, _, series_by_key in self.families.values():
+            for series in series_by_key.values():
+                if series.lines:
+                    block = ''.join(series.lines).encode('utf-8')
+                    series.extents.append((spool.tell(), len(block)))
+                    spool.write(block)
+                    series.lines = []
+        self.buffered = 0
+
+    def write(self, output: TextIO) -> None:
+        spool = self.spool
+        for name, (kind, unit, documentation, series_by_key) in self.families.items():
+            output.write(f'# TYPE {name} {kind}\n')
+            if unit:
+                output.write(f'# UNIT {name} {unit}\n')
+            output.write(f'# HELP {name} {documentation}\n')
+            for series in series_by_key.values():
+                prefix = series.prefix
+                for offset, length in series.extents:
+                    spool.seek(offset)
+                    for line in spool.read(length).decode('utf-8').splitlines(keepends=True):
+                        output.write(prefix + line)
+                for line in series.lines:
+                    output.write(prefix + line)
+        output.write('# EOF\n')
+        if spool is not None:
+            spool.close()
+            self.spool = None
+
+
+def map_bounded(executor: Executor, fn: Callable, items: Iterable, ahead: int) -> Iterator:
+    """Like ``executor.map``, but with at most ``ahead`` calls submitted and not yet consumed."""
+    pending: Deque[Future] = deque()
+    for item in items:
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def replay(
+    paths: Iterable[str],
+    output: TextIO,
+    *,
+    hostname: str,
+    interval: float = 1.0,
+    jobs: int | None = None,
+    chunk_size: int = 4 << 20,
+) -> int:
+    """Replay the captures in ``paths`` into ``output``. Returns the number of frames.
+
+    Frames are parsed in parallel across ``jobs`` processes, chunk by chunk,
+    and derived in capture order in this process, so the peak and average
+    powers carry over exactly as in a live run. Only two chunks per process
+    are in flight at a time. Pass the captures in time order.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    power = PowerHistory()
+    collector = SnapshotCollector(hostname)
+    writer = OpenMetricsWriter()
+    chunks = (chunk for path in paths for chunk in split_capture(path, chunk_size))
+    count = 0
+    previous = None
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for readings in map_bounded(executor, parse_chunk, chunks, 2 * jobs):
+            for reading in readings:
+                values = derive_sample(reading, power, interval)
+                timestamp = unix_time(reading[4])
+                if previous is not None and timestamp <= previous:
+                    # Frame timestamps have second resolution; keep faster
+                    # samples apart by their elapsed time.
+                    timestamp = previous + (reading[0].get('elapsed_s') or interval)
+                previous = timestamp
+                collector.update(values, timestamp=timestamp, cpu=collector.cpu_sample(reading[0]['cpu']))
+                writer.add(collector.collect(), timestamp)
+                count += 1
+    writer.write(output)
+    return count
+
+
+def iter_paths(paths: Iterable[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            yield path
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='asitop-exporter replay',
+        description='Replay recorded powermetrics plist captures into OpenMetrics text with the\n'
+                    'original sample timestamps, e.g. for `promtool tsdb create-blocks-from openmetrics`.',
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        'captures',
+        nargs='+',
+        metavar='CAPTURE',
+        help='powermetrics -f plist output files (or directories of them), in time order',
+    )
+    parser.add_argument(
+        '--output',
+        '-o',
+        dest='output',
+        type=str,
+        default='-',
+        metavar='PATH',
+        help='OpenMetrics output file. (default: stdout)',
+    )
+    parser.add_argument(
+        '--hostname',
+        '--host',
+        '-H',
+        dest='hostname',
+        type=str,
+        default=get_ip_address(),
+        metavar='HOSTNAME',
+        help='hostname label of the replayed metrics. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--interval',
+        dest='interval',
+        type=float,
+        default=1.0,
+        metavar='SEC',
+        help='sampling interval of the capture, used only for frames without elapsed_ns. (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        dest='jobs',
+        type=int,
+        default=None,
+        metavar='N',
+        help='parser processes. (default: number of CPUs)',
+    )
+    args = parser.parse_args(argv)
+
+    paths = list(iter_paths(args.captures))
+    if args.output == '-':
+        count = replay(paths, sys.stdout, hostname=args.hostname, interval=args.interval, jobs=args.jobs)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            count = replay(paths, output, hostname=args.hostname, interval=args.interval, jobs=args.jobs)
+    print(f'INFO: Replayed {count} frames from {len(paths)} captures.', file=sys.stderr)
+    return 0
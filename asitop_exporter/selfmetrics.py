@@ -0,0 +1,177 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Metrics about the exporter itself: hot path timings, staleness and overhead."""
+
+from __future__ import annotations
+
+import os
+import time
+from typing import Callable, Iterator
+
+import psutil
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+
+
+# Parsing, updating and rendering take micro- to milliseconds.
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class ProcessCollector(Collector):
+    """CPU time and RSS of the exporter and of its powermetrics child, via psutil.
+
+    ``child`` returns the ``Popen`` of the running powermetrics command (or
+    ``None``). That is ``sudo nice ... powermetrics``, so the powermetrics
+    process itself is looked up among its descendants; the lookup is cached
+    until the child is replaced.
+    """
+
+    def __init__(self, child: Callable[[], object]) -> None:
+        self.child = child
+        self.exporter = psutil.Process()
+        self.child_pid = None
+        self.child_processes = []
+
+    def child_process_list(self) -> list:
+        popen = self.child()
+        pid = getattr(popen, 'pid', None)
+        if pid != self.child_pid:
+            self.child_pid = pid
+            self.child_processes = []
+            if pid is not None:
+                try:
+                    parent = psutil.Process(pid)
+                    children = parent.children(recursive=True)
+                    powermetrics = [child for child in children if child.name() == 'powermetrics']
+                    self.child_processes = powermetrics or [parent, *children]
+                except psutil.Error:
+                    # Not started yet, or not ours to inspect; retry on the next scrape.
+                    self.child_pid = None
+        return self.child_processes
+
+    def describe(self) -> Iterator[Metric]:
+        yield CounterMetricFamily(
+            'asitop_exporter_process_cpu_seconds',
+            'CPU time of the exporter and of the powermetrics child.',
+            labels=['process'],
+        )
+        yield GaugeMetricFamily(
+            'asitop_exporter_process_resident_memory_bytes',
+            'Resident memory of the exporter and of the powermetrics child.',
+            labels=['process'],
+        )
+
+    def collect(self) -> Iterator[Metric]:
+        cpu = CounterMetricFamily(
+            'asitop_exporter_process_cpu_seconds',
+            'CPU time of the exporter and of the powermetrics child.',
+            labels=['process'],
+        )
+        rss = GaugeMetricFamily(
+            'asitop_exporter_process_resident_memory_bytes',
+            'Resident memory of the exporter and of the powermetrics child.',
+            labels=['process'],
+        )
+        for label, processes in (('exporter', [self.exporter]), ('powermetrics', self.child_process_list())):
+            if not processes:
+                continue
+            seconds = 0.0
+            resident = 0
+            try:
+                for process in processes:
+                    with process.oneshot():
+                        times = process.cpu_times()
+                        seconds += times.user + times.system
+                        resident += process.memory_info().rss
+            except psutil.Error:
+                self.child_pid = None
+                continue
+            cpu.add_metric([label], seconds)
+            rss.add_metric([label], resident)
+        yield cpu
+        yield rss
+
+
+class SelfMetrics:  # pylint: disable=too-many-instance-attributes
+    """Self-instrumentation of the exporter, in a registry of its own.
+
+    The exporter adds the registry to the one it serves unless started with
+    ``--no_self_metrics``, in which case nothing is timed or collected.
+    """
+
+    def __init__(
+        self,
+        child: Callable[[], object],
+        frame_time: Callable[[], float | None],
+        output_file: Callable[[], str | None],
+    ) -> None:
+        self.registry = CollectorRegistry()
+        self.frame_time = frame_time
+        self.output_file = output_file
+
+        self.parse = Histogram(
+            name='asitop_exporter_parse_duration_seconds',
+            documentation='Time spent decoding and parsing the powermetrics frames of one read.',
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.update = Histogram(
+            name='asitop_exporter_update_duration_seconds',
+            documentation='Time spent ingesting and publishing the frames of one read, not counting the wait for them.',
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.render = Histogram(
+            name='asitop_exporter_render_duration_seconds',
+            documentation='Time spent rendering a /metrics body (cache misses only).',
+            buckets=DURATION_BUCKETS,
+            registry=self.registry,
+        )
+        self.retries = Counter(
+            name='asitop_exporter_reading_retries',
+            documentation='Times get_reading waited a second without a new frame, in file and stream mode.',
+            registry=self.registry,
+        )
+        self.sample_age = Gauge(
+            name='asitop_exporter_sample_age_seconds',
+            documentation='Age of the newest powermetrics frame (now minus its timestamp).',
+            registry=self.registry,
+        )
+        self.sample_age.set_function(self.current_sample_age)
+        self.file_size = Gauge(
+            name='asitop_exporter_powermetrics_file_bytes',
+            documentation='Size of the powermetrics output file (0 when reading its pipe).',
+            registry=self.registry,
+        )
+        self.file_size.set_function(self.current_file_size)
+        self.registry.register(ProcessCollector(child))
+
+    def current_sample_age(self) -> float:
+        timestamp = self.frame_time()
+        if timestamp is None:
+            return float('nan')
+        return time.time() - timestamp
+
+    def current_file_size(self) -> float:
+        path = self.output_file()
+        if path is None:
+            return 0
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
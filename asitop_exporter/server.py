@@ -0,0 +1,402 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""HTTP endpoints of ``asitop-exporter``."""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import math
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from typing import Callable, Dict, List, Mapping, NamedTuple, Tuple
+from urllib.parse import parse_qs, unquote
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+from prometheus_client import CollectorRegistry, Histogram
+from prometheus_client.exposition import ThreadingWSGIServer, choose_encoder
+
+from asitop_exporter.collector import HOST_METRICS, Snapshot
+from asitop_exporter.history import HistoryStore, encode_range
+
+
+class Response(NamedTuple):
+    status: str
+    headers: List[Tuple[str, str]]
+    body: bytes
+
+
+def text_response(status: str, text: str) -> Response:
+    return Response(status, [('Content-Type', 'text/plain; charset=utf-8')], text.encode('utf-8'))
+
+
+def history_aliases() -> Dict[str, str]:
+    """Map exported metric names (with and without unit) to history keys."""
+    aliases = {}
+    for spec in HOST_METRICS:
+        aliases[spec.key] = spec.key
+        aliases[spec.name] = spec.key
+        aliases[f'{spec.name}_{spec.unit}'] = spec.key
+    return aliases
+
+
+# Bodies differ by content type and encoding; caches must key on both.
+VARY = ('Vary', 'Accept, Accept-Encoding')
+
+
+class CachedBody(NamedTuple):
+    body: bytes
+    headers: List[Tuple[str, str]]
+    etag: str
+
+
+class ExpositionCache:
+    """``/metrics`` bodies rendered once per published sample.
+
+    Each representation (text or OpenMetrics, plain or gzip) is rendered on
+    first request after a new sample and then served as cached bytes with an
+    ``ETag`` until the next one, so scrape cost no longer depends on how
+    often or by how many clients the exporter is scraped. Other metrics in
+    the registry (e.g. the sink counters) are therefore refreshed once per
+    sample too, or at least every ``max_age`` seconds if it is set, so that
+    e.g. the sample age keeps growing while the sampler is stalled.
+    """
+
+    def __init__(
+        self,
+        registry: CollectorRegistry,
+        snapshot: Callable[[], Snapshot],
+        max_age: float | None = None,
+        render_time: Histogram | None = None,
+    ) -> None:
+        self.registry = registry
+        self.snapshot = snapshot
+        self.max_age = max_age
+        self.render_time = render_time
+        # Versions restart at zero, keep ETags from another run from matching.
+        self.instance = os.urandom(4).hex()
+        self.lock = threading.Lock()
+        self.version = None
+        # Bumped on every re-render, including expiry without a new sample.
+        self.generation = 0
+        self.expires = math.inf
+        self.bodies: Dict[Tuple[str, bool], CachedBody] = {}
+
+    def get(self, accept: str | None, compress: bool) -> CachedBody:
+        snapshot = self.snapshot()
+        encoder, content_type = choose_encoder(accept)
+        key = (content_type, compress)
+        with self.lock:
+            now = time.monotonic()
+            if snapshot.version != self.version or now >= self.expires:
+                self.version = snapshot.version
+                self.generation += 1
+                if self.max_age is not None:
+                    self.expires = now + self.max_age
+                self.bodies = {}
+            cached = self.bodies.get(key)
+            if cached is None:
+                cached = self.bodies[key] = self.render(snapshot, encoder, content_type, compress)
+        return cached
+
+    def render(self, snapshot: Snapshot, encoder: Callable, content_type: str, compress: bool) -> CachedBody:
+        start = time.perf_counter()
+        body = encoder(self.registry)
+        variant = 'om' if content_type.startswith('application/openmetrics-text') else 'text'
+        headers = [('Content-Type', content_type), VARY]
+        if compress:
+            body = gzip.compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+            variant += '-gzip'
+        etag = f'"{self.instance}-{self.generation}-{variant}"'
+        headers.append(('ETag', etag))
+        if snapshot.timestamp:
+            headers.append(('Last-Modified', formatdate(snapshot.timestamp, usegmt=True)))
+        if self.render_time is not None:
+            self.render_time.observe(time.perf_counter() - start)
+        return CachedBody(body, headers, etag)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+class WSGIApp:
+    """Base of the HTTP applications: :meth:`handle` answers one request
+    independently of the server in front of it, calling the instance makes
+    it a WSGI application."""
+
+    def handle(self, method: str, path: str, query_string: str, headers: Mapping[str, str]) -> Response:
+        raise NotImplementedError
+
+    def __call__(self, environ: dict, start_response: Callable) -> List[bytes]:
+        headers = {
+            key[5:].replace('_', '-').lower(): value
+            for key, value in environ.items()
+            if key.startswith('HTTP_')
+        }
+        response = self.handle(
+            environ['REQUEST_METHOD'],
+            environ.get('PATH_INFO', '/'),
+            environ.get('QUERY_STRING', ''),
+            headers,
+        )
+        start_response(response.status, response.headers + [('Content-Length', str(len(response.body)))])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
+        return [response.body]
+
+
+class ExporterApp(WSGIApp):
+    """Route requests to ``/metrics`` and the history API."""
+
+    def __init__(
+        self,
+        registry: CollectorRegistry,
+        history: HistoryStore | None = None,
+        snapshot: Callable[[], Snapshot] | None = None,
+        max_age: float | None = None,
+        render_time: Histogram | None = None,
+    ) -> None:
+        self.registry = registry
+        self.history = history
+        self.render_time = render_time
+        # With the current snapshot at hand, bodies are cached per sample.
+        self.cache = None
+        if snapshot is not None:
+            self.cache = ExpositionCache(registry, snapshot, max_age=max_age, render_time=render_time)
+        self.aliases = history_aliases()
+        self.routes: Dict[str, Callable[[Mapping[str, List[str]], Mapping[str, str]], Response]] = {
+            '/metrics': self.metrics,
+            '/api/v1/range': self.range,
+        }
+
+    def handle(self, method: str, path: str, query_string: str, headers: Mapping[str, str]) -> Response:
+        """Answer one request. ``headers`` are keyed by lower-case header name."""
+        route = self.routes.get(path)
+        if route is None:
+            # Like prometheus_client's WSGI app, serve the metrics on any other path.
+            if path.startswith('/api/'):
+                return text_response('404 Not Found', 'Not Found\n')
+            route = self.metrics
+        if method not in ('GET', 'HEAD'):
+            return text_response('405 Method Not Allowed', 'Method Not Allowed\n')
+        return route(parse_qs(query_string), headers)
+
+    def metrics(self, params: Mapping[str, List[str]], headers: Mapping[str, str]) -> Response:
+        compress = 'gzip' in headers.get('accept-encoding', '')
+        if self.cache is not None and 'name[]' not in params:
+            cached = self.cache.get(headers.get('accept'), compress)
+            if etag_matches(headers.get('if-none-match', ''), cached.etag):
+                return Response('304 Not Modified', [VARY, ('ETag', cached.etag)], b'')
+            return Response('200 OK', cached.headers, cached.body)
+
+        encoder, content_type = choose_encoder(headers.get('accept'))
+        registry = self.registry
+        if 'name[]' in params:
+            registry = registry.restricted_registry(params['name[]'])
+        start = time.perf_counter()
+        body = encoder(registry)
+        if self.render_time is not None:
+            self.render_time.observe(time.perf_counter() - start)
+        response_headers = [('Content-Type', content_type), VARY]
+        if compress:
+            body = gzip.compress(body)
+            response_headers.append(('Content-Encoding', 'gzip'))
+        return Response('200 OK', response_headers, body)
+
+    def range(self, params: Mapping[str, List[str]], headers: Mapping[str, str]) -> Response:
+        if self.history is None:
+            return text_response('404 Not Found', 'History is disabled, start with --history_size.\n')
+        metric = params.get('metric', [''])[0]
+        key = self.aliases.get(metric)
+        if key is None or key not in self.history.index:
+            return Response(
+                '400 Bad Request',
+                [('Content-Type', 'application/json')],
+                json.dumps({'error': f'unknown metric {metric!r}', 'metrics': list(self.history.keys)}).encode('utf-8'),
+            )
+        try:
+            start = float(params.get('start', ['-inf'])[0])
+            end = float(params.get('end', ['inf'])[0])
+        except ValueError:
+            return text_response('400 Bad Request', 'start and end must be unix timestamps.\n')
+        if math.isnan(start) or math.isnan(end):
+            return text_response('400 Bad Request', 'start and end must be unix timestamps.\n')
+        timestamps, values = self.history.query(key, start, end)
+        content_type, body = encode_range(metric, timestamps, values, params.get('format', ['json'])[0])
+        return Response('200 OK', [('Content-Type', content_type)], body)
+
+
+class _SilentHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log nothing."""
+
+
+def _get_best_family(address: str, port: int) -> Tuple[int, str]:
+    # Same address family selection as prometheus_client.start_wsgi_server.
+    infos = socket.getaddrinfo(address, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    family, _, _, _, sockaddr = next(iter(infos))
+    return family, sockaddr[0]
+
+
+def start_wsgi_server(
+    app: WSGIApp,
+    port: int,
+    addr: str = '0.0.0.0',
+    name: str = 'metrics-server',
+) -> Tuple[ThreadingWSGIServer, threading.Thread]:
+    """Serve ``app`` from a daemon thread, one thread per request."""
+    ThreadingWSGIServer.address_family, addr = _get_best_family(addr, port)
+    httpd = make_server(addr, port, app, ThreadingWSGIServer, handler_class=_SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name=name, daemon=True)
+    thread.start()
+    return httpd, thread
+
+
+def parse_request_head(head: bytes) -> Tuple[str, str, str, Dict[str, str]] | None:
+    """Split an HTTP/1.x request head into method, target, version and headers."""
+    try:
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        return None
+    if not version.startswith('HTTP/1.'):
+        return None
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def encode_response(response: Response, *, head_only: bool = False, keep_alive: bool = True) -> bytes:
+    lines = [f'HTTP/1.1 {response.status}']
+    lines.extend(f'{name}: {value}' for name, value in response.headers)
+    lines.append(f'Content-Length: {len(response.body)}')
+    lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    return head if head_only else head + response.body
+
+
+class AsyncioHTTPServer:
+    """Serve an :class:`ExporterApp` from an asyncio event loop.
+
+    Connections are kept alive (HTTP/1.1 semantics, ``Connection: close``
+    honoured) and multiplexed on one loop, so idle or slow clients cost no
+    threads. Reading a request and writing its response are each bounded by
+    ``timeout`` seconds, after which the connection is dropped, so one slow
+    client cannot hold up the others. :meth:`ExporterApp.handle` runs on a
+    small thread pool to keep the loop responsive while a body is rendered.
+    """
+
+    def __init__(self, app: ExporterApp, *, timeout: float = 10.0, max_workers: int = 4) -> None:
+        self.app = app
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='metrics-render')
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    @property
+    def server_port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    def bind(self, addr: str, port: int) -> None:
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, addr, port, reuse_address=True),
+        )
+
+    def serve_forever(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def shutdown(self, timeout: float | None = None) -> None:
+        """Close the listener and all open connections, then stop the loop."""
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(timeout)
+        self.executor.shutdown(wait=False)
+
+    async def _close(self) -> None:
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.call_soon(self.loop.stop)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                request = parse_request_head(head[:-4])
+                if request is None:
+                    writer.write(encode_response(text_response('400 Bad Request', 'Bad Request\n'), keep_alive=False))
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                    break
+                method, target, version, headers = request
+                length = int(headers.get('content-length', '0') or 0)
+                if length:
+                    # Request bodies are not used, read them off the connection.
+                    await asyncio.wait_for(reader.readexactly(length), self.timeout)
+
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                path, _, query_string = target.partition('?')
+                response = await loop.run_in_executor(
+                    self.executor, self.app.handle, method, unquote(path), query_string, headers,
+                )
+                writer.write(encode_response(response, head_only=method == 'HEAD', keep_alive=keep_alive))
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Shutting down. Returning normally keeps asyncio.streams from
+            # logging the cancellation as an unhandled error.
+            pass
+        finally:
+            writer.close()
+
+
+def start_asyncio_server(
+    app: ExporterApp,
+    port: int,
+    addr: str = '0.0.0.0',
+    timeout: float = 10.0,
+) -> Tuple[AsyncioHTTPServer, threading.Thread]:
+    """Serve ``app`` from an asyncio event loop in a daemon thread."""
+    httpd = AsyncioHTTPServer(app, timeout=timeout)
+    httpd.bind(addr, port)
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    return httpd, thread
@@ -0,0 +1,424 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Output sinks fed with every published sample."""
+
+from __future__ import annotations
+
+import gzip
+import json
+import queue
+import random
+import socket
+import threading
+import time
+from typing import Any, List, Mapping, NamedTuple
+from uuid import uuid4
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+
+from asitop_exporter.collector import SnapshotCollector
+from asitop_exporter.history import HistoryStore
+from asitop_exporter.payload import PayloadEncoder
+
+
+class Sample(NamedTuple):
+    """One published sample, as handed to every sink."""
+
+    timestamp: float  # unix time
+    values: Mapping[str, float]
+    cpu: Any = None  # collector.CpuSample
+    window: Any = None  # {key: WindowStats}
+    quantiles: Any = None  # QuantileTracker.summary()
+    tasks: Any = None  # TaskAggregator.top()
+
+
+class SinkMetrics:
+    """Throughput, drop, error and lag metrics shared by all sinks, labelled by sink.
+
+    The write latency is a timing of the exporter itself, so it goes to
+    ``latency_registry`` (the self-metrics registry) instead; with ``None``
+    it is kept but not exported.
+    """
+
+    def __init__(
+        self,
+        registry: CollectorRegistry | None = None,
+        latency_registry: CollectorRegistry | None = None,
+    ) -> None:
+        self.written = Counter(
+            name='asitop_exporter_sink_samples_written',
+            documentation='Samples written by each output sink.',
+            labelnames=['sink'],
+            registry=registry,
+        )
+        self.dropped = Counter(
+            name='asitop_exporter_sink_samples_dropped',
+            documentation='Samples dropped by each output sink because its queue was full or the write failed.',
+            labelnames=['sink'],
+            registry=registry,
+        )
+        self.failures = Counter(
+            name='asitop_exporter_sink_failures',
+            documentation='Failed write attempts of each output sink, including retried ones.',
+            labelnames=['sink'],
+            registry=registry,
+        )
+        self.queue_depth = Gauge(
+            name='asitop_exporter_sink_queue_depth',
+            documentation='Samples waiting in the queue of each output sink.',
+            labelnames=['sink'],
+            registry=registry,
+        )
+        self.lag = Gauge(
+            name='asitop_exporter_sink_lag_seconds',
+            documentation='Age of the newest sample written by each output sink when it was written.',
+            labelnames=['sink'],
+            registry=registry,
+        )
+        self.latency = Histogram(
+            name='asitop_exporter_sink_write_latency_seconds',
+            documentation='Duration of the successful writes of each output sink.',
+            labelnames=['sink'],
+            registry=latency_registry,
+        )
+
+
+class Sink:
+    """An output written synchronously from the sampling thread.
+
+    Only suitable for cheap, local outputs. Anything that can block belongs
+    in a :class:`QueuedSink`.
+    """
+
+    name = 'sink'
+    # Set by sinks whose write() counts each of its failed attempts itself.
+    counts_failures = False
+
+    def bind(self, metrics: SinkMetrics) -> None:
+        self.written = metrics.written.labels(self.name)
+        self.dropped = metrics.dropped.labels(self.name)
+        self.failures = metrics.failures.labels(self.name)
+        self.lag = metrics.lag.labels(self.name)
+        self.latency = metrics.latency.labels(self.name)
+
+    def start(self) -> None:
+        pass
+
+    def stop(self, timeout: float | None = None) -> None:
+        pass
+
+    def offer(self, sample: Sample) -> bool:
+        self._write([sample])
+        return True
+
+    def _write(self, samples: List[Sample]) -> None:
+        start = time.monotonic()
+        counted = self.counts_failures
+        try:
+            ok = self.write(samples)
+        except Exception:  # pylint: disable=broad-except
+            ok = counted = False
+        if not ok:
+            if not counted:
+                self.failures.inc()
+            self.dropped.inc(len(samples))
+            return
+        self.latency.observe(time.monotonic() - start)
+        self.written.inc(len(samples))
+        self.lag.set(time.time() - samples[-1].timestamp)
+
+    def write(self, samples: List[Sample]) -> bool:
+        """Write ``samples``, returning ``False`` (or raising) if they were lost."""
+        raise NotImplementedError
+
+
+class QueuedSink(Sink):
+    """An output written from its own worker thread through a bounded queue.
+
+    :meth:`offer` never blocks: when the queue is full the sample is dropped
+    and counted, so a slow or failing sink loses only its own data and never
+    stalls sampling or the other sinks. The worker writes up to
+    ``batch_size`` queued samples at once, waiting at most ``linger``
+    seconds to fill a batch.
+    """
+
+    def __init__(self, queue_size: int = 64, batch_size: int = 1, linger: float = 0.0) -> None:
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'{self.name}-sink', daemon=True)
+
+    def bind(self, metrics: SinkMetrics) -> None:
+        super().bind(metrics)
+        metrics.queue_depth.labels(self.name).set_function(self.queue.qsize)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def offer(self, sample: Sample) -> bool:
+        try:
+            self.queue.put_nowait(sample)
+        except queue.Full:
+            self.dropped.inc()
+            return False
+        return True
+
+    def _next_batch(self) -> List[Sample]:
+        batch = [self.queue.get(timeout=0.5)]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                batch = self._next_batch()
+            except queue.Empty:
+                continue
+            self._write(batch)
+
+
+class PrometheusSink(Sink):
+    """Publish the sample to ``/metrics`` by swapping the collector's snapshot."""
+
+    name = 'prometheus'
+
+    def __init__(self, collector: SnapshotCollector) -> None:
+        self.collector = collector
+
+    def write(self, samples: List[Sample]) -> bool:
+        for sample in samples:
+            self.collector.update(
+                sample.values,
+                timestamp=sample.timestamp,
+                cpu=sample.cpu,
+                window=sample.window,
+                quantiles=sample.quantiles,
+                tasks=sample.tasks,
+            )
+        return True
+
+
+class HistorySink(Sink):
+    """Append the host metrics to the ``/api/v1/range`` history."""
+
+    name = 'history'
+
+    def __init__(self, history: HistoryStore) -> None:
+        self.history = history
+
+    def write(self, samples: List[Sample]) -> bool:
+        for sample in samples:
+            self.history.append(sample.timestamp, sample.values)
+        return True
+
+    def stop(self, timeout: float | None = None) -> None:
+        self.history.close()
+
+
+class HttpJsonSink(QueuedSink):  # pylint: disable=too-many-instance-attributes
+    """Post the samples as JSON to ``url`` (``--post_url``).
+
+    Batches are encoded with :class:`~asitop_exporter.payload.PayloadEncoder`
+    into one JSON array, optionally gzipped, and sent over a keep-alive
+    session. Failed requests (5xx, 429 or no response) are retried with
+    exponential backoff and full jitter; other 4xx responses reject the
+    batch at once. Every failed attempt is counted.
+    """
+
+    name = 'http'
+    counts_failures = True
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        url: str,
+        encoder: PayloadEncoder,
+        *,
+        queue_size: int = 64,
+        batch_size: int = 1,
+        linger: float = 0.0,
+        compress: bool = False,
+        timeout: float = 5.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30.0,
+    ) -> None:
+        super().__init__(queue_size=queue_size, batch_size=batch_size, linger=linger)
+        self.url = url
+        self.encoder = encoder
+        self.compress = compress
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.headers['Content-type'] = 'application/json'
+        if compress:
+            self.session.headers['Content-Encoding'] = 'gzip'
+
+    def stop(self, timeout: float | None = None) -> None:
+        super().stop(timeout)
+        self.session.close()
+
+    def write(self, samples: List[Sample]) -> bool:
+        payloads = [
+            self.encoder.encode(sample.values, int(sample.timestamp * 1000), str(uuid4()))
+            for sample in samples
+        ]
+        body = b'[' + b', '.join([payload for payload in payloads if payload]) + b']'
+        if self.compress:
+            body = gzip.compress(body)
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+                if response.status_code < 300:
+                    return True
+                if response.status_code < 500 and response.status_code != 429:
+                    # The receiver rejected the batch, retrying will not help.
+                    self.failures.inc()
+                    return False
+            except RequestException:
+                pass
+            self.failures.inc()
+            if attempt == self.retries:
+                break
+            delay = random.uniform(0.0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if self._stop.wait(delay):
+                break
+        return False
+
+
+class StatsdSink(QueuedSink):
+    """Send the samples as StatsD gauges over UDP.
+
+    Each metric becomes ``<prefix>.<key>:<value>|g``, tagged DogStatsD-style
+    with the hostname unless ``tags`` is false. Lines are packed into
+    datagrams of at most ``max_datagram`` bytes.
+    """
+
+    name = 'statsd'
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        address: str,
+        hostname: str,
+        *,
+        prefix: str = 'asitop',
+        tags: bool = True,
+        max_datagram: int = 1432,
+        queue_size: int = 64,
+    ) -> None:
+        super().__init__(queue_size=queue_size)
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port or 8125))
+        self.prefix = prefix
+        self.suffix = f'|g|#hostname:{hostname}'.encode('utf-8') if tags else b'|g'
+        self.max_datagram = max_datagram
+        self.socket = socket.socket(socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def stop(self, timeout: float | None = None) -> None:
+        super().stop(timeout)
+        self.socket.close()
+
+    def datagrams(self, samples: List[Sample]) -> List[bytes]:
+        datagrams = []
+        current = b''
+        for sample in samples:
+            for key, value in sample.values.items():
+                line = f'{self.prefix}.{key}:{value:g}'.encode('utf-8') + self.suffix
+                if current and len(current) + 1 + len(line) > self.max_datagram:
+                    datagrams.append(current)
+                    current = b''
+                current = current + b'\n' + line if current else line
+        if current:
+            datagrams.append(current)
+        return datagrams
+
+    def write(self, samples: List[Sample]) -> bool:
+        for datagram in self.datagrams(samples):
+            self.socket.sendto(datagram, self.address)
+        return True
+
+
+class JsonLinesSink(QueuedSink):
+    """Append one JSON object per sample to a file (newline-delimited JSON)."""
+
+    name = 'jsonl'
+
+    def __init__(self, path: str, hostname: str, *, queue_size: int = 64) -> None:
+        super().__init__(queue_size=queue_size, batch_size=queue_size)
+        self.path = path
+        self.hostname = hostname
+        self.file = open(path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+
+    def stop(self, timeout: float | None = None) -> None:
+        super().stop(timeout)
+        self.file.close()
+
+    def write(self, samples: List[Sample]) -> bool:
+        lines = [
+            json.dumps({'timestamp': sample.timestamp, 'hostname': self.hostname, **sample.values}) + '\n'
+            for sample in samples
+        ]
+        self.file.writelines(lines)
+        self.file.flush()
+        return True
+
+
+class SinkPipeline:
+    """Fan every published sample out to all configured sinks."""
+
+    def __init__(
+        self,
+        registry: CollectorRegistry | None = None,
+        latency_registry: CollectorRegistry | None = None,
+    ) -> None:
+        self.metrics = SinkMetrics(registry, latency_registry)
+        self.sinks: List[Sink] = []
+
+    def add(self, sink: Sink) -> Sink:
+        sink.bind(self.metrics)
+        self.sinks.append(sink)
+        return sink
+
+    def start(self) -> SinkPipeline:
+        for sink in self.sinks:
+            sink.start()
+        return self
+
+    def stop(self, timeout: float | None = None) -> None:
+        for sink in self.sinks:
+            sink.stop(timeout)
+
+    def publish(self, sample: Sample) -> None:
+        for sink in self.sinks:
+            sink.offer(sample)
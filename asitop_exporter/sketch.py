@@ -0,0 +1,192 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Mergeable streaming quantile sketches over sliding time windows."""
+
+from __future__ import annotations
+
+import math
+import time
+from collections import deque
+from typing import Dict, Iterable, Mapping, NamedTuple, Sequence, Tuple
+
+
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class DDSketch:
+    """Quantile sketch with bounded relative error (DDSketch).
+
+    Positive values are counted in logarithmically sized buckets, so every
+    quantile is estimated within ``relative_accuracy`` of the true value.
+    At most ``max_bins`` buckets are kept; beyond that the lowest buckets
+    are collapsed into one, which only affects the lowest quantiles. Values
+    at or below ``min_value`` are counted as zero. Sketches with the same
+    parameters can be merged.
+    """
+
+    def __init__(
+        self,
+        relative_accuracy: float = 0.01,
+        max_bins: int = 1024,
+        min_value: float = 1e-9,
+    ) -> None:
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if value <= self.min_value:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        bins = self.bins
+        bins[index] = bins.get(index, 0) + 1
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        indices = sorted(self.bins)
+        excess = len(indices) - self.max_bins + 1
+        target = indices[excess]
+        collapsed = sum(self.bins.pop(index) for index in indices[:excess])
+        self.bins[target] += collapsed
+
+    def merge(self, other: DDSketch) -> None:
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def quantile(self, q: float) -> float:
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs: Iterable[float]) -> list:
+        """Estimate several quantiles with one pass over the sorted buckets."""
+        qs = list(qs)
+        if self.count == 0:
+            return [math.nan] * len(qs)
+        order = sorted(range(len(qs)), key=qs.__getitem__)
+        results = [0.0] * len(qs)
+        buckets = sorted(self.bins.items())
+        position = 0
+        seen = self.zero_count
+        for i in order:
+            rank = qs[i] * (self.count - 1)
+            if rank < self.zero_count or not buckets:
+                results[i] = 0.0
+                continue
+            while position < len(buckets) - 1 and seen + buckets[position][1] <= rank:
+                seen += buckets[position][1]
+                position += 1
+            results[i] = 2 * self.gamma ** buckets[position][0] / (self.gamma + 1)
+        return results
+
+
+class WindowedSketch:
+    """A sketch of the values added during the last ``window`` seconds.
+
+    The window is split into ``slices`` sub-sketches. Slices older than the
+    window are dropped, so memory stays fixed and the reported distribution
+    trails the true sliding window by at most one slice.
+    """
+
+    def __init__(self, window: float, slices: int = 6, **sketch_options) -> None:
+        self.window = window
+        self.slices = slices
+        self.slice_length = window / slices
+        self.sketch_options = sketch_options
+        self.parts = deque(maxlen=slices)
+
+    def add(self, value: float, now: float) -> None:
+        index = int(now // self.slice_length)
+        if not self.parts or self.parts[-1][0] != index:
+            self.parts.append((index, DDSketch(**self.sketch_options)))
+        self.parts[-1][1].add(value)
+
+    def merged(self, now: float) -> DDSketch:
+        oldest = int(now // self.slice_length) - self.slices + 1
+        sketch = DDSketch(**self.sketch_options)
+        for index, part in self.parts:
+            if index >= oldest:
+                sketch.merge(part)
+        return sketch
+
+
+class QuantileSummary(NamedTuple):
+    count: int  # since start, like a Prometheus summary's _count
+    sum: float  # since start
+    quantiles: Tuple[float, ...]  # over the window
+
+
+class QuantileTracker:
+    """Windowed sketches for a set of metrics and window lengths.
+
+    Only the quantiles are windowed. The count and sum are cumulative, so
+    the exported ``_count`` and ``_sum`` never decrease and ``rate()`` over
+    them works as for any other Prometheus summary.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable[str],
+        windows: Sequence[float],
+        quantiles: Sequence[float] = DEFAULT_QUANTILES,
+        relative_accuracy: float = 0.01,
+    ) -> None:
+        self.keys = tuple(keys)
+        self.windows = tuple(windows)
+        self.quantiles = tuple(quantiles)
+        self.sketches = {
+            key: {window: WindowedSketch(window, relative_accuracy=relative_accuracy) for window in self.windows}
+            for key in self.keys
+        }
+        self.counts = dict.fromkeys(self.keys, 0)
+        self.sums = dict.fromkeys(self.keys, 0.0)
+
+    def add(self, values: Mapping[str, float], now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        for key, windows in self.sketches.items():
+            value = values[key]
+            self.counts[key] += 1
+            self.sums[key] += value
+            for sketch in windows.values():
+                sketch.add(value, now)
+
+    def summary(self, now: float | None = None) -> Dict[str, Dict[float, QuantileSummary]]:
+        """Return ``{key: {window: QuantileSummary}}`` for the current windows."""
+        now = time.monotonic() if now is None else now
+        summary = {}
+        for key, windows in self.sketches.items():
+            summary[key] = {}
+            for window, sketch in windows.items():
+                summary[key][window] = QuantileSummary(
+                    self.counts[key],
+                    self.sums[key],
+                    tuple(sketch.merged(now).quantiles(self.quantiles)),
+                )
+        return summary
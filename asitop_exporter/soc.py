@@ -0,0 +1,177 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Apple Silicon SoC discovery with an on-disk cache."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, NamedTuple, Sequence
+
+
+CommandRunner = Callable[[Sequence[str]], str]
+
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'asitop_exporter', 'soc_info.json')
+
+CPU_KEYS = ('machdep.cpu.brand_string', 'machdep.cpu.core_count')
+CORE_COUNT_KEYS = ('hw.perflevel0.logicalcpu', 'hw.perflevel1.logicalcpu')
+# Identify the machine and the current boot; a new boot or an OS update
+# invalidates the cache.
+FINGERPRINT_KEYS = ('hw.model', 'kern.osversion', 'kern.uuid', 'kern.bootsessionuuid')
+
+
+class SocLimits(NamedTuple):
+    cpu_max_power: int  # W
+    gpu_max_power: int  # W
+    cpu_max_bw: int  # GB/s
+    gpu_max_bw: int  # GB/s
+
+
+SOC_LIMITS: Dict[str, SocLimits] = {
+    'Apple M1': SocLimits(20, 20, 70, 70),
+    'Apple M1 Pro': SocLimits(30, 30, 200, 200),
+    'Apple M1 Max': SocLimits(30, 60, 250, 400),
+    'Apple M1 Ultra': SocLimits(60, 120, 500, 800),
+    'Apple M2': SocLimits(25, 15, 100, 100),
+}
+DEFAULT_LIMITS = SocLimits(20, 20, 70, 70)
+
+
+def run_command(command: Sequence[str]) -> str:
+    """Run ``command`` and return its stdout, or ``''`` if it cannot be run."""
+    try:
+        return subprocess.run(
+            list(command),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=30,
+            check=False,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def query_sysctl(keys: Iterable[str], run: CommandRunner = run_command) -> Dict[str, str]:
+    """Read only the given sysctl ``keys`` with a single ``sysctl`` call."""
+    keys = tuple(keys)
+    values = {}
+    for line in run(('sysctl', *keys)).splitlines():
+        key, sep, value = line.partition(':')
+        if sep and key in keys:
+            values[key] = value.strip()
+    return values
+
+
+def query_gpu_cores(run: CommandRunner = run_command) -> int | str:
+    output = run(('system_profiler', '-detailLevel', 'basic', 'SPDisplaysDataType'))
+    for line in output.splitlines():
+        if 'Total Number of Cores' in line:
+            try:
+                return int(line.split(': ')[-1])
+            except ValueError:
+                break
+    return '?'
+
+
+def fingerprint(run: CommandRunner = run_command) -> str | None:
+    values = query_sysctl(FINGERPRINT_KEYS, run)
+    if not values:
+        return None
+    digest = hashlib.sha256()
+    for key in FINGERPRINT_KEYS:
+        digest.update(f'{key}={values.get(key, "")}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_soc_info(sysctl_values: Dict[str, str], gpu_core_count: int | str) -> dict:
+    try:
+        e_core_count = int(sysctl_values['hw.perflevel1.logicalcpu'])
+        p_core_count = int(sysctl_values['hw.perflevel0.logicalcpu'])
+    except (KeyError, ValueError):
+        e_core_count = '?'
+        p_core_count = '?'
+    try:
+        core_count = int(sysctl_values['machdep.cpu.core_count'])
+    except (KeyError, ValueError):
+        core_count = '?'
+    # sysctl failed or is not the macOS one: keep going with the default limits.
+    name = sysctl_values.get('machdep.cpu.brand_string', '?')
+    limits = SOC_LIMITS.get(name, DEFAULT_LIMITS)
+    return {
+        'name': name,
+        'core_count': core_count,
+        'cpu_max_power': limits.cpu_max_power,
+        'gpu_max_power': limits.gpu_max_power,
+        'cpu_max_bw': limits.cpu_max_bw,
+        'gpu_max_bw': limits.gpu_max_bw,
+        'e_core_count': e_core_count,
+        'p_core_count': p_core_count,
+        'gpu_core_count': gpu_core_count,
+    }
+
+
+def load_cached(path: str, key: str) -> dict | None:
+    try:
+        with open(path, encoding='utf-8') as fp:
+            cached = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('fingerprint') != key:
+        return None
+    return cached.get('soc_info')
+
+
+def store_cached(path: str, key: str, soc_info: dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump({'fingerprint': key, 'soc_info': soc_info}, fp)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def discover_soc_info(
+    run: CommandRunner = run_command,
+    cache_path: str | None = CACHE_PATH,
+) -> dict:
+    """Return the SoC description used to scale power and bandwidth metrics.
+
+    The result is cached in ``cache_path`` under a fingerprint of the machine
+    and the current boot, so restarts skip ``system_profiler``, which can take
+    several seconds. On a cache miss the sysctl and ``system_profiler`` probes
+    run concurrently. Pass a fake ``run`` to discover without macOS.
+    """
+    key = fingerprint(run) if cache_path is not None else None
+    if key is not None:
+        cached = load_cached(cache_path, key)
+        if cached is not None:
+            return cached
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        gpu_cores = executor.submit(query_gpu_cores, run)
+        sysctl_values = query_sysctl(CPU_KEYS + CORE_COUNT_KEYS, run)
+        soc_info = build_soc_info(sysctl_values, gpu_cores.result())
+
+    if key is not None:
+        store_cached(cache_path, key, soc_info)
+    return soc_info
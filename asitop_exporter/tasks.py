@@ -0,0 +1,86 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Top-N per-process energy and CPU usage from the ``tasks`` sampler."""
+
+from __future__ import annotations
+
+import heapq
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+
+# Hard cap on exported processes per interval, whatever --top_tasks says.
+MAX_TOP_TASKS = 100
+OTHER = 'other'
+
+
+class TaskStats(NamedTuple):
+    pid: int | None  # None for the ``other`` series
+    name: str
+    cpu_ms_per_s: float
+    energy_impact_per_s: float
+    wakeups_per_s: float
+
+
+class TaskAggregator:
+    """Average per-process rates over an interval and keep the top ``limit``.
+
+    Every frame adds ``(pid, name, cpu, energy, wakeups)`` rates weighted by
+    the frame duration. :meth:`top` selects the processes with the highest
+    energy impact with a size-``limit`` heap (O(n log limit)) and folds all
+    the others into one ``other`` entry, so the exported series stay bounded
+    no matter how many short-lived processes the host runs. Processes that
+    drop out of the top, or exit, are simply not exported any more.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = min(max(1, limit), MAX_TOP_TASKS)
+        self.totals: Dict[int, List] = {}
+        self.elapsed = 0.0
+
+    def add(self, tasks: Iterable[Tuple[int, str, float, float, float]], elapsed: float) -> None:
+        totals = self.totals
+        for pid, name, cpu, energy, wakeups in tasks:
+            entry = totals.get(pid)
+            if entry is None:
+                totals[pid] = [name, cpu * elapsed, energy * elapsed, wakeups * elapsed]
+            else:
+                entry[0] = name
+                entry[1] += cpu * elapsed
+                entry[2] += energy * elapsed
+                entry[3] += wakeups * elapsed
+        self.elapsed += elapsed
+
+    def reset(self) -> None:
+        self.totals = {}
+        self.elapsed = 0.0
+
+    def top(self) -> Tuple[TaskStats, ...]:
+        """Return the top processes of the interval plus ``other``, as rates."""
+        if not self.totals or self.elapsed <= 0:
+            return ()
+        scale = 1.0 / self.elapsed
+        top = heapq.nlargest(self.limit, self.totals.items(), key=lambda item: item[1][2])
+        stats = [
+            TaskStats(pid, name, cpu * scale, energy * scale, wakeups * scale)
+            for pid, (name, cpu, energy, wakeups) in top
+        ]
+        if len(self.totals) > len(top):
+            cpu = sum(entry[1] for entry in self.totals.values()) - sum(entry[1][1] for entry in top)
+            energy = sum(entry[2] for entry in self.totals.values()) - sum(entry[1][2] for entry in top)
+            wakeups = sum(entry[3] for entry in self.totals.values()) - sum(entry[1][3] for entry in top)
+            stats.append(TaskStats(None, OTHER, cpu * scale, energy * scale, wakeups * scale))
+        return tuple(stats)
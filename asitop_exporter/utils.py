@@ -16,6 +16,8 @@
 # ==============================================================================
 """Utility functions for ``asitop-exporter``."""
 
+from __future__ import annotations
+
 import socket
 import os
 import glob
@@ -23,7 +25,29 @@ import subprocess
 from subprocess import PIPE
 import psutil
 from .parsers import *
+from .soc import CORE_COUNT_KEYS, CPU_KEYS, CommandRunner, discover_soc_info, query_gpu_cores, query_sysctl, run_command
 import plistlib
+from typing import TextIO
+
+from termcolor import colored
+
+
+def cprint(text: str = '', *, file: TextIO | None = None) -> None:
+    """Print colored text to a file."""
+    for prefix, color in (
+        ('INFO: ', 'yellow'),
+        ('WARNING: ', 'yellow'),
+        ('ERROR: ', 'red'),
+        ('NVML ERROR: ', 'red'),
+    ):
+        if text.startswith(prefix):
+            text = text.replace(
+                prefix.rstrip(),
+                colored(prefix.rstrip(), color=color, attrs=('bold',)),
+                1,
+            )
+    print(text, file=file)
+
 
 def get_ip_address() -> str:
     """Get the IP address of the current machine."""
@@ -39,24 +63,53 @@ def get_ip_address() -> str:
         s.close()
     return ip_address
 
-def run_powermetrics_process(timecode, nice=10, interval=1000):
+def powermetrics_samplers(run: CommandRunner = run_command) -> frozenset:
+    """Return the sampler names listed by ``powermetrics -h`` on this macOS."""
+    names = set()
+    section = None
+    for line in run(("powermetrics", "-h")).splitlines():
+        if "supported by --samplers" in line:
+            section = []
+        elif section is not None:
+            if line.strip():
+                section.append(line.split()[0])
+            elif section:
+                names.update(section)
+                section = None
+    if section:
+        names.update(section)
+    return frozenset(names)
+
+
+def run_powermetrics_process(timecode, nice=10, interval=1000, output_file=True, tasks=False, bandwidth=False):
+    """Start ``powermetrics`` writing plist frames to a temp file or, with
+    ``output_file=False``, to its stdout pipe. ``tasks=True`` adds the
+    per-process ``tasks`` sampler with energy impact and ``bandwidth=True``
+    the memory ``bandwidth`` sampler."""
     #ver, *_ = platform.mac_ver()
     #major_ver = int(ver.split(".")[0])
-    for tmpf in glob.glob("/tmp/asitop_exporter_powermetrics*"):
-        os.remove(tmpf)
-    output_file_flag = "-o"
-    command = " ".join([
+    command = [
         "sudo nice -n",
         str(nice),
         "powermetrics",
         "--samplers cpu_power,gpu_power,thermal",
-        output_file_flag,
-        "/tmp/asitop_exporter_powermetrics"+timecode,
+    ]
+    if bandwidth:
+        command[-1] += ",bandwidth"
+    if tasks:
+        command[-1] += ",tasks"
+        command.append("--show-process-energy")
+    if output_file:
+        for tmpf in glob.glob("/tmp/asitop_exporter_powermetrics*"):
+            os.remove(tmpf)
+        output_file_flag = "-o"
+        command += [output_file_flag, "/tmp/asitop_exporter_powermetrics"+timecode]
+    command += [
         "-f plist",
         "-i",
         str(interval)
-    ])
-    process = subprocess.Popen(command.split(" "), stdin=PIPE, stdout=PIPE)
+    ]
+    process = subprocess.Popen(" ".join(command).split(" "), stdin=PIPE, stdout=PIPE)
     return process
 
 
@@ -92,97 +145,22 @@ def get_ram_metrics_dict():
 
 
 def get_cpu_info():
-    cpu_info = os.popen('sysctl -a | grep machdep.cpu').read()
-    cpu_info_lines = cpu_info.split("\n")
-    data_fields = ["machdep.cpu.brand_string", "machdep.cpu.core_count"]
-    cpu_info_dict = {}
-    for l in cpu_info_lines:
-        for h in data_fields:
-            if h in l:
-                value = l.split(":")[1].strip()
-                cpu_info_dict[h] = value
-    return cpu_info_dict
+    return query_sysctl(CPU_KEYS)
 
 
 def get_core_counts():
-    cores_info = os.popen('sysctl -a | grep hw.perflevel').read()
-    cores_info_lines = cores_info.split("\n")
-    data_fields = ["hw.perflevel0.logicalcpu", "hw.perflevel1.logicalcpu"]
     cores_info_dict = {}
-    for l in cores_info_lines:
-        for h in data_fields:
-            if h in l:
-                value = int(l.split(":")[1].strip())
-                cores_info_dict[h] = value
+    for key, value in query_sysctl(CORE_COUNT_KEYS).items():
+        try:
+            cores_info_dict[key] = int(value)
+        except ValueError:
+            pass
     return cores_info_dict
 
 
 def get_gpu_cores():
-    try:
-        cores = os.popen(
-            "system_profiler -detailLevel basic SPDisplaysDataType | grep 'Total Number of Cores'").read()
-        cores = int(cores.split(": ")[-1])
-    except:
-        cores = "?"
-    return cores
+    return query_gpu_cores()
 
 
 def get_soc_info():
-    cpu_info_dict = get_cpu_info()
-    core_counts_dict = get_core_counts()
-    try:
-        e_core_count = core_counts_dict["hw.perflevel1.logicalcpu"]
-        p_core_count = core_counts_dict["hw.perflevel0.logicalcpu"]
-    except:
-        e_core_count = "?"
-        p_core_count = "?"
-    soc_info = {
-        "name": cpu_info_dict["machdep.cpu.brand_string"],
-        "core_count": int(cpu_info_dict["machdep.cpu.core_count"]),
-        "cpu_max_power": None,
-        "gpu_max_power": None,
-        "cpu_max_bw": None,
-        "gpu_max_bw": None,
-        "e_core_count": e_core_count,
-        "p_core_count": p_core_count,
-        "gpu_core_count": get_gpu_cores()
-    }
-    # TDP (power)
-    if soc_info["name"] == "Apple M1 Max":
-        soc_info["cpu_max_power"] = 30
-        soc_info["gpu_max_power"] = 60
-    elif soc_info["name"] == "Apple M1 Pro":
-        soc_info["cpu_max_power"] = 30
-        soc_info["gpu_max_power"] = 30
-    elif soc_info["name"] == "Apple M1":
-        soc_info["cpu_max_power"] = 20
-        soc_info["gpu_max_power"] = 20
-    elif soc_info["name"] == "Apple M1 Ultra":
-        soc_info["cpu_max_power"] = 60
-        soc_info["gpu_max_power"] = 120
-    elif soc_info["name"] == "Apple M2":
-        soc_info["cpu_max_power"] = 25
-        soc_info["gpu_max_power"] = 15
-    else:
-        soc_info["cpu_max_power"] = 20
-        soc_info["gpu_max_power"] = 20
-    # bandwidth
-    if soc_info["name"] == "Apple M1 Max":
-        soc_info["cpu_max_bw"] = 250
-        soc_info["gpu_max_bw"] = 400
-    elif soc_info["name"] == "Apple M1 Pro":
-        soc_info["cpu_max_bw"] = 200
-        soc_info["gpu_max_bw"] = 200
-    elif soc_info["name"] == "Apple M1":
-        soc_info["cpu_max_bw"] = 70
-        soc_info["gpu_max_bw"] = 70
-    elif soc_info["name"] == "Apple M1 Ultra":
-        soc_info["cpu_max_bw"] = 500
-        soc_info["gpu_max_bw"] = 800
-    elif soc_info["name"] == "Apple M2":
-        soc_info["cpu_max_bw"] = 100
-        soc_info["gpu_max_bw"] = 100
-    else:
-        soc_info["cpu_max_bw"] = 70
-        soc_info["gpu_max_bw"] = 70
-    return soc_info
+    return discover_soc_info()
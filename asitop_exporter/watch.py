@@ -0,0 +1,201 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Wait for writes to the powermetrics output file.
+
+:func:`watch_file` picks kqueue on macOS and BSD, inotify (through ctypes)
+on Linux and falls back to polling ``stat``. A watcher's :meth:`wait`
+returns as soon as the file may have grown, so a reader can pick up a new
+frame within milliseconds of powermetrics writing it. Writes that happen
+between two waits are not lost: the next :meth:`wait` returns immediately.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+
+class PollingWatcher:
+    """Fallback: compare the file's size and modification time every ``interval``."""
+
+    def __init__(self, path: str, interval: float = 0.05) -> None:
+        self.path = path
+        self.interval = interval
+        self.state = self.stat()
+
+    def stat(self) -> tuple | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def wait(self, timeout: float) -> bool:
+        """Return ``True`` once the file changed, ``False`` after ``timeout`` seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            state = self.stat()
+            if state != self.state:
+                self.state = state
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+    def close(self) -> None:
+        pass
+
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    """Linux: inotify on the file's directory, so the file may not exist yet."""
+
+    def __init__(self, path: str) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self.name = os.fsencode(os.path.basename(path))
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        directory = os.path.dirname(os.path.abspath(path))
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            if self.drain():
+                return True
+
+    def drain(self) -> bool:
+        """Consume the queued events; return whether any concerned the file."""
+        matched = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return matched
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if name == self.name or mask & IN_Q_OVERFLOW:
+                    matched = True
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class KqueueWatcher:
+    """macOS and BSD: ``EVFILT_VNODE`` on the file, or on its directory until it exists."""
+
+    FILE_EVENTS = select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME \
+        if hasattr(select, 'kqueue') else 0
+    # Only for event notifications, does not keep the volume busy (macOS).
+    OPEN_FLAGS = getattr(os, 'O_EVTONLY', 0x8000 if sys.platform == 'darwin' else os.O_RDONLY)
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.kqueue = select.kqueue()
+        self.fd = -1
+        self.watching_file = False
+        self.watch()
+
+    def watch(self) -> None:
+        """(Re)register on the file if it exists, else on its directory."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        try:
+            self.fd = os.open(self.path, self.OPEN_FLAGS)
+            self.watching_file = True
+            fflags = self.FILE_EVENTS
+        except FileNotFoundError:
+            self.fd = os.open(self.directory, self.OPEN_FLAGS)
+            self.watching_file = False
+            fflags = select.KQ_NOTE_WRITE
+        event = select.kevent(
+            self.fd,
+            filter=select.KQ_FILTER_VNODE,
+            flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+            fflags=fflags,
+        )
+        self.kqueue.control([event], 0, 0)
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            events = self.kqueue.control(None, 4, remaining)
+            if not events:
+                return False
+            fflags = 0
+            for event in events:
+                fflags |= event.fflags
+            if not self.watching_file:
+                # Something changed in the directory; has the file appeared?
+                self.watch()
+                if self.watching_file:
+                    return True
+                continue
+            if fflags & (select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME):
+                self.watch()
+            return True
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self.kqueue.close()
+
+
+def watch_file(path: str):
+    """Return the best available watcher for ``path``."""
+    try:
+        if hasattr(select, 'kqueue'):
+            return KqueueWatcher(path)
+        if sys.platform.startswith('linux'):
+            return InotifyWatcher(path)
+    except (OSError, AttributeError):
+        pass
+    return PollingWatcher(path)
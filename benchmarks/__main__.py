@@ -0,0 +1,63 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Run the ``asitop-exporter`` microbenchmarks."""
+
+from __future__ import annotations
+
+import argparse
+import sys
+
+from benchmarks import hot_path
+from tests.fixtures import TOPOLOGIES
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Microbenchmarks for the asitop-exporter hot path.',
+    )
+    parser.add_argument(
+        '--topology',
+        dest='topologies',
+        action='append',
+        choices=sorted(TOPOLOGIES),
+        help='SoC topology to benchmark, may be repeated. (default: all)',
+    )
+    parser.add_argument(
+        '--samples',
+        type=int,
+        default=200,
+        help='Timed calls per benchmark. (default: %(default)d)',
+    )
+    parser.add_argument(
+        '--history',
+        type=int,
+        default=1000,
+        help='Frames already in the powermetrics file before parsing. (default: %(default)d)',
+    )
+    args = parser.parse_args()
+
+    results = hot_path.run(args.topologies or list(TOPOLOGIES), args.samples, args.history)
+    print(f'{"benchmark":<31} {"topology":<9} {"throughput":>14} {"latency":>13} {"peak alloc":>14}')
+    for topology_results in results.values():
+        for result in topology_results:
+            print(result.format())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
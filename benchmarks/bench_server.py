@@ -0,0 +1,144 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Scrape latency of the ``/metrics`` servers under concurrent clients.
+
+Run with ``python -m benchmarks.bench_server``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import http.client
+import socket
+import sys
+import threading
+import time
+from typing import List, NamedTuple
+
+from asitop_exporter.parsers import parse_frame
+from asitop_exporter.server import ExporterApp, start_asyncio_server, start_wsgi_server
+from tests.fixtures import TOPOLOGIES, make_exporter, make_frame
+
+
+SERVERS = {
+    'threaded': start_wsgi_server,
+    'asyncio': start_asyncio_server,
+}
+
+
+class LatencyResult(NamedTuple):
+    server: str
+    clients: int
+    stalled: int
+    latencies: List[float]
+    seconds: float
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def format(self) -> str:
+        return (
+            f'{self.server:<15} {self.clients:>7} {self.stalled:>7} '
+            f'{self.percentile(0.5) * 1e3:>9.2f} {self.percentile(0.95) * 1e3:>9.2f} '
+            f'{self.percentile(0.99) * 1e3:>9.2f} {max(self.latencies) * 1e3:>9.2f} '
+            f'{len(self.latencies) / self.seconds:>10,.0f}/s'
+        )
+
+
+def scrape(port: int, requests: int, barrier: threading.Barrier, latencies: List[float]) -> None:
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    barrier.wait()
+    for _ in range(requests):
+        start = time.perf_counter()
+        connection.request('GET', '/metrics', headers={'Accept-Encoding': 'gzip'})
+        response = connection.getresponse()
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def bench_server(server: str, port: int, clients: int, requests: int, stalled: int) -> LatencyResult:
+    # Stalled clients connect and send half a request, like a hung scraper.
+    idle = []
+    for _ in range(stalled):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'GET /metrics HTTP/1.1\r\n')
+        idle.append(sock)
+
+    barrier = threading.Barrier(clients + 1)
+    latencies: List[float] = []
+    threads = [
+        threading.Thread(target=scrape, args=(port, requests, barrier, latencies), daemon=True)
+        for _ in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    for sock in idle:
+        sock.close()
+    return LatencyResult(server, clients, stalled, latencies, seconds)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.bench_server',
+        description='Concurrent scrape latency of the /metrics servers.',
+    )
+    parser.add_argument('--topology', default='M1 Max', choices=sorted(TOPOLOGIES))
+    parser.add_argument(
+        '--clients',
+        type=int,
+        action='append',
+        help='Concurrent keep-alive scrapers, may be repeated. (default: 1, 4, 16)',
+    )
+    parser.add_argument('--requests', type=int, default=50, help='Scrapes per client. (default: %(default)d)')
+    parser.add_argument(
+        '--stalled',
+        type=int,
+        default=0,
+        help='Extra clients that connect but never finish their request. (default: %(default)d)',
+    )
+    args = parser.parse_args()
+
+    exporter = make_exporter()
+    reading = parse_frame(make_frame(args.topology, 0))
+    exporter.ingest([reading])
+    exporter.publish()
+    apps = {
+        '': ExporterApp(exporter.registry),
+        '+cache': ExporterApp(exporter.registry, snapshot=lambda: exporter.collector.snapshot),
+    }
+
+    print(f'{"server":<15} {"clients":>7} {"stalled":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9} {"throughput":>12}')
+    for name, start_server in SERVERS.items():
+        for suffix, app in apps.items():
+            httpd, _ = start_server(app, port=0, addr='127.0.0.1')
+            for clients in args.clients or [1, 4, 16]:
+                print(bench_server(name + suffix, httpd.server_port, clients, args.requests, args.stalled).format())
+            httpd.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks for parsing a sample and publishing it."""
+
+from __future__ import annotations
+
+import os
+import plistlib
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, NamedTuple
+
+from prometheus_client import generate_latest
+
+from asitop_exporter.decoder import BASE_KEYS, TASK_FIELDS, SelectivePlistDecoder
+from asitop_exporter.parsers import (
+    parse_bandwidth_metrics,
+    parse_cpu_metrics,
+    parse_frame,
+    parse_powermetrics,
+)
+from asitop_exporter.reader import PowermetricsFileReader
+from asitop_exporter.server import ExporterApp
+from tests.fixtures import make_exporter, make_frame, make_sample
+
+
+class Result(NamedTuple):
+    name: str
+    topology: str
+    samples: int
+    seconds: float
+    peak_bytes: int
+
+    @property
+    def per_second(self) -> float:
+        return self.samples / self.seconds if self.seconds else float('inf')
+
+    @property
+    def usec_per_sample(self) -> float:
+        return self.seconds / self.samples * 1e6
+
+    def format(self) -> str:
+        return (
+            f'{self.name:<31} {self.topology:<9} {self.per_second:>12,.0f}/s '
+            f'{self.usec_per_sample:>10.1f} us {self.peak_bytes / 1024:>10.1f} KiB'
+        )
+
+
+def measure(name: str, topology: str, func: Callable[[], object], samples: int) -> Result:
+    """Time ``samples`` calls of ``func`` and the peak allocation of a single call."""
+    func()  # warm up caches and lazy imports
+
+    start = time.perf_counter()
+    for _ in range(samples):
+        func()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Result(name, topology, samples, seconds, peak - baseline)
+
+
+def bench_topology(topology: str, samples: int, history: int) -> Iterator[Result]:
+    frame = make_frame(topology, 0, bandwidth=True)
+    sample = make_sample(topology, 0, bandwidth=True)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'powermetrics')
+        with open(path, 'wb') as fp:
+            for index in range(history):
+                fp.write(make_frame(topology, index) + b'\x00')
+        reader = PowermetricsFileReader(path)
+        reader.read_frames()
+
+        def append_and_parse() -> object:
+            with open(path, 'ab') as fp:
+                fp.write(frame + b'\x00')
+            return parse_powermetrics(reader=reader)
+
+        yield measure('parse_powermetrics', topology, append_and_parse, samples)
+        reader.close()
+
+    yield measure('parse_frame', topology, lambda: parse_frame(frame), samples)
+    yield measure('plistlib.loads', topology, lambda: plistlib.loads(frame), samples)
+    yield measure('parse_cpu_metrics', topology, lambda: parse_cpu_metrics(sample), samples)
+    yield measure('parse_bandwidth_metrics', topology, lambda: parse_bandwidth_metrics(sample), samples)
+
+    exporter = make_exporter()
+    reading = parse_frame(frame)
+    exporter.get_reading = lambda: [reading]
+    yield measure('PrometheusExporter.sample_once', topology, exporter.sample_once, samples)
+    yield measure('post payload serialisation', topology, exporter.encode_result, samples)
+    yield measure('/metrics rendering', topology, lambda: generate_latest(exporter.registry), samples)
+    app = ExporterApp(exporter.registry, snapshot=lambda: exporter.collector.snapshot)
+    headers = {'accept-encoding': 'gzip'}
+    yield measure('/metrics cached (gzip)', topology, lambda: app.handle('GET', '/metrics', '', headers), samples)
+
+    # 10 frames per interval at --sample_interval 100: collect() ingests every
+    # frame as it lands and publishes the window once.
+    exporter = make_exporter(sample_interval=0.1)
+    readings = [parse_frame(make_frame(topology, index, interval=0.1)) for index in range(10)]
+
+    def ingest_window() -> None:
+        for reading in readings:
+            exporter.ingest([reading])
+        exporter.publish()
+
+    yield measure('ingest x10 + publish (window)', topology, ingest_window, samples)
+
+    # --top_tasks on a busy host
+    frame = make_frame(topology, 0, tasks=500)
+    decoder = SelectivePlistDecoder(BASE_KEYS, {'tasks': TASK_FIELDS})
+    yield measure('parse_frame (500 tasks)', topology, lambda: parse_frame(frame, decoder), samples)
+    exporter = make_exporter(top_tasks=10)
+    reading = parse_frame(frame, decoder)
+    exporter.get_reading = lambda: [reading]
+    yield measure('sample_once (--top_tasks 10)', topology, exporter.sample_once, samples)
+
+
+def run(topologies: List[str], samples: int, history: int) -> Dict[str, List[Result]]:
+    return {
+        topology: list(bench_topology(topology, samples, history))
+        for topology in topologies
+    }
@@ -7,7 +7,7 @@ setup(
     version='1.0.0',
     author='xuwei fang',
     description='Performance monitoring CLI tool for Apple Silicon',
-    packages=find_packages(),
+    packages=find_packages(exclude=('benchmarks', 'benchmarks.*', 'tests', 'tests.*')),
     entry_points={
             'console_scripts': [
                 'asitop-exporter = asitop_exporter.__main__:main'
@@ -23,7 +23,11 @@ setup(
         "dashing",
         "psutil",
         "prometheus_client",
+        "requests",
         "termcolor",
     ],
+    extras_require={
+        "highres": ["numpy"],
+    },
     zip_safe=False
 )
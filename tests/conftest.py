@@ -0,0 +1,79 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Shared fixtures: a local stand-in HTTP server."""
+
+from __future__ import annotations
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, NamedTuple
+
+import pytest
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    headers: dict
+    body: bytes
+
+
+class StandInServer:
+    """Record every request and answer with the queued status codes (then 200)."""
+
+    def __init__(self) -> None:
+        self.requests: List[Request] = []
+        self.statuses: List[int] = []
+        self.received = threading.Condition()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_body(self) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with server.received:
+                    server.requests.append(Request(self.command, self.path, dict(self.headers), body))
+                    status = server.statuses.pop(0) if server.statuses else 200
+                    server.received.notify_all()
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_POST = do_PUT = handle_body
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def wait_for(self, count: int, timeout: float = 5.0) -> List[Request]:
+        with self.received:
+            self.received.wait_for(lambda: len(self.requests) >= count, timeout=timeout)
+            return list(self.requests)
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    yield stand_in
+    stand_in.close()
@@ -0,0 +1,187 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Synthetic ``powermetrics -f plist`` frames for each SoC topology, shared with the benchmarks."""
+
+from __future__ import annotations
+
+import datetime
+import plistlib
+import random
+from typing import Dict, List, Tuple
+
+from prometheus_client import CollectorRegistry
+
+from asitop_exporter.exporter import PrometheusExporter
+
+
+# Cluster name -> number of cores, in the order powermetrics reports them.
+TOPOLOGIES: Dict[str, List[Tuple[str, int]]] = {
+    'M1': [('E-Cluster', 4), ('P-Cluster', 4)],
+    'M2': [('E-Cluster', 4), ('P-Cluster', 4)],
+    'M1 Pro': [('E-Cluster', 2), ('P0-Cluster', 4), ('P1-Cluster', 4)],
+    'M1 Max': [('E-Cluster', 2), ('P0-Cluster', 4), ('P1-Cluster', 4)],
+    'M1 Ultra': [
+        ('E0-Cluster', 2),
+        ('E1-Cluster', 2),
+        ('P0-Cluster', 4),
+        ('P1-Cluster', 4),
+        ('P2-Cluster', 4),
+        ('P3-Cluster', 4),
+    ],
+    'M3 Max': [('E-Cluster', 4), ('P0-Cluster', 6), ('P1-Cluster', 6)],
+    'M3 Ultra': [
+        ('E0-Cluster', 4),
+        ('E1-Cluster', 4),
+        ('P0-Cluster', 6),
+        ('P1-Cluster', 6),
+        ('P2-Cluster', 6),
+        ('P3-Cluster', 6),
+    ],
+    'M4 Max': [('E-Cluster', 4), ('P0-Cluster', 6), ('P1-Cluster', 6)],
+}
+
+BANDWIDTH_COUNTERS = [
+    f'{unit} DCS {direction}'
+    for unit in (
+        'PCPU0', 'PCPU1', 'PCPU2', 'PCPU3', 'PCPU',
+        'ECPU0', 'ECPU1', 'ECPU',
+        'GFX', 'ISP', 'STRM CODEC', 'PRORES', 'VDEC',
+        'VENC0', 'VENC1', 'VENC2', 'VENC3', 'VENC',
+        'JPG0', 'JPG1', 'JPG2', 'JPG3', 'JPG',
+    )
+    for direction in ('RD', 'WR')
+] + ['DCS RD', 'DCS WR']
+
+EPOCH = datetime.datetime(2024, 1, 1)
+
+
+def make_sample(
+    topology: str = 'M1',
+    index: int = 0,
+    *,
+    interval: float = 1.0,
+    tasks: int = 0,
+    bandwidth: bool = False,
+    rng: random.Random | None = None,
+) -> dict:
+    """Build one powermetrics sample as the dict ``plistlib`` would decode."""
+    rng = rng or random.Random(index)
+    elapsed_ns = int(interval * 1e9)
+    clusters = []
+    cpu = 0
+    for name, core_count in TOPOLOGIES[topology]:
+        base_freq = 2.0e9 if name[0] == 'E' else 3.2e9
+        cpus = []
+        for _ in range(core_count):
+            cpus.append({
+                'cpu': cpu,
+                'freq_hz': base_freq * rng.uniform(0.3, 1.0),
+                'idle_ratio': rng.random(),
+                'down_ratio': 0.0,
+            })
+            cpu += 1
+        clusters.append({
+            'name': name,
+            'hw_resid_counters': True,
+            'freq_hz': base_freq * rng.uniform(0.3, 1.0),
+            'idle_ratio': rng.random(),
+            'down_ratio': 0.0,
+            'cpus': cpus,
+        })
+
+    cpu_energy = rng.uniform(100, 20000) * interval
+    gpu_energy = rng.uniform(10, 30000) * interval
+    ane_energy = rng.uniform(0, 4000) * interval
+    sample = {
+        'is_delta': True,
+        'elapsed_ns': elapsed_ns,
+        'hw_model': 'Mac14,2',
+        'kern_osversion': '23A344',
+        'kern_bootargs': '',
+        'kern_boottime': 1704067200,
+        'timestamp': EPOCH + datetime.timedelta(seconds=index * interval),
+        'thermal_pressure': 'Nominal',
+        'processor': {
+            'clusters': clusters,
+            'cpu_energy': cpu_energy,
+            'cpu_power': cpu_energy / interval,
+            'gpu_energy': gpu_energy,
+            'ane_energy': ane_energy,
+            'ane_power': ane_energy / interval,
+            'combined_power': (cpu_energy + gpu_energy + ane_energy) / interval,
+        },
+        'gpu': {
+            'freq_hz': rng.uniform(389, 1398),
+            'idle_ratio': rng.random(),
+            'dvfm_states': [
+                {'freq': freq, 'used_ns': rng.randrange(elapsed_ns), 'used_ratio': rng.random()}
+                for freq in (389, 486, 648, 778, 951, 1114, 1260, 1398)
+            ],
+            'gpu_energy': gpu_energy,
+        },
+    }
+    if tasks:
+        sample['tasks'] = [
+            {
+                'pid': pid,
+                'name': f'process{pid}',
+                'started_abstime_ns': rng.randrange(elapsed_ns),
+                'interval_ns': elapsed_ns,
+                'cputime_ns': rng.randrange(elapsed_ns),
+                'cputime_ms_per_s': rng.uniform(0, 1000),
+                'cputime_sample_ms_per_s': rng.uniform(0, 1000),
+                'cputime_userland_ratio': rng.random(),
+                'intr_wakeups': rng.randrange(100),
+                'intr_wakeups_per_s': rng.uniform(0, 100),
+                'idle_wakeups': rng.randrange(100),
+                'idle_wakeups_per_s': rng.uniform(0, 100),
+                'energy_impact': rng.uniform(0, 500),
+                'energy_impact_per_s': rng.uniform(0, 500),
+            }
+            for pid in range(100, 100 + tasks)
+        ]
+    if bandwidth:
+        sample['bandwidth_counters'] = [
+            {'name': name, 'value': rng.uniform(0, 5e9) * interval}
+            for name in BANDWIDTH_COUNTERS
+        ]
+    return sample
+
+
+def make_frame(topology: str = 'M1', index: int = 0, **kwargs) -> bytes:
+    """Encode one sample as a powermetrics plist frame (without separator)."""
+    return plistlib.dumps(make_sample(topology, index, **kwargs))
+
+
+def make_capture(path: str, topology: str = 'M1', frames: int = 10, **kwargs) -> str:
+    """Write a multi-frame, NUL-delimited capture like ``powermetrics -o``."""
+    with open(path, 'wb') as fp:
+        for index in range(frames):
+            fp.write(make_frame(topology, index, **kwargs))
+            fp.write(b'\x00')
+    return path
+
+
+def make_exporter(interval: float = 1.0, **kwargs) -> PrometheusExporter:
+    """An exporter on a private registry; powermetrics is not started."""
+    return PrometheusExporter(
+        hostname='fixture',
+        registry=CollectorRegistry(),
+        interval=interval,
+        timecode='0',
+        **kwargs,
+    )
@@ -0,0 +1,106 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Per-cluster and per-core CPU families rendered from fixture frames."""
+
+from __future__ import annotations
+
+import pytest
+from prometheus_client import generate_latest
+
+from tests.fixtures import TOPOLOGIES, make_exporter, make_frame, make_sample
+from asitop_exporter.collector import SnapshotCollector
+from asitop_exporter.parsers import parse_frame, parse_frames
+
+
+def families(collector):
+    return {family.name: family for family in collector.collect()}
+
+
+def expected_cores(sample):
+    """``(cluster, core, type, percent, MHz)`` per core, computed from the raw sample."""
+    return [
+        (
+            cluster['name'],
+            str(cpu['cpu']),
+            cluster['name'][0],
+            int((1 - cpu['idle_ratio']) * 100),
+            int(cpu['freq_hz'] / 1e6),
+        )
+        for cluster in sample['processor']['clusters']
+        for cpu in cluster['cpus']
+    ]
+
+
+@pytest.mark.parametrize('topology', sorted(TOPOLOGIES))
+def test_core_and_cluster_families(topology):
+    sample = make_sample(topology, 1)
+    collector = SnapshotCollector('fixture')
+    collector.update({}, cpu=collector.cpu_sample(parse_frame(make_frame(topology, 1))[0]['cpu']))
+    rendered = families(collector)
+
+    cores = expected_cores(sample)
+    percent = rendered['host_CPU_core_percent_Percentage'].samples
+    clock = rendered['host_CPU_core_clock_MHz'].samples
+    assert len(percent) == len(clock) == len(cores) == sum(count for _, count in TOPOLOGIES[topology])
+    for (cluster, core, core_type, active, freq), percent_sample, clock_sample in zip(cores, percent, clock):
+        labels = {'hostname': 'fixture', 'cluster': cluster, 'core': core, 'type': core_type}
+        assert percent_sample.labels == labels and percent_sample.value == active
+        assert clock_sample.labels == labels and clock_sample.value == freq
+
+    clusters = sample['processor']['clusters']
+    percent = rendered['host_CPU_cluster_percent_Percentage'].samples
+    clock = rendered['host_CPU_cluster_clock_MHz'].samples
+    assert [s.labels for s in percent] == [
+        {'hostname': 'fixture', 'cluster': cluster['name'], 'type': cluster['name'][0]} for cluster in clusters
+    ]
+    assert [s.value for s in percent] == [int((1 - cluster['idle_ratio']) * 100) for cluster in clusters]
+    assert [s.value for s in clock] == [int(cluster['freq_hz'] / 1e6) for cluster in clusters]
+
+
+def test_label_values_are_built_once_per_topology():
+    collector = SnapshotCollector('fixture')
+    first = collector.cpu_sample(parse_frame(make_frame('M1 Pro', 0))[0]['cpu'])
+    second = collector.cpu_sample(parse_frame(make_frame('M1 Pro', 1))[0]['cpu'])
+    assert second.topology is first.topology
+    assert second.core_active != first.core_active
+
+    other = collector.cpu_sample(parse_frame(make_frame('M3 Max', 0))[0]['cpu'])
+    assert other.topology is not first.topology
+    assert len(collector.topologies) == 2
+    # Switching back reuses the first topology's labels.
+    assert collector.cpu_sample(parse_frame(make_frame('M1 Pro', 2))[0]['cpu']).topology is first.topology
+
+
+def test_families_are_empty_before_the_first_sample():
+    rendered = families(SnapshotCollector('fixture'))
+    for name in ('host_CPU_core_percent_Percentage', 'host_CPU_cluster_clock_MHz'):
+        assert rendered[name].samples == []
+
+
+def test_exporter_publishes_the_newest_frame_per_core():
+    exporter = make_exporter()
+    try:
+        exporter.ingest(parse_frames([make_frame('M1 Ultra', index) for index in range(3)]))
+        exporter.publish()
+        body = generate_latest(exporter.registry).decode()
+    finally:
+        exporter.sinks.stop(timeout=1)
+
+    for cluster, core, core_type, active, freq in expected_cores(make_sample('M1 Ultra', 2)):
+        labels = f'cluster="{cluster}",core="{core}",hostname="fixture",type="{core_type}"'
+        assert f'host_CPU_core_percent_Percentage{{{labels}}} {float(active)}\n' in body
+        assert f'host_CPU_core_clock_MHz{{{labels}}} {float(freq)}\n' in body
@@ -0,0 +1,210 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""The ``--debug_port`` endpoints: folded stacks, cProfile sessions and tracemalloc."""
+
+from __future__ import annotations
+
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import pytest
+from prometheus_client import CollectorRegistry
+
+from asitop_exporter import cli
+from asitop_exporter.collector import SnapshotCollector
+from asitop_exporter.debug import DebugApp, ProfileGate
+
+
+def get(app, path, query=''):
+    return app.handle('GET', path, query, {})
+
+
+class Worker:
+    """A thread spinning in :func:`spin_for_the_profiler`, through ``gate`` if given."""
+
+    def __init__(self, gate: ProfileGate | None = None) -> None:
+        self.gate = gate
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='worker', daemon=True)
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            if self.gate is None:
+                spin_for_the_profiler(0.005)
+            else:
+                self.gate.call(lambda: spin_for_the_profiler(0.005))
+
+    def __enter__(self) -> Worker:
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop.set()
+        self.thread.join(5)
+
+
+def spin_for_the_profiler(seconds: float) -> None:
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def test_profile_returns_folded_stacks():
+    with Worker():
+        response = get(DebugApp(), '/debug/profile', 'seconds=0.3&interval=5')
+    assert response.status == '200 OK'
+    header, *lines = response.body.decode().splitlines()
+    assert header.startswith('# ') and header.endswith(' samples')
+    samples = int(header.split()[1])
+    assert samples > 10
+    worker = []
+    for line in lines:
+        # flamegraph.pl input: frames from the thread name down, a space, the count.
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+        frames = stack.split(';')
+        if frames[0] == 'worker':
+            worker.append((frames, int(count)))
+    assert worker
+    assert sum(count for _, count in worker) <= samples
+    assert any('spin_for_the_profiler (' in frame for frames, _ in worker for frame in frames)
+    frames = worker[0][0]
+    assert frames[1].startswith('_bootstrap (')
+    assert all(frame.endswith(')') and ':' in frame for frame in frames[1:])
+
+
+def test_cprofile_session():
+    gate = ProfileGate()
+    with Worker(gate):
+        response = get(DebugApp(gate, interval=0.1), '/debug/profile', 'seconds=0.3&mode=cprofile&sort=time&limit=5')
+    assert response.status == '200 OK'
+    text = response.body.decode()
+    assert 'Ordered by: internal time' in text
+    assert 'spin_for_the_profiler' in text
+
+
+@pytest.mark.parametrize('query, message', [
+    ('seconds=0', b'seconds must be'),
+    ('seconds=1000', b'seconds must be'),
+    ('seconds=abc', b''),
+    ('seconds=0.1&interval=0', b'interval must be positive'),
+    ('seconds=0.1&mode=perf', b'mode must be sample or cprofile'),
+    ('seconds=30&mode=cprofile&sort=bogus', b'sort must be one of calls, cumulative'),
+    ('seconds=30&mode=cprofile&sort=tottime', b'sort must be one of'),
+    ('seconds=30&mode=cprofile&limit=x', b''),
+])
+def test_bad_parameters_are_400(query, message):
+    start = time.monotonic()
+    response = get(DebugApp(ProfileGate()), '/debug/profile', query)
+    assert response.status == '400 Bad Request'
+    assert message in response.body
+    # Rejected up front, not after profiling for the requested seconds.
+    assert time.monotonic() - start < 1
+
+
+def test_cprofile_without_a_gate_is_404():
+    assert get(DebugApp(), '/debug/profile', 'seconds=0.1&mode=cprofile').status == '404 Not Found'
+
+
+def test_tracemalloc_start_snapshot_diff():
+    app = DebugApp()
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        assert get(app, '/debug/tracemalloc/snapshot').status == '409 Conflict'
+        response = get(app, '/debug/tracemalloc/start', 'frames=2')
+        assert response.body == b'tracemalloc started with 2 frames.\n'
+        assert get(app, '/debug/tracemalloc/start').body == b'tracemalloc is already tracing.\n'
+
+        response = get(app, '/debug/tracemalloc/snapshot', 'limit=5')
+        assert response.status == '200 OK'
+        assert response.body.startswith(b'snapshot 1\ntotal ')
+        assert len(response.body.splitlines()) <= 2 + 5
+
+        retained = [bytearray(4096) for _ in range(256)]
+        response = get(app, '/debug/tracemalloc/diff', 'from=1&limit=3')
+        assert response.status == '200 OK'
+        text = response.body.decode()
+        assert text.startswith('snapshot 2\n')
+        top = text.splitlines()[2]
+        assert __file__ in top and 'size=' in top and '+' in top
+
+        response = get(app, '/debug/tracemalloc/diff', 'from=1&to=2')
+        assert response.body.startswith(b'snapshot 2\n')
+        assert get(app, '/debug/tracemalloc/diff', 'from=9').status == '400 Bad Request'
+        assert get(app, '/debug/tracemalloc/diff', 'from=1&to=9').status == '400 Bad Request'
+        del retained
+
+        assert get(app, '/debug/tracemalloc/stop').status == '200 OK'
+        assert not tracemalloc.is_tracing()
+        assert get(app, '/debug/tracemalloc/diff', 'from=1').status == '400 Bad Request'
+    finally:
+        if tracemalloc.is_tracing() and not was_tracing:
+            tracemalloc.stop()
+
+
+def test_routes():
+    app = DebugApp()
+    assert get(app, '/').body.startswith(b'asitop-exporter debug endpoints')
+    with Worker():
+        assert b'Thread worker' in get(app, '/debug/threads').body
+    assert get(app, '/debug/nothing').status == '404 Not Found'
+    assert app.handle('POST', '/debug/threads', '', {}).status == '405 Method Not Allowed'
+
+
+class StubExporter:
+    """Stands in for PrometheusExporter in cli.main(), recording close()."""
+
+    instances = []
+
+    def __init__(self, **kwargs) -> None:
+        self.registry = CollectorRegistry()
+        self.history = None
+        self.collector = SnapshotCollector('fixture')
+        self.self_metrics = None
+        self.profile_gate = kwargs['profile_gate']
+        self.closed = False
+        StubExporter.instances.append(self)
+
+    def start_powermetrics_process(self) -> None:
+        pass
+
+    def collect(self) -> None:
+        raise AssertionError('main() should have returned')
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_cli_closes_the_exporter_when_the_debug_port_is_taken(monkeypatch, capsys):
+    monkeypatch.setattr(cli, 'PrometheusExporter', StubExporter)
+    monkeypatch.setattr(cli, 'get_soc_info', lambda: None)
+    with socket.socket() as taken, socket.socket() as free:
+        taken.bind(('127.0.0.1', 0))
+        taken.listen()
+        free.bind(('127.0.0.1', 0))
+        port = free.getsockname()[1]
+        free.close()
+        monkeypatch.setattr(sys, 'argv', [
+            'asitop-exporter', '--port', str(port), '--bind-address', '127.0.0.1',
+            '--debug_port', str(taken.getsockname()[1]),
+        ])
+        assert cli.main() == 1
+    assert StubExporter.instances[-1].closed
+    assert 'ERROR: Cannot serve the debug endpoints' in capsys.readouterr().err
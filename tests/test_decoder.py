@@ -0,0 +1,86 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""SelectivePlistDecoder against plistlib on fixture frames."""
+
+from __future__ import annotations
+
+import plistlib
+
+import pytest
+
+from tests.fixtures import TOPOLOGIES, make_frame, make_sample
+from asitop_exporter.decoder import BASE_KEYS, TASK_FIELDS, SelectivePlistDecoder
+from asitop_exporter.parsers import DEFAULT_DECODER, parse_frame
+
+
+DECODER = SelectivePlistDecoder(BASE_KEYS, {'tasks': TASK_FIELDS})
+
+
+@pytest.mark.parametrize('topology', sorted(TOPOLOGIES))
+def test_base_keys_match_plistlib(topology):
+    frame = make_frame(topology, 3, tasks=20, bandwidth=True)
+    expected = {key: value for key, value in plistlib.loads(frame).items() if key in BASE_KEYS}
+    assert DEFAULT_DECODER.loads(frame) == expected
+    assert SelectivePlistDecoder(BASE_KEYS).loads(frame) == expected
+
+
+def frame_with(tasks_xml: bytes) -> bytes:
+    """Insert ``<key>tasks</key>`` + ``tasks_xml`` before the processor dict."""
+    frame = make_frame('M1 Max', 0)
+    at = frame.index(b'<key>processor</key>')
+    return frame[:at] + b'<key>tasks</key>' + tasks_xml + frame[at:]
+
+
+def test_tasks_are_decoded():
+    frame = make_frame('M1 Max', 0, tasks=5)
+    decoded = DECODER.loads(frame)
+    expected = plistlib.loads(frame)['tasks']
+    assert [task['pid'] for task in decoded['tasks']] == [task['pid'] for task in expected]
+    assert set(decoded['tasks'][0]) <= TASK_FIELDS
+
+
+def test_empty_tasks_array():
+    frame = frame_with(b'<array/>')
+    decoded = DECODER.loads(frame)
+    assert decoded['tasks'] == []
+    assert 'processor' in decoded
+    cpu_metrics_dict = parse_frame(frame, DECODER)[0]
+    assert cpu_metrics_dict['tasks'] == []
+
+
+def test_absent_tasks():
+    frame = make_frame('M1 Max', 0)
+    decoded = DECODER.loads(frame)
+    assert 'tasks' not in decoded
+    assert 'tasks' not in parse_frame(frame, DECODER)[0]
+
+
+def test_nested_tasks_key_is_not_cut():
+    sample = make_sample('M1 Max', 0)
+    sample['processor']['tasks'] = []
+    sample['gpu']['tasks'] = [{'pid': 1}]
+    frame = plistlib.dumps(sample)
+    decoded = DECODER.loads(frame)
+    assert 'tasks' not in decoded
+    assert decoded['processor']['clusters'] == sample['processor']['clusters']
+
+
+def test_non_array_tasks_falls_back_to_expat():
+    frame = frame_with(b'<dict><key>pid</key><integer>1</integer></dict>')
+    decoded = DECODER.loads(frame)
+    assert decoded['tasks'] == []
+    assert 'processor' in decoded
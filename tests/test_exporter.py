@@ -0,0 +1,169 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""PrometheusExporter reading, restart and rate-switch logic with fake children."""
+
+from __future__ import annotations
+
+import datetime
+import os
+import plistlib
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from tests.fixtures import EPOCH, make_exporter, make_sample
+from asitop_exporter import exporter as exporter_module
+from asitop_exporter.parsers import unix_time
+from asitop_exporter.reader import PowermetricsStreamReader
+from asitop_exporter.recorder import Recording
+
+
+class FakeProcess:
+    def __init__(self) -> None:
+        self.terminated = False
+
+    def poll(self):
+        return 0 if self.terminated else None
+
+    def terminate(self) -> None:
+        self.terminated = True
+
+    def wait(self, timeout=None):
+        return self.poll()
+
+
+class FakeReader:
+    """Hand out queued frames, one batch per read_frames() call."""
+
+    def __init__(self, *batches) -> None:
+        self.batches = list(batches)
+        self.closed = False
+
+    def read_frames(self, timeout=None):
+        return self.batches.pop(0) if self.batches else []
+
+    def wait(self, timeout: float) -> bool:
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def frames(start: float, count: int, interval: float):
+    """Frames of a child sampling every ``interval`` seconds, the first at ``start``."""
+    batch = []
+    for index in range(count):
+        sample = make_sample('M1', index, interval=interval)
+        sample['timestamp'] = EPOCH + datetime.timedelta(seconds=start + index * interval)
+        batch.append(plistlib.dumps(sample))
+    return batch
+
+
+@pytest.fixture
+def exporter():
+    exporter = make_exporter(interval=4.0, adaptive_interval=(1.0, 2.0))
+    yield exporter
+    exporter.sinks.stop(timeout=1)
+
+
+def test_rate_switch_drops_overlapping_old_frames(exporter):
+    old = FakeReader(frames(0, 2, 2.0), frames(4, 3, 2.0))
+    new = FakeReader(frames(5, 3, 1.0))
+    exporter.powermetrics_process, exporter.reader = FakeProcess(), old
+    exporter.pending_powermetrics = (FakeProcess(), new)
+
+    readings = exporter.read_readings()
+    stamps = [reading[4].second for reading in readings]
+    # Old frames at 0 and 2, then 4 (drained); 6 and 8 overlap the new child's 5, 6, 7.
+    assert stamps == [0, 2, 4, 5, 6, 7]
+    assert exporter.reader is new
+    assert old.closed
+
+
+def test_rate_switch_records_the_overlap_once(tmp_path):
+    exporter = make_exporter(interval=4.0, adaptive_interval=(1.0, 2.0), record_dir=str(tmp_path))
+    old = FakeReader(frames(0, 2, 2.0), frames(4, 3, 2.0))
+    new = FakeReader(frames(5, 3, 1.0), frames(8, 1, 1.0))
+    exporter.powermetrics_process, exporter.reader = FakeProcess(), old
+    exporter.pending_powermetrics = (FakeProcess(), new)
+    try:
+        exporter.read_readings()
+        exporter.read_readings()
+    finally:
+        exporter.sinks.stop(timeout=1)
+        exporter.recorder.close()
+
+    recorded = [timestamp - unix_time(EPOCH) for timestamp, _ in Recording(str(tmp_path)).frames()]
+    assert recorded == [0, 2, 4, 5, 6, 7, 8]
+
+
+def test_stream_mode_counts_retries():
+    exporter = make_exporter(stream=True)
+    read_end, write_end = os.pipe()
+    exporter.powermetrics_process = FakeProcess()
+    exporter.reader = PowermetricsStreamReader(os.fdopen(read_end, 'rb'))
+    frame = frames(0, 1, 1.0)[0]
+    timer = threading.Timer(1.3, os.write, (write_end, frame + b'\0'))
+    timer.start()
+    try:
+        readings = exporter.get_reading()
+    finally:
+        timer.join()
+        os.close(write_end)
+        exporter.sinks.stop(timeout=1)
+    assert len(readings) == 1
+    assert exporter.registry.get_sample_value('asitop_exporter_reading_retries_total') == 1
+
+
+def run_exiting_powermetrics(monkeypatch, seconds: float, **kwargs) -> list:
+    """Run the collect loop for ``seconds`` with a powermetrics that exits at once."""
+    spawned = []
+
+    def exiting_powermetrics(timecode, interval=1000, output_file=True, **_):
+        process = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, '-c', ''],
+            stdout=subprocess.DEVNULL if output_file else subprocess.PIPE,
+        )
+        spawned.append(process)
+        return process
+
+    monkeypatch.setattr(exporter_module, 'run_powermetrics_process', exiting_powermetrics)
+    exporter = make_exporter(**kwargs)
+    exporter.timecode = str(int(time.time()))
+    exporter.start_powermetrics_process()
+    deadline = time.monotonic() + seconds
+    try:
+        while time.monotonic() < deadline:
+            exporter.maintain_powermetrics()
+            exporter.run_update()
+    finally:
+        exporter.terminate_powermetrics_process()
+        exporter.sinks.stop(timeout=1)
+    return spawned
+
+
+@pytest.mark.parametrize('stream', [True, False])
+def test_restarts_back_off(monkeypatch, capsys, stream):
+    spawned = run_exiting_powermetrics(monkeypatch, 2.5, stream=stream)
+    # Started, then restarted at once, after 1 s and after 2 more.
+    assert 2 <= len(spawned) <= 4
+    restarts = [line for line in capsys.readouterr().err.splitlines() if 'powermetrics exited' in line]
+    assert len(restarts) == len(spawned) - 1
+    assert all('exited with code 0, restarting in ' in line for line in restarts)
@@ -0,0 +1,30 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""HistoryStore ring buffer queries."""
+
+from __future__ import annotations
+
+from asitop_exporter.history import HistoryStore
+
+
+def test_query_range_after_wrapping():
+    store = HistoryStore(['power'], capacity=5)
+    for second in range(8):
+        store.append(float(second), {'power': second * 10.0})
+    assert store.query('power') == ([3.0, 4.0, 5.0, 6.0, 7.0], [30.0, 40.0, 50.0, 60.0, 70.0])
+    assert store.query('power', 4.5, 6.0) == ([5.0, 6.0], [50.0, 60.0])
+    assert store.query('power', 8.0) == ([], [])
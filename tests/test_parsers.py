@@ -0,0 +1,168 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Frame parsers: the bandwidth slots and rollups, and the cached CPU layout."""
+
+from __future__ import annotations
+
+import plistlib
+
+import pytest
+
+from tests.fixtures import TOPOLOGIES, make_exporter, make_sample
+from asitop_exporter.exporter import BANDWIDTH_VALUES
+from asitop_exporter.parsers import (
+    BANDWIDTH_COUNTERS,
+    get_cpu_layout,
+    parse_bandwidth_metrics,
+    parse_cpu_metrics,
+    parse_frames,
+)
+
+
+def rolled_up(counters):
+    """The rollups of ``parse_bandwidth_metrics``, written out by hand, in GB."""
+    gb = {name: counters.get(name, 0.0) / 1e9 for name in BANDWIDTH_COUNTERS}
+    for unit in ('PCPU', 'JPG', 'VENC'):
+        for direction in ('RD', 'WR'):
+            gb[f'{unit} DCS {direction}'] += sum(gb[f'{unit}{index} DCS {direction}'] for index in range(4))
+    gb['MEDIA DCS'] = sum(
+        gb[f'{unit} DCS {direction}']
+        for unit in ('ISP', 'STRM CODEC', 'PRORES', 'VDEC', 'VENC', 'JPG')
+        for direction in ('RD', 'WR')
+    )
+    return gb
+
+
+def test_counters_and_rollups():
+    sample = make_sample('M1', 0, bandwidth=True)
+    counters = {counter['name']: counter['value'] for counter in sample['bandwidth_counters']}
+    assert parse_bandwidth_metrics(sample) == pytest.approx(rolled_up(counters))
+
+
+def test_missing_counters_are_zero_and_unknown_ones_ignored():
+    sample = {'bandwidth_counters': [
+        {'name': 'PCPU2 DCS RD', 'value': 2e9},
+        {'name': 'JPG0 DCS WR', 'value': 1e9},
+        {'name': 'AMCC DCS RD', 'value': 7e9},
+    ]}
+    metrics = parse_bandwidth_metrics(sample)
+    assert 'AMCC DCS RD' not in metrics
+    assert metrics['PCPU DCS RD'] == 2.0
+    assert metrics['JPG DCS WR'] == 1.0
+    assert metrics['MEDIA DCS'] == 1.0
+    assert metrics['DCS RD'] == metrics['GFX DCS RD'] == 0.0
+
+
+def test_no_sampler_is_none():
+    assert parse_bandwidth_metrics(make_sample('M1', 0)) is None
+
+
+@pytest.mark.parametrize('interval', [0.25, 1.0, 5.0])
+def test_rates_are_scaled_by_elapsed_ns(interval):
+    sample = make_sample('M1 Max', 0, interval=interval, bandwidth=True)
+    counters = {counter['name']: counter['value'] for counter in sample['bandwidth_counters']}
+    gb = rolled_up(counters)
+    exporter = make_exporter(interval=1.0, bandwidth=True)
+    try:
+        values = exporter.derive_sample(parse_frames([plistlib.dumps(sample)], exporter.decoder)[0])
+    finally:
+        exporter.sinks.stop(timeout=1)
+    for key, sources in BANDWIDTH_VALUES:
+        assert values[key] == pytest.approx(sum(gb[source] for source in sources) / interval)
+    assert values['host_dram_bandwidth'] == pytest.approx(
+        (counters['DCS RD'] + counters['DCS WR']) / 1e9 / interval)
+
+
+def test_exporter_without_the_sampler_skips_bandwidth():
+    exporter = make_exporter(bandwidth=True)
+    try:
+        readings = parse_frames([plistlib.dumps(make_sample('M1', index)) for index in range(2)], exporter.decoder)
+        assert len(readings) == 2
+        exporter.ingest(readings)
+        exporter.publish()
+    finally:
+        exporter.sinks.stop(timeout=1)
+    assert not any(key in exporter.metrics_dict for key, _ in BANDWIDTH_VALUES)
+    assert 'host_cpu_power' in exporter.metrics_dict
+    family = {f.name: f for f in exporter.collector.collect()}['host_DRAM_bandwidth_GBps']
+    assert family.samples == []
+
+
+@pytest.mark.parametrize('topology', ['M1 Ultra', 'M3 Max', 'M3 Ultra', 'M4 Max'])
+def test_cpu_layout(topology):
+    sample = make_sample(topology, 3)
+    clusters = sample['processor']['clusters']
+    metrics = parse_cpu_metrics(sample)
+    layout = metrics['cpu'].layout
+
+    assert [name for name, _ in layout.key] == [name for name, _ in TOPOLOGIES[topology]]
+    assert layout.cluster_count == len(TOPOLOGIES[topology])
+    assert layout.core_count == sum(count for _, count in TOPOLOGIES[topology])
+    e_clusters = [cluster for cluster in clusters if cluster['name'][0] == 'E']
+    p_clusters = [cluster for cluster in clusters if cluster['name'][0] == 'P']
+    assert metrics['e_core'] == [cpu['cpu'] for cluster in e_clusters for cpu in cluster['cpus']]
+    assert metrics['p_core'] == [cpu['cpu'] for cluster in p_clusters for cpu in cluster['cpus']]
+    assert metrics['e_core'] + metrics['p_core'] == list(range(layout.core_count))
+
+    for prefix, group in (('E', e_clusters), ('P', p_clusters)):
+        # Active weighted by the cluster's cores, clock of the fastest cluster.
+        active = [int((1 - cluster['idle_ratio']) * 100) for cluster in group]
+        weights = [len(cluster['cpus']) for cluster in group]
+        assert metrics[f'{prefix}-Cluster_active'] == int(
+            sum(a * w for a, w in zip(active, weights)) / sum(weights))
+        assert metrics[f'{prefix}-Cluster_freq_Mhz'] == max(int(cluster['freq_hz'] / 1e6) for cluster in group)
+
+    reading = metrics['cpu']
+    assert len(reading.cluster_active) == len(reading.cluster_freq) == layout.cluster_count
+    assert reading.core_freq == [
+        int(cpu['freq_hz'] / 1e6) for cluster in clusters for cpu in cluster['cpus']
+    ]
+
+
+def test_cpu_layout_is_cached_per_topology():
+    first = parse_cpu_metrics(make_sample('M3 Ultra', 0))['cpu'].layout
+    assert parse_cpu_metrics(make_sample('M3 Ultra', 1))['cpu'].layout is first
+    other = parse_cpu_metrics(make_sample('M1 Ultra', 0))['cpu'].layout
+    assert other is not first
+    assert other.core_count == 20
+    assert parse_cpu_metrics(make_sample('M1 Ultra', 1))['cpu'].layout is other
+
+
+def test_cpu_layout_is_rebuilt_when_the_core_count_changes():
+    sample = make_sample('M4 Max', 0)
+    layout = parse_cpu_metrics(sample)['cpu'].layout
+    assert layout.core_count == 16
+
+    # A core of the second P cluster goes offline, the cluster names stay the same.
+    reduced = make_sample('M4 Max', 1)
+    reduced['processor']['clusters'][2]['cpus'].pop()
+    metrics = parse_cpu_metrics(reduced)
+    assert metrics['cpu'].layout is not layout
+    assert metrics['cpu'].layout.core_count == 15
+    assert len(metrics['cpu'].core_active) == len(metrics['cpu'].core_freq) == 15
+    assert metrics['p_core'] == list(range(4, 15))
+    assert get_cpu_layout(reduced['processor']['clusters']) is metrics['cpu'].layout
+
+    # The same number of cores with other ids is a new layout too.
+    renumbered = make_sample('M4 Max', 2)
+    for cpu in renumbered['processor']['clusters'][0]['cpus']:
+        cpu['cpu'] += 100
+    metrics = parse_cpu_metrics(renumbered)
+    assert metrics['cpu'].layout.core_count == 16
+    assert metrics['e_core'] == [100, 101, 102, 103]
+
+    assert parse_cpu_metrics(make_sample('M4 Max', 3))['cpu'].layout.key == layout.key
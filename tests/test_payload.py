@@ -0,0 +1,138 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""PayloadEncoder against the ``json.dumps`` body it replaced, byte for byte."""
+
+from __future__ import annotations
+
+import copy
+import json
+
+import pytest
+
+from tests.fixtures import TOPOLOGIES, make_exporter, make_frame
+from asitop_exporter.parsers import parse_frames
+from asitop_exporter.payload import PayloadEncoder
+
+
+TIMESTAMP = 1704067200123
+UUID = '0b7f3c1e-5d2a-4c8e-9f61-2a3b4c5d6e7f'
+
+
+def build_result(metrics_dict, nodeip, interval, timestamp=TIMESTAMP, uuid=UUID):
+    """``PrometheusExporter.build_result`` as it was before the precompiled encoder."""
+    metric_json = {
+        "cluster" : "jmlj-tonglu-productk8s",
+        "namespace": "ezagi",
+        "nodeip": nodeip,
+        "endpoint": nodeip,
+        "metric": "Throughput",
+        "value": 1.0,
+        "step": int(interval),
+        "counterType": "COUNTER",
+        "timestamp": timestamp,
+        "uuid": uuid,
+        "tags": {
+            "url": "",
+            "serviceName": "ezagi_algo_m2_iaas"
+        },
+        "monitorType": "iaas"
+    }
+    metric_json_list = []
+    for k, v in metrics_dict.items():
+        current_json = metric_json
+        current_json['tags']['url'] = k
+        current_json['value'] = v
+        metric_json_list.append(copy.deepcopy(current_json))
+    return metric_json_list
+
+
+def baseline(metrics_dict, nodeip='10.0.0.1', interval=1.0):
+    return json.dumps(build_result(metrics_dict, nodeip, interval)).encode()
+
+
+def encoded(metrics_dict, nodeip='10.0.0.1', interval=1.0):
+    return b'[' + PayloadEncoder(nodeip, interval).encode(metrics_dict, TIMESTAMP, UUID) + b']'
+
+
+def published_values(topology):
+    """The ``metrics_dict`` the exporter posts after a few fixture frames."""
+    exporter = make_exporter(bandwidth=True)
+    try:
+        exporter.ingest(parse_frames(
+            [make_frame(topology, index, bandwidth=True) for index in range(3)], exporter.decoder))
+        exporter.publish()
+    finally:
+        exporter.sinks.stop(timeout=1)
+    return exporter.metrics_dict
+
+
+@pytest.mark.parametrize('topology', sorted(TOPOLOGIES))
+def test_matches_json_dumps(topology):
+    values = published_values(topology)
+    assert encoded(values) == baseline(values)
+
+
+@pytest.mark.parametrize('interval', [0.5, 1.0, 2.7, 60.0])
+def test_step_is_truncated_like_int(interval):
+    values = {'host_cpu_power': 1.5}
+    assert encoded(values, interval=interval) == baseline(values, interval=interval)
+
+
+def test_number_edge_cases():
+    values = {
+        'int': 7,
+        'zero': 0,
+        'negative': -3,
+        'bool': True,
+        'tiny': 1e-7,
+        'huge': 1.5e300,
+        'precise': 0.1 + 0.2,
+        'nan': float('nan'),
+        'inf': float('inf'),
+        '-inf': float('-inf'),
+    }
+    assert encoded(values) == baseline(values)
+
+
+def test_strings_are_escaped():
+    nodeip = 'host "a"\\b\tµ\u2603'
+    values = {
+        'quote"key': 1.0,
+        'back\\slash': 2,
+        'new\nline': 3.5,
+        'control\x01': 4.0,
+        'unicode-\u00e9\u4e2d\U0001f600': 5.0,
+    }
+    assert encoded(values, nodeip=nodeip) == baseline(values, nodeip=nodeip)
+    assert json.loads(encoded(values, nodeip=nodeip))[0]['nodeip'] == nodeip
+
+
+def test_empty_sample():
+    assert encoded({}) == baseline({})
+
+
+def test_batch_matches_concatenated_records():
+    encoder = PayloadEncoder('10.0.0.1', 1.0)
+    first, second = published_values('M1'), published_values('M1 Ultra')
+    body = b'[' + b', '.join([
+        encoder.encode(first, TIMESTAMP, UUID),
+        encoder.encode(second, TIMESTAMP + 1000, UUID),
+    ]) + b']'
+    assert body == json.dumps(
+        build_result(first, '10.0.0.1', 1.0)
+        + build_result(second, '10.0.0.1', 1.0, timestamp=TIMESTAMP + 1000)
+    ).encode()
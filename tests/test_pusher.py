@@ -0,0 +1,82 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""PushGatewayPusher against a local HTTP server standing in for the Pushgateway."""
+
+from __future__ import annotations
+
+import gzip
+
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+
+from asitop_exporter.pusher import PushGatewayPusher, grouping_path
+
+
+def make_registry():
+    registry = CollectorRegistry()
+    Gauge('host_cpu_power', 'CPU power.', registry=registry).set(4.5)
+    return registry
+
+
+def test_grouping_path():
+    assert grouping_path('asitop', {'instance': 'mac-1'}) == '/metrics/job/asitop/instance/mac-1'
+    assert grouping_path('asitop', {'instance': 'a/b'}) == '/metrics/job/asitop/instance@base64/YS9i'
+    assert grouping_path('asitop', {'instance': ''}) == '/metrics/job/asitop/instance@base64/='
+
+
+def test_push_puts_the_exposition(server):
+    registry = make_registry()
+    pusher = PushGatewayPusher(server.url + '/', registry, job='asitop', grouping_key={'instance': 'mac-1'})
+    assert pusher.push()
+    request = server.requests[0]
+    assert request.method == 'PUT'
+    assert request.path == '/metrics/job/asitop/instance/mac-1'
+    assert b'host_cpu_power 4.5' in request.body
+    pusher.session.close()
+
+
+def test_push_gzip_and_retries(server):
+    server.statuses = [502, 429]
+    registry = make_registry()
+    pusher = PushGatewayPusher(server.url, registry, compress=True, backoff=0.01)
+    assert pusher.push()
+    assert len(server.requests) == 3
+    request = server.requests[-1]
+    assert request.headers['Content-Encoding'] == 'gzip'
+    assert b'host_cpu_power 4.5' in gzip.decompress(request.body)
+    assert registry.get_sample_value('asitop_exporter_push_failures_total') == 2
+    pusher.session.close()
+
+
+def test_push_does_not_retry_rejected_bodies(server):
+    server.statuses = [400]
+    registry = make_registry()
+    pusher = PushGatewayPusher(server.url, registry, backoff=0.01)
+    assert not pusher.push()
+    assert len(server.requests) == 1
+    assert registry.get_sample_value('asitop_exporter_push_failures_total') == 1
+    pusher.session.close()
+
+
+def test_body_rendered_once_per_version(server):
+    registry = make_registry()
+    version = [1]
+    pusher = PushGatewayPusher(server.url, registry, version=lambda: version[0])
+    first = pusher.render()
+    assert pusher.render() is first
+    version[0] = 2
+    assert pusher.render() == generate_latest(registry)
+    pusher.session.close()
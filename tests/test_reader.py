@@ -0,0 +1,112 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""PowermetricsFileReader and split_frames against a file written in chunks."""
+
+from __future__ import annotations
+
+import os
+
+from asitop_exporter.reader import PowermetricsFileReader, split_frames
+
+
+def frame(index: int) -> bytes:
+    return (
+        b'<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0">\n<dict>'
+        b'<key>index</key><integer>%d</integer></dict>\n</plist>\n' % index
+    )
+
+
+def append(path, data: bytes) -> None:
+    with open(path, 'ab') as fp:
+        fp.write(data)
+
+
+def test_split_frames():
+    frames, partial = split_frames(b'', frame(0) + b'\0' + frame(1)[:20])
+    assert frames == [frame(0)]
+    assert partial == frame(1)[:20]
+    # A frame ending in </plist> is complete before its NUL is written.
+    frames, partial = split_frames(partial, frame(1)[20:])
+    assert frames == [frame(1)]
+    assert partial == b''
+    # The NUL arriving on its own adds no empty frame.
+    assert split_frames(partial, b'\0') == ([], b'')
+
+
+def test_partial_frames_are_buffered(tmp_path):
+    path = tmp_path / 'powermetrics'
+    reader = PowermetricsFileReader(str(path))
+    assert reader.read_frames() == []  # not created yet
+
+    data = frame(0) + b'\0' + frame(1) + b'\0' + frame(2)
+    cuts = [0, 10, len(frame(0)), len(frame(0)) + 1, len(frame(0)) + 40, len(data) - 5, len(data)]
+    received = []
+    for start, end in zip(cuts, cuts[1:]):
+        append(path, data[start:end])
+        received += reader.read_frames()
+    assert received == [frame(0), frame(1), frame(2)]
+
+    # The trailing NUL of the last frame arrives in its own write.
+    append(path, b'\0')
+    assert reader.read_frames() == []
+    append(path, frame(3) + b'\0')
+    assert reader.read_frames() == [frame(3)]
+    reader.close()
+
+
+def test_truncated_file_starts_over(tmp_path):
+    path = tmp_path / 'powermetrics'
+    path.write_bytes(frame(0) + b'\0' + frame(1) + b'\0')
+    reader = PowermetricsFileReader(str(path))
+    assert len(reader.read_frames()) == 2
+
+    # Truncated in place and written again, as a new powermetrics -o does.
+    with open(path, 'r+b') as fp:
+        fp.truncate(0)
+    append(path, frame(2) + b'\0')
+    assert reader.read_frames() == [frame(2)]
+    reader.close()
+
+
+def test_rotated_file_is_reopened(tmp_path):
+    path = tmp_path / 'powermetrics'
+    path.write_bytes(frame(0) + b'\0' + frame(1)[:30])
+    reader = PowermetricsFileReader(str(path))
+    assert reader.read_frames() == [frame(0)]
+
+    # Replaced by a new file (new inode) that is longer than the old offset.
+    rotated = tmp_path / 'rotated'
+    rotated.write_bytes(frame(5) + b'\0' + frame(6) + b'\0')
+    os.replace(rotated, path)
+    assert reader.read_frames() == [frame(5), frame(6)]
+
+    os.remove(path)
+    assert reader.read_frames() == []
+    append(path, frame(7) + b'\0')
+    assert reader.read_frames() == [frame(7)]
+    reader.close()
+
+
+def test_large_offsets_across_allocation_granularity(tmp_path):
+    path = tmp_path / 'powermetrics'
+    padding = b'<plist>' + b' ' * 70000 + b'</plist>'
+    path.write_bytes(padding + b'\0')
+    reader = PowermetricsFileReader(str(path))
+    assert reader.read_frames() == [padding]
+    append(path, frame(1) + b'\0')
+    assert reader.read_frames() == [frame(1)]
+    reader.close()
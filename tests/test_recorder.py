@@ -0,0 +1,64 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Recorder segment rotation and size limits."""
+
+from __future__ import annotations
+
+import os
+
+from asitop_exporter.recorder import Recorder, Recording, list_segments, load_index
+
+
+def frame(second: int) -> bytes:
+    # Incompressible enough that every block has about the same size.
+    noise = os.urandom(2048).hex()
+    return (
+        f'<plist><dict><key>timestamp</key><date>2024-01-01T00:{second // 60:02d}:{second % 60:02d}Z</date>'
+        f'<key>noise</key><string>{noise}</string></dict></plist>'
+    ).encode('ascii')
+
+
+def recording_size(directory) -> int:
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def test_max_bytes_bounds_a_single_large_segment(tmp_path):
+    # One huge, long-lived segment: rotation alone would never enforce the limit.
+    recorder = Recorder(str(tmp_path), max_bytes=20000, segment_size=1 << 30, segment_age=1e9, block_size=1)
+    largest = 0
+    for second in range(100):
+        recorder.write([frame(second)])
+        largest = max(largest, recording_size(tmp_path))
+    recorder.close()
+    block = 4096
+    assert largest <= 20000 + block
+    assert len(list_segments(str(tmp_path))) >= 1
+
+
+def test_segments_started_in_the_same_second_are_kept_apart(tmp_path):
+    # Every block starts a new segment, and all frames have the same timestamp.
+    recorder = Recorder(str(tmp_path), segment_size=1, block_size=1)
+    frames = [frame(0) for _ in range(12)]
+    for raw in frames:
+        recorder.write([raw])
+    recorder.close()
+
+    segments = [os.path.basename(path) for path in list_segments(str(tmp_path))]
+    assert segments == ['1704067200.seg'] + [f'1704067200-{sequence}.seg' for sequence in range(1, 12)]
+    for path in list_segments(str(tmp_path)):
+        assert len(load_index(path)) == 1
+    assert [raw for _, raw in Recording(str(tmp_path)).frames()] == frames
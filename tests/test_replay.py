@@ -0,0 +1,123 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Replaying fixture captures into OpenMetrics text."""
+
+from __future__ import annotations
+
+import io
+from concurrent.futures import Future
+
+from prometheus_client.openmetrics.parser import text_string_to_metric_families
+
+from tests.fixtures import EPOCH, make_capture
+from asitop_exporter.collector import SnapshotCollector
+from asitop_exporter.exporter import PowerHistory, derive_sample
+from asitop_exporter.parsers import parse_frames, unix_time
+from asitop_exporter.replay import OpenMetricsWriter, map_bounded, parse_chunk, replay, split_capture
+
+
+def test_replay_capture_to_openmetrics(tmp_path):
+    first = make_capture(str(tmp_path / 'a.plist'), 'M1 Pro', frames=12)
+    second = make_capture(str(tmp_path / 'b.plist'), 'M1 Pro', frames=12)
+    output = io.StringIO()
+    # Small chunks so the frames are spread over several parser processes.
+    count = replay([first, second], output, hostname='fixture', jobs=2, chunk_size=4096)
+    text = output.getvalue()
+
+    assert count == 24
+    assert text.endswith('# EOF\n')
+    assert text.count('# EOF') == 1
+    families = {family.name: family for family in text_string_to_metric_families(text)}
+    power = families['host_cpu_power_W']
+    assert power.unit == 'W'
+    assert len(power.samples) == 24
+    assert all(sample.labels == {'hostname': 'fixture'} for sample in power.samples)
+    timestamps = [float(sample.timestamp) for sample in power.samples]
+    assert timestamps == sorted(timestamps) and len(set(timestamps)) == 24
+    assert timestamps[0] == unix_time(EPOCH)
+    # Ten cores, one series each, every series with a sample per frame.
+    cores = families['host_CPU_core_percent_Percentage'].samples
+    assert len({sample.labels['core'] for sample in cores}) == 10
+    assert len(cores) == 240
+
+
+def test_replay_derives_like_the_exporter(tmp_path):
+    capture = make_capture(str(tmp_path / 'a.plist'), 'M1', frames=8)
+    output = io.StringIO()
+    replay([capture], output, hostname='fixture', jobs=1)
+    families = {family.name: family for family in text_string_to_metric_families(output.getvalue())}
+
+    power = PowerHistory()
+    expected = [
+        derive_sample(reading, power, 1.0)
+        for chunk in split_capture(capture, 1 << 20)
+        for reading in parse_chunk(chunk)
+    ]
+    assert [sample.value for sample in families['host_cpu_peak_power_W'].samples] == [
+        values['host_cpu_peak_power'] for values in expected
+    ]
+    assert [sample.value for sample in families['host_gpu_avg_power_W'].samples] == [
+        values['host_gpu_avg_power'] for values in expected
+    ]
+
+
+def write(capture, buffer_size):
+    writer = OpenMetricsWriter(buffer_size=buffer_size)
+    collector = SnapshotCollector('fixture')
+    power = PowerHistory()
+    with open(capture, 'rb') as fp:
+        frames = [frame for frame in fp.read().split(b'\x00') if frame]
+    for index, reading in enumerate(parse_frames(frames)):
+        collector.update(derive_sample(reading, power, 1.0), cpu=collector.cpu_sample(reading[0]['cpu']))
+        writer.add(collector.collect(), 1704067200.0 + index)
+    output = io.StringIO()
+    writer.write(output)
+    return writer, output.getvalue()
+
+
+def test_spilling_does_not_change_the_output(tmp_path):
+    capture = make_capture(str(tmp_path / 'a.plist'), 'M3 Max', frames=6)
+    buffered, expected = write(capture, 1 << 30)
+    assert buffered.spool is None
+    spilled, text = write(capture, 1)
+    assert text == expected
+    assert spilled.spool is None  # closed after writing
+
+
+class CountingExecutor:
+    """Run submitted calls lazily and track how many are outstanding."""
+
+    def __init__(self) -> None:
+        self.outstanding = 0
+        self.most = 0
+
+    def submit(self, fn, item):
+        self.outstanding += 1
+        self.most = max(self.most, self.outstanding)
+        future = Future()
+        future.set_result(fn(item))
+        return future
+
+
+def test_map_bounded_keeps_order_and_limit():
+    executor = CountingExecutor()
+    results = []
+    for result in map_bounded(executor, lambda item: item * 2, range(20), 3):
+        executor.outstanding -= 1
+        results.append(result)
+    assert results == [item * 2 for item in range(20)]
+    assert executor.most == 3
@@ -0,0 +1,156 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""The cached ``/metrics`` endpoint: ETags, 304s, invalidation and gzip."""
+
+from __future__ import annotations
+
+import gzip
+import urllib.error
+import urllib.request
+
+import pytest
+from prometheus_client import CollectorRegistry, Histogram
+
+from asitop_exporter.collector import SnapshotCollector
+from asitop_exporter.server import ExporterApp, start_asyncio_server
+
+
+OPENMETRICS = 'application/openmetrics-text; version=1.0.0'
+
+
+class Stand:
+    """An ExporterApp over a snapshot collector, counting renders."""
+
+    def __init__(self, max_age=None) -> None:
+        self.registry = CollectorRegistry()
+        self.collector = SnapshotCollector('fixture')
+        self.registry.register(self.collector)
+        self.render_time = Histogram('render_seconds', 'Render time.', registry=CollectorRegistry())
+        self.app = ExporterApp(
+            self.registry,
+            snapshot=lambda: self.collector.snapshot,
+            max_age=max_age,
+            render_time=self.render_time,
+        )
+        self.publish(1.0)
+
+    def publish(self, power: float) -> None:
+        self.collector.update({'host_cpu_power': power}, timestamp=1704067200.0)
+
+    def get(self, **headers):
+        return self.app.handle('GET', '/metrics', '', {key.replace('_', '-'): value for key, value in headers.items()})
+
+    @property
+    def renders(self) -> float:
+        samples = self.render_time.collect()[0].samples
+        return next(sample.value for sample in samples if sample.name == 'render_seconds_count')
+
+
+def header(response, name):
+    return dict(response.headers).get(name)
+
+
+@pytest.fixture
+def stand():
+    return Stand()
+
+
+def test_body_is_rendered_once_per_sample(stand):
+    first = stand.get()
+    second = stand.get()
+    assert first.status == second.status == '200 OK'
+    assert second.body is first.body
+    assert header(second, 'ETag') == header(first, 'ETag')
+    assert b'host_cpu_power_W{hostname="fixture"} 1.0' in first.body
+    assert stand.renders == 1
+
+
+def test_if_none_match_returns_304(stand):
+    etag = header(stand.get(), 'ETag')
+    for if_none_match in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+        response = stand.get(if_none_match=if_none_match)
+        assert response.status == '304 Not Modified'
+        assert response.body == b''
+        assert header(response, 'ETag') == etag
+        assert header(response, 'Vary') == 'Accept, Accept-Encoding'
+    assert stand.get(if_none_match='"other"').status == '200 OK'
+
+
+def test_new_snapshot_invalidates(stand):
+    old = stand.get()
+    stand.publish(2.0)
+    response = stand.get(if_none_match=header(old, 'ETag'))
+    assert response.status == '200 OK'
+    assert header(response, 'ETag') != header(old, 'ETag')
+    assert b'host_cpu_power_W{hostname="fixture"} 2.0' in response.body
+    assert stand.renders == 2
+
+
+def test_max_age_rerenders_without_a_new_sample():
+    stand = Stand(max_age=0.0)
+    first = stand.get()
+    second = stand.get(if_none_match=header(first, 'ETag'))
+    assert second.status == '200 OK'
+    assert header(second, 'ETag') != header(first, 'ETag')
+
+
+def test_gzip_negotiation(stand):
+    plain = stand.get()
+    compressed = stand.get(accept_encoding='br, gzip;q=0.8')
+    assert header(plain, 'Content-Encoding') is None
+    assert header(compressed, 'Content-Encoding') == 'gzip'
+    assert gzip.decompress(compressed.body) == plain.body
+    # Every representation has its own ETag, and all of them vary on both headers.
+    assert header(compressed, 'ETag') != header(plain, 'ETag')
+    assert header(plain, 'Vary') == header(compressed, 'Vary') == 'Accept, Accept-Encoding'
+    assert stand.get(if_none_match=header(plain, 'ETag'), accept_encoding='gzip').status == '200 OK'
+    assert stand.get(if_none_match=header(compressed, 'ETag'), accept_encoding='gzip').status == '304 Not Modified'
+
+
+def test_openmetrics_is_cached_separately(stand):
+    text = stand.get()
+    openmetrics = stand.get(accept=OPENMETRICS)
+    assert header(openmetrics, 'Content-Type').startswith('application/openmetrics-text')
+    assert openmetrics.body.endswith(b'# EOF\n')
+    assert header(openmetrics, 'ETag') != header(text, 'ETag')
+    assert stand.get(accept=OPENMETRICS).body is openmetrics.body
+    assert stand.renders == 2
+
+
+def test_filtered_requests_bypass_the_cache(stand):
+    etag = header(stand.get(), 'ETag')
+    response = stand.app.handle('GET', '/metrics', 'name[]=host_cpu_power_W', {'if-none-match': etag})
+    assert response.status == '200 OK'
+    assert header(response, 'Vary') == 'Accept, Accept-Encoding'
+    assert b'host_cpu_power_W' in response.body and b'host_ECPU_percent' not in response.body
+
+
+def test_304_over_http(stand):
+    httpd, thread = start_asyncio_server(stand.app, 0, addr='127.0.0.1')
+    try:
+        url = f'http://127.0.0.1:{httpd.server_port}/metrics'
+        with urllib.request.urlopen(url, timeout=5) as response:
+            etag = response.headers['ETag']
+            assert response.headers['Vary'] == 'Accept, Accept-Encoding'
+        request = urllib.request.Request(url, headers={'If-None-Match': etag})
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request, timeout=5)
+        assert error.value.code == 304
+        assert error.value.headers['Vary'] == 'Accept, Accept-Encoding'
+    finally:
+        httpd.shutdown(timeout=5)
+        thread.join(5)
@@ -0,0 +1,141 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""HttpJsonSink batching, gzip and retries against a local HTTP server."""
+
+from __future__ import annotations
+
+import gzip
+import json
+import time
+
+from prometheus_client import CollectorRegistry
+
+from tests.fixtures import make_exporter, make_frame
+from asitop_exporter.parsers import parse_frames
+from asitop_exporter.payload import PayloadEncoder
+from asitop_exporter.sinks import HttpJsonSink, Sample, SinkPipeline
+
+
+def make_sink(url, **kwargs):
+    registry = CollectorRegistry()
+    pipeline = SinkPipeline(registry)
+    kwargs.setdefault('backoff', 0.01)
+    sink = pipeline.add(HttpJsonSink(url, PayloadEncoder('10.0.0.1', 1.0), **kwargs))
+    return pipeline, sink, registry
+
+
+def sample(value):
+    return Sample(time.time(), {'host_cpu_power': value})
+
+
+def counter(registry, name):
+    return registry.get_sample_value(name, {'sink': 'http'}) or 0.0
+
+
+def test_batches_samples_into_one_post(server):
+    pipeline, _, registry = make_sink(server.url, batch_size=3, linger=2.0)
+    for value in range(3):
+        pipeline.publish(sample(value))
+    pipeline.start()
+    try:
+        requests = server.wait_for(1)
+        time.sleep(0.1)
+    finally:
+        pipeline.stop(timeout=5)
+    assert len(server.requests) == 1
+    assert requests[0].method == 'POST'
+    assert len(json.loads(requests[0].body)) == 3
+    assert counter(registry, 'asitop_exporter_sink_samples_written_total') == 3
+
+
+def test_gzip_body(server):
+    pipeline, _, _ = make_sink(server.url, compress=True)
+    pipeline.start()
+    try:
+        pipeline.publish(sample(1.5))
+        request = server.wait_for(1)[0]
+    finally:
+        pipeline.stop(timeout=5)
+    assert request.headers['Content-Encoding'] == 'gzip'
+    records = json.loads(gzip.decompress(request.body))
+    assert len(records) == 1
+
+
+def test_retries_5xx_and_429(server):
+    server.statuses = [503, 429]
+    pipeline, sink, registry = make_sink(server.url, retries=3)
+    pipeline.start()
+    assert sink.write([sample(1.0)])
+    assert len(server.requests) == 3
+    assert server.requests[0].body == server.requests[2].body
+    assert counter(registry, 'asitop_exporter_sink_failures_total') == 2
+    pipeline.stop(timeout=5)
+
+
+def test_gives_up_after_retries(server):
+    server.statuses = [500] * 3
+    pipeline, sink, registry = make_sink(server.url, retries=2)
+    pipeline.start()
+    sink._write([sample(1.0)])  # pylint: disable=protected-access
+    assert len(server.requests) == 3
+    assert counter(registry, 'asitop_exporter_sink_failures_total') == 3
+    assert counter(registry, 'asitop_exporter_sink_samples_dropped_total') == 1
+    pipeline.stop(timeout=5)
+
+
+def test_4xx_drops_the_batch_without_retrying(server):
+    server.statuses = [413]
+    pipeline, sink, registry = make_sink(server.url, retries=3)
+    pipeline.start()
+    sink._write([sample(1.0), sample(2.0)])  # pylint: disable=protected-access
+    assert len(server.requests) == 1
+    assert counter(registry, 'asitop_exporter_sink_failures_total') == 1
+    assert counter(registry, 'asitop_exporter_sink_samples_dropped_total') == 2
+    assert counter(registry, 'asitop_exporter_sink_samples_written_total') == 0
+    pipeline.stop(timeout=5)
+
+
+def test_failure_interrupted_by_stop_is_counted(server):
+    server.statuses = [503]
+    pipeline, sink, registry = make_sink(server.url, retries=3, backoff=60.0, max_backoff=60.0)
+    pipeline.start()
+    sink._stop.set()  # pylint: disable=protected-access
+    sink._write([sample(1.0)])  # pylint: disable=protected-access
+    assert len(server.requests) == 1
+    assert counter(registry, 'asitop_exporter_sink_failures_total') == 1
+    assert counter(registry, 'asitop_exporter_sink_samples_dropped_total') == 1
+    pipeline.stop(timeout=5)
+
+
+def test_write_latency_is_a_self_metric():
+    for self_metrics in (True, False):
+        exporter = make_exporter(self_metrics=self_metrics)
+        try:
+            exporter.ingest(parse_frames([make_frame('M1', 0)]))
+            exporter.publish()
+        finally:
+            exporter.sinks.stop(timeout=1)
+        labels = {'sink': 'prometheus'}
+        assert exporter.registry.get_sample_value('asitop_exporter_sink_samples_written_total', labels) == 1
+        latency = exporter.registry.get_sample_value('asitop_exporter_sink_write_latency_seconds_count', labels)
+        if self_metrics:
+            assert latency == 1
+            assert exporter.self_metrics.registry.get_sample_value(
+                'asitop_exporter_sink_write_latency_seconds_count', labels) == 1
+        else:
+            # --no_self_metrics removes every self metric, the post latency included.
+            assert latency is None
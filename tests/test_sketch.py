@@ -0,0 +1,42 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""QuantileTracker summaries."""
+
+from __future__ import annotations
+
+import math
+
+from asitop_exporter.sketch import QuantileTracker
+
+
+def test_count_and_sum_are_cumulative():
+    tracker = QuantileTracker(['power'], windows=[60], quantiles=[0.5])
+    for second in range(60):
+        tracker.add({'power': 1.0}, now=float(second))
+    for second in range(60, 180):
+        tracker.add({'power': 5.0}, now=float(second))
+
+    summary = tracker.summary(now=179.0)['power'][60]
+    # Only the last window's values are in the quantiles...
+    assert math.isclose(summary.quantiles[0], 5.0, rel_tol=0.02)
+    # ...but _count and _sum keep growing after old sub-windows expire.
+    assert summary.count == 180
+    assert summary.sum == 60 * 1.0 + 120 * 5.0
+
+    later = tracker.summary(now=1000.0)['power'][60]
+    assert later.count == 180
+    assert math.isnan(later.quantiles[0])
@@ -0,0 +1,103 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""SoC discovery and its on-disk cache, with canned sysctl output."""
+
+from __future__ import annotations
+
+from typing import List, Sequence
+
+from asitop_exporter.soc import discover_soc_info
+
+
+SYSCTL = {
+    'machdep.cpu.brand_string': 'Apple M1 Max',
+    'machdep.cpu.core_count': '10',
+    'hw.perflevel0.logicalcpu': '8',
+    'hw.perflevel1.logicalcpu': '2',
+    'hw.model': 'MacBookPro18,2',
+    'kern.osversion': '23A344',
+    'kern.uuid': 'A-B-C',
+    'kern.bootsessionuuid': 'boot-1',
+}
+SYSTEM_PROFILER = """Graphics/Displays:
+
+    Apple M1 Max:
+
+      Chipset Model: Apple M1 Max
+      Total Number of Cores: 32
+"""
+
+
+class FakeRunner:
+    """Answer sysctl and system_profiler from canned output and log the calls."""
+
+    def __init__(self, sysctl=None, failing: Sequence[str] = ()) -> None:
+        self.sysctl = dict(SYSCTL if sysctl is None else sysctl)
+        self.failing = failing
+        self.calls: List[str] = []
+
+    def __call__(self, command: Sequence[str]) -> str:
+        self.calls.append(command[0])
+        if command[0] in self.failing:
+            return ''
+        if command[0] == 'sysctl':
+            return ''.join(f'{key}: {self.sysctl[key]}\n' for key in command[1:] if key in self.sysctl)
+        if command[0] == 'system_profiler':
+            return SYSTEM_PROFILER
+        raise AssertionError(f'unexpected command {command}')
+
+
+def test_discovers_and_caches(tmp_path):
+    cache = str(tmp_path / 'soc_info.json')
+    run = FakeRunner()
+    soc_info = discover_soc_info(run, cache)
+    assert soc_info['name'] == 'Apple M1 Max'
+    assert soc_info['core_count'] == 10
+    assert (soc_info['e_core_count'], soc_info['p_core_count']) == (2, 8)
+    assert soc_info['gpu_core_count'] == 32
+    assert (soc_info['cpu_max_power'], soc_info['gpu_max_power']) == (30, 60)
+    assert 'system_profiler' in run.calls
+
+    cached = FakeRunner()
+    assert discover_soc_info(cached, cache) == soc_info
+    # Only the fingerprint is read on a cache hit.
+    assert cached.calls == ['sysctl']
+
+
+def test_fingerprint_mismatch_discovers_again(tmp_path):
+    cache = str(tmp_path / 'soc_info.json')
+    discover_soc_info(FakeRunner(), cache)
+    rebooted = FakeRunner({**SYSCTL, 'kern.bootsessionuuid': 'boot-2', 'machdep.cpu.brand_string': 'Apple M2'})
+    soc_info = discover_soc_info(rebooted, cache)
+    assert 'system_profiler' in rebooted.calls
+    assert soc_info['name'] == 'Apple M2'
+    assert discover_soc_info(FakeRunner(rebooted.sysctl), cache)['name'] == 'Apple M2'
+
+
+def test_failing_commands(tmp_path):
+    cache = tmp_path / 'soc_info.json'
+    soc_info = discover_soc_info(FakeRunner(failing=('system_profiler',)), str(cache))
+    assert soc_info['gpu_core_count'] == '?'
+    assert soc_info['name'] == 'Apple M1 Max'
+
+    cache.unlink()
+    soc_info = discover_soc_info(FakeRunner(failing=('sysctl',)), str(cache))
+    assert soc_info['name'] == '?'
+    assert soc_info['core_count'] == '?'
+    assert soc_info['gpu_core_count'] == 32
+    # Without a fingerprint nothing is cached.
+    assert not cache.exists()
@@ -0,0 +1,98 @@
+# This file is part of asitop, the interactive NVIDIA-GPU process viewer.
+#
+# Copyright 2021-2024 fangxuwei. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""The polling and inotify file watchers on an appended and rotated file."""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+
+import pytest
+
+from asitop_exporter.watch import InotifyWatcher, PollingWatcher
+
+
+BACKENDS = [
+    PollingWatcher,
+    pytest.param(
+        InotifyWatcher,
+        marks=pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is Linux only'),
+    ),
+]
+
+
+def append(path, data: bytes) -> None:
+    with open(path, 'ab') as fp:
+        fp.write(data)
+
+
+@pytest.fixture(params=BACKENDS)
+def watched(request, tmp_path):
+    path = tmp_path / 'powermetrics'
+    append(path, b'first')
+    watcher = request.param(str(path))
+    yield path, watcher
+    watcher.close()
+
+
+def test_quiet_file_times_out(watched):
+    _, watcher = watched
+    start = time.monotonic()
+    assert not watcher.wait(0.2)
+    assert time.monotonic() - start >= 0.2
+
+
+def test_append_wakes_the_waiter(watched):
+    path, watcher = watched
+    append(path, b'second')
+    assert watcher.wait(2.0)
+    assert not watcher.wait(0.1)
+
+
+def test_rename_over_the_file_wakes_the_waiter(watched):
+    path, watcher = watched
+    rotated = path.with_name('powermetrics.new')
+    append(rotated, b'rotated')
+    os.replace(rotated, path)
+    assert watcher.wait(2.0)
+    append(path, b'more')
+    assert watcher.wait(2.0)
+
+
+def test_recreated_file_wakes_the_waiter(watched):
+    path, watcher = watched
+    path.unlink()
+    # The polling watcher may see the deletion on its own first.
+    watcher.wait(0.1)
+    append(path, b'new')
+    assert watcher.wait(2.0)
+
+
+def test_other_files_are_ignored(tmp_path):
+    path = tmp_path / 'powermetrics'
+    append(path, b'first')
+    watchers = [PollingWatcher(str(path))]
+    if sys.platform.startswith('linux'):
+        watchers.append(InotifyWatcher(str(path)))
+    try:
+        append(tmp_path / 'other', b'noise')
+        for watcher in watchers:
+            assert not watcher.wait(0.1)
+    finally:
+        for watcher in watchers:
+            watcher.close()